@@ -0,0 +1,61 @@
+"""Time it takes LightGCode to analyse a print with the GCode._preprocess
+loop, with gcoder_preprocess when it is built and with the NumPy columnar
+engine when NumPy is installed, and to load it from a file with
+gcoder.parse_file in 1 to 4 processes.
+
+    PYTHONPATH=. python benchmarks/bench_analysis.py [lines]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from bqclient.host.drivers.printrun import gcoder
+
+
+def corpus(count):
+    lines = ["G28", "G90", "M82", "G92 E0"]
+    for i in range(count):
+        if i % 1000 == 0:
+            lines.append("G1 Z%.2f F600" % (0.2 + i / 5000.0))
+            lines.append("G92 E0")
+        lines.append("G1 X%.3f Y%.3f E%.5f F1800" % (100 + (i % 50) * 0.37, 100 + (i % 70) * 0.29, (i % 1000) * 0.01))
+    return lines
+
+
+def measure(name, data, columnar, compiled=False):
+    gcoder.LightGCode.columnar = columnar
+    gcoder.LightGCode.compiled = compiled
+    started = time.perf_counter()
+    gcode = gcoder.LightGCode(data)
+    elapsed = time.perf_counter() - started
+    print("%-8s %7.3f s  %d layers, %.1f mm of filament" % (name, elapsed, len(gcode.all_layers), gcode.filament_length))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    data = corpus(count)
+    measure("loop", data, False)
+    if gcoder.gcoder_preprocess is None:
+        print("gcoder_preprocess isn't built, run python setup.py build_ext --inplace")
+    else:
+        measure("compiled", data, False, True)
+    if gcoder.gcoder_columnar is None:
+        print("NumPy isn't installed, the columnar engine is unavailable")
+        return
+    measure("columnar", data, True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "corpus.gcode")
+        with open(path, "w") as fh:
+            fh.write("\n".join(data))
+        for workers in (1, 2, 4):
+            started = time.perf_counter()
+            gcoder.parse_file(path, workers=workers, min_parallel_size=0)
+            elapsed = time.perf_counter() - started
+            print("%d workers %6.3f s to load %.1f MB on %d cores" %
+                  (workers, elapsed, os.path.getsize(path) / 1e6, os.cpu_count()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Lines and bytes saved by fitting arcs to a print made mostly of
+cylinders, tessellated like slicers do, and time it takes, alone and
+followed by the Optimizer.
+
+    PYTHONPATH=. python benchmarks/bench_arcs.py [layers] [tolerance]
+"""
+import math
+import sys
+import time
+
+from bqclient.host.drivers.printrun.arcs import ArcFitter
+from bqclient.host.drivers.printrun.optimizer import Optimizer
+
+
+def cylinder(lines, e, center, radius, resolution=0.2, clockwise=False):
+    """The perimeter of a cylinder, in moves of about resolution mm"""
+    segments = max(8, int(2 * math.pi * radius / resolution))
+    sign = -1 if clockwise else 1
+    lines.append("G0 X%.3f Y%.3f F9000" % (center[0] + radius, center[1]))
+    for k in range(1, segments + 1):
+        angle = sign * 2 * math.pi * k / segments
+        e += 0.0333 * 2 * math.pi * radius / segments
+        lines.append("G1 X%.3f Y%.3f E%.5f F1800.000 ; perimeter" % (
+            center[0] + radius * math.cos(angle), center[1] + radius * math.sin(angle), e))
+    return e
+
+
+def corpus(layers):
+    lines = ["G28", "G21", "G90", "M82", "M104 S210", "G92 E0"]
+    for layer in range(layers):
+        lines.append(";LAYER:%d" % layer)
+        lines.append("G1 Z%.2f F600" % (0.2 * (layer + 1)))
+        e = 0.0
+        for (cx, cy) in ((60, 60), (120, 60), (60, 120), (120, 120)):
+            for (radius, clockwise) in ((20, False), (19.6, True), (8, False)):
+                e = cylinder(lines, e, (cx, cy), radius, clockwise=clockwise)
+        # Some infill between them
+        for i in range(20):
+            e += 0.5
+            lines.append("G1 X%d Y%d E%.5f" % (40 + 5 * i, 90 + (i % 2) * 5, e))
+        lines.append("G92 E0")
+    return lines
+
+
+def report(name, lines, result, elapsed):
+    before = sum(len(line) + 1 for line in lines)
+    after = sum(len(line) + 1 for line in result)
+    print("%-18s %7d lines, %9d bytes, %5.1f%% of the bytes, %6.3f s" % (
+        name, len(result), after, 100.0 * after / before, elapsed))
+
+
+def main():
+    layers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    lines = corpus(layers)
+    report("original", lines, lines, 0)
+
+    started = time.perf_counter()
+    fitter = ArcFitter(tolerance)
+    fitted = list(fitter.lines(lines))
+    report("arcs", lines, fitted, time.perf_counter() - started)
+    print("%d moves fitted into %d arcs" % (fitter.segments, fitter.arcs))
+
+    started = time.perf_counter()
+    optimized = list(Optimizer().lines(lines))
+    report("optimizer", lines, optimized, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    both = list(Optimizer().lines(ArcFitter(tolerance).lines(lines)))
+    report("arcs and optimizer", lines, both, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
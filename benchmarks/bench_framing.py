@@ -0,0 +1,50 @@
+"""Per-line cost of framing a command for the serial port.
+
+Compares the string based framing printcore used to do with the pure
+Python and compiled bytes based helpers. Run with:
+
+    PYTHONPATH=. python benchmarks/bench_framing.py
+"""
+import timeit
+from functools import reduce
+
+from bqclient.host.drivers.printrun import printcore
+
+COMMANDS = [
+    "G1 X102.331 Y87.129 E1.20343",
+    "G1 X103.02 Y87.54 E0.01922",
+    "G0 F7200 X80.5 Y95.25",
+    "M104 S210",
+]
+NUMBER = 200000
+
+
+def string_frame(command, lineno):
+    prefix = "N" + str(lineno) + " " + command
+    command = prefix + "*" + str(reduce(lambda x, y: x ^ y, map(ord, prefix)))
+    return (command + "\n").encode('ascii')
+
+
+def run(name, function, commands):
+    def _loop():
+        for lineno in range(NUMBER // len(commands)):
+            for command in commands:
+                function(command, lineno)
+
+    seconds = min(timeit.repeat(_loop, number=1, repeat=5))
+    print("%-28s %8.3f us/line" % (name, seconds * 1e6 / NUMBER))
+
+
+def main():
+    encoded = [command.encode('ascii') for command in COMMANDS]
+
+    run("string (before)", string_frame, COMMANDS)
+    run("bytes, pure Python", printcore.py_frame, encoded)
+    if printcore.frame is not printcore.py_frame:
+        run("bytes, compiled", printcore.frame, encoded)
+    else:
+        print("compiled framing is not built, run python setup.py build_ext --inplace")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Time it takes GCode and LightGCode to analyse a print with each kind of
+line, with the _preprocess loop, and what a move costs with them: the
+pure Python PyLine and PyLightLine, and GLine and GLightLine when
+gcoder_line is built.
+
+    PYTHONPATH=. python benchmarks/bench_lines.py [lines]
+"""
+import sys
+import time
+
+from bqclient.host.drivers.printrun import gcoder
+
+
+def corpus(count):
+    lines = ["G28", "G90", "M82", "G92 E0"]
+    for i in range(count):
+        if i % 1000 == 0:
+            lines.append("G1 Z%.2f F600" % (0.2 + i / 5000.0))
+        lines.append("G1 X%.3f Y%.3f E%.5f" % (100 + (i % 50) * 0.37, 100 + (i % 70) * 0.29, i * 0.01))
+    return lines
+
+
+def measure(name, gcode_class, line_class, data):
+    gcode = gcode_class(deferred=True)
+    gcode.line_class = line_class
+    gcode.columnar = False
+    gcode.compiled = False
+    started = time.perf_counter()
+    gcode.prepare(data)
+    elapsed = time.perf_counter() - started
+    print("%-14s %7.3f s  %4d bytes per move" % (name, elapsed, gcoder.line_size(gcode.lines[-1])))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = corpus(count)
+    heavy = [gcoder.PyLine]
+    light = [gcoder.PyLightLine]
+    if gcoder.gcoder_line is None:
+        print("gcoder_line isn't built, run python setup.py build_ext --inplace")
+    else:
+        heavy.append(gcoder.gcoder_line.GLine)
+        light.append(gcoder.gcoder_line.GLightLine)
+    print(gcoder.implementation())
+    for line_class in heavy:
+        # _preprocess only sets attributes on lines of the Line class
+        gcoder.Line = line_class
+        measure(line_class.__name__, gcoder.GCode, line_class, data)
+    for line_class in light:
+        measure(line_class.__name__, gcoder.LightGCode, line_class, data)
+
+
+if __name__ == "__main__":
+    main()
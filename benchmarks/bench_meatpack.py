@@ -0,0 +1,70 @@
+"""Streams a print to the virtual printer at a given baud rate with and
+without MeatPack, and reports lines/sec and bytes per line on the wire. The
+packer's own throughput is printed first.
+
+Run with:
+
+    PYTHONPATH=. python benchmarks/bench_meatpack.py [lines] [baud]
+"""
+import sys
+import time
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.meatpack import MeatPacker
+from bqclient.host.drivers.printrun.printcore import frame, printcore
+from bqclient.host.drivers.printrun.virtual_printer import VirtualPrinter
+
+WINDOW_SIZE = 4
+
+
+def corpus(count):
+    return ["G1 X%.3f Y%.3f E%.5f" % (100 + (i % 50) * 0.37, 100 + (i % 70) * 0.41, i * 0.01)
+            for i in range(count)]
+
+
+def bench_packer(lines):
+    data = b"".join(frame(line.encode('ascii'), i + 1) for (i, line) in enumerate(lines))
+    for no_spaces in (False, True):
+        packer = MeatPacker(no_spaces)
+        started = time.perf_counter()
+        packed = packer.pack(data)
+        elapsed = time.perf_counter() - started
+        print("packer  no spaces %-5s  %8.0f lines/s  %.2f of the bytes" %
+              (no_spaces, len(lines) / elapsed, len(packed) / len(data)))
+
+
+def run(lines, baud, meatpack):
+    printer = VirtualPrinter(seed=42, meatpack=meatpack, baud=baud)
+    printer.start()
+    core = printcore()
+    core.meatpack = meatpack
+    try:
+        core.connect(printer.port, baud)
+        while not core.online:
+            time.sleep(0.01)
+        core.window_size = WINDOW_SIZE
+        received = printer.bytes_received
+        started = time.perf_counter()
+        core.startprint(LightGCode(lines))
+        while core.printing:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - started
+        received = printer.bytes_received - received
+    finally:
+        core.disconnect()
+        printer.stop()
+    print("baud %6d  meatpack %-5s  %6.0f lines/s  %5.1f bytes per line" %
+          (baud, meatpack, len(lines) / elapsed, received / len(lines)))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    baud = int(sys.argv[2]) if len(sys.argv) > 2 else 115200
+    lines = corpus(count)
+    bench_packer(corpus(100000))
+    for meatpack in (False, True):
+        run(lines, baud, meatpack)
+
+
+if __name__ == "__main__":
+    main()
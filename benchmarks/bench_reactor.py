@@ -0,0 +1,100 @@
+"""Compares ok latency and throughput of many printers printing at once with
+their own threads against all of them sharing one reactor thread.
+
+Each printer is a virtual printer on its own pseudo-terminal, taking as long
+to receive as a serial port at the given baud rate. The virtual printers run
+in a process of their own, so they don't take the GIL from printcore. With a
+baud rate of 0 they answer right away, which measures how many lines the host
+can push rather than the latency printers see. Run with:
+
+    PYTHONPATH=. python benchmarks/bench_reactor.py [lines per printer] [baud]
+"""
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+from collections import deque
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.printcore import printcore
+from bqclient.host.drivers.printrun.reactor import Reactor
+from bqclient.host.drivers.printrun.virtual_printer import VirtualPrinter
+
+PRINTER_COUNTS = [1, 10, 30]
+
+
+def track_latency(core, latencies):
+    sent = deque()
+    core.sendcb = lambda command, gline: sent.append(time.perf_counter())
+
+    def on_recv(line):
+        if line.startswith("ok") and sent:
+            latencies.append(time.perf_counter() - sent.popleft())
+
+    core.recvcb = on_recv
+
+
+def serve(count, baud, connection):
+    """Runs count virtual printers until told to stop"""
+    logging.disable(logging.WARNING)
+    printers = [VirtualPrinter(baud=baud or None) for _ in range(count)]
+    for printer in printers:
+        printer.start()
+    connection.send([printer.port for printer in printers])
+    connection.recv()
+    for printer in printers:
+        printer.stop()
+
+
+def run(count, lines, baud, reactor):
+    (connection, printers_connection) = multiprocessing.Pipe()
+    printers = multiprocessing.Process(target=serve, args=(count, baud, printers_connection))
+    printers.start()
+    cores = []
+    latencies = []
+    try:
+        for port in connection.recv():
+            core = printcore()
+            core.reactor = reactor
+            core.connect(port, 115200)
+            cores.append(core)
+        while not all(core.online for core in cores):
+            time.sleep(0.01)
+        for core in cores:
+            track_latency(core, latencies)
+        started = time.perf_counter()
+        for core in cores:
+            core.startprint(LightGCode(lines))
+        while any(core.printing for core in cores):
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - started
+        # Leaving out the main thread
+        threads = threading.active_count() - 1
+    finally:
+        for core in cores:
+            core.disconnect()
+        connection.send(None)
+        printers.join()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1e6
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+    print("%-8s %3d printers  %8.0f lines/s  p50 %7.1f us  p99 %8.1f us  %4d printcore threads" %
+          ("reactor" if reactor else "threads", count, count * len(lines) / elapsed, p50, p99, threads))
+
+
+def main():
+    logging.disable(logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    baud = int(sys.argv[2]) if len(sys.argv) > 2 else 115200
+    lines = ["G1 X%d Y%d E%d" % (i % 100, i % 80, i) for i in range(count)]
+    for printer_count in PRINTER_COUNTS:
+        run(printer_count, lines, baud, None)
+        reactor = Reactor()
+        run(printer_count, lines, baud, reactor)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    main()
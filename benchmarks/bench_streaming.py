@@ -0,0 +1,77 @@
+"""Time until the first line can be sent and peak memory of loading a print
+up front with LightGCode and with PackedGCode against streaming it with
+StreamingGCode and indexing a memory mapped copy with MappedGCode. The
+memory kept once loaded is shown too.
+
+    PYTHONPATH=. python benchmarks/bench_streaming.py [lines]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.mapped import MappedGCode
+from bqclient.host.drivers.printrun.packed import PackedGCode
+from bqclient.host.drivers.printrun.streaming import StreamingGCode
+
+
+def write_corpus(path, count):
+    with open(path, "w") as fh:
+        for i in range(count):
+            if i % 1000 == 0:
+                fh.write("G1 Z%.2f\n" % (0.2 + i / 5000.0))
+            fh.write("G1 X%.3f Y%.3f E%.5f\n" % (100 + (i % 50) * 0.37, 100 + (i % 70) * 0.29, i * 0.01))
+
+
+def loaded(path, gcode_class=LightGCode):
+    with open(path, 'rb') as fh:
+        gcode = gcode_class([i.strip().decode("utf-8") for i in fh.readlines()])
+    (layer, line) = gcode.idxs(0)
+    return gcode, gcode.all_layers[layer][line]
+
+
+def packed(path):
+    return loaded(path, PackedGCode)
+
+
+def streamed(path):
+    gcode = StreamingGCode(path)
+    return gcode, gcode.line_at(0)[1]
+
+
+def mapped(path):
+    gcode = MappedGCode(path)
+    return gcode, gcode.line_at(0)[1]
+
+
+def measure(name, function, path):
+    started = time.perf_counter()
+    function(path)
+    elapsed = time.perf_counter() - started
+    # Tracing allocations slows everything down, so memory is measured on a
+    # second run
+    tracemalloc.start()
+    kept = function(path)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-10s first line after %7.3f s, peak memory %7.1f MB, %7.1f MB kept" %
+          (name, elapsed, peak / 1e6, current / 1e6))
+    del kept
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "corpus.gcode")
+        write_corpus(path, count)
+        print("%d lines, %.1f MB" % (count, os.path.getsize(path) / 1e6))
+        measure("LightGCode", loaded, path)
+        measure("packed", packed, path)
+        measure("streamed", streamed, path)
+        measure("mapped", mapped, path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Time it takes to split the lines of a print and strip their comments
+with the regular expressions gcoder used to, and with gcoder.tokenize and
+gcoder.strip_comments.
+
+    PYTHONPATH=. python benchmarks/bench_tokenize.py [lines]
+"""
+import sys
+import time
+
+from bqclient.host.drivers.printrun import gcoder
+
+
+def corpus(count):
+    lines = ["G28", "G90", "M82", "G92 E0", "M104 S210", "M109 S210 ; wait"]
+    for i in range(count):
+        if i % 1000 == 0:
+            lines.append("G1 Z%.2f F600 ; layer %d" % (0.2 + i / 5000.0, i // 1000))
+        lines.append("G1 X%.3f Y%.3f E%.5f" % (100 + (i % 50) * 0.37, 100 + (i % 70) * 0.29, i * 0.01))
+    return lines
+
+
+def measure(name, function, data):
+    started = time.perf_counter()
+    for raw in data:
+        function(raw)
+    print("%-16s %7.3f s" % (name, time.perf_counter() - started))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    data = corpus(count)
+    measure("findall", lambda raw: gcoder.gcode_exp.findall(raw.lower()), data)
+    measure("tokenize", gcoder.tokenize, data)
+    measure("sub", lambda raw: gcoder.gcode_strip_comment_exp.sub("", raw).strip(), data)
+    measure("strip_comments", gcoder.strip_comments, data)
+    measure("findall and sub", lambda raw: (gcoder.gcode_exp.findall(raw.lower()),
+                                           gcoder.gcode_strip_comment_exp.sub("", raw).strip()), data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Streams a print to the virtual printer and reports lines/sec and ok
+latency. The cost of recovering from resends shows up as the throughput lost
+at a nonzero resend rate.
+
+Every combination of window size and resend rate is printed, run with:
+
+    PYTHONPATH=. python benchmarks/bench_virtual_printer.py [lines]
+"""
+import logging
+import sys
+import time
+from collections import deque
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.printcore import printcore
+from bqclient.host.drivers.printrun.virtual_printer import VirtualPrinter
+
+WINDOW_SIZES = [1, 4, 8]
+RESEND_RATES = [0.0, 0.01]
+
+
+def corpus(count):
+    return ["G1 X%.3f Y%.3f E%.5f" % (100 + (i % 50), 100 + (i % 70), i * 0.01) for i in range(count)]
+
+
+def run(lines, window_size, resend_rate):
+    printer = VirtualPrinter(resend_rate=resend_rate, seed=42)
+    printer.start()
+    core = printcore()
+    sent = deque()
+    latencies = []
+
+    def on_send(command, gline):
+        sent.append(time.perf_counter())
+
+    def on_recv(line):
+        if line.startswith("ok") and sent:
+            latencies.append(time.perf_counter() - sent.popleft())
+
+    try:
+        core.connect(printer.port, 115200)
+        while not core.online:
+            time.sleep(0.01)
+        core.window_size = window_size
+        core.sendcb = on_send
+        core.recvcb = on_recv
+        started = time.perf_counter()
+        core.startprint(LightGCode(lines))
+        while core.printing:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - started
+    finally:
+        core.disconnect()
+        printer.stop()
+
+    latencies.sort()
+    median = latencies[len(latencies) // 2] * 1e6 if latencies else 0
+    print("window %2d  resend rate %.2f  %8.0f lines/s  median ok latency %7.1f us  %4d resends" %
+          (window_size, resend_rate, len(lines) / elapsed, median, printer.resends_requested))
+
+
+def main():
+    # Injected resends are logged as printer errors
+    logging.disable(logging.ERROR)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lines = corpus(count)
+    for resend_rate in RESEND_RATES:
+        for window_size in WINDOW_SIZES:
+            run(lines, window_size, resend_rate)
+
+
+if __name__ == "__main__":
+    main()
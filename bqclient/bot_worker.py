@@ -149,12 +149,17 @@ class BotWorker(object):
                 try:
                     self.driver.run(filename,
                                     update_job_progress=self._update_job_progress)
-                except Exception:
+                except Exception as e:
                     self.log.error("Unknown exception from driver run method", exc_info=True)
-                self.log.info("Driver's run method returned")
-
-                finish_job_command = self.resolver(FinishJob)
-                finish_job_command(self._current_job.id)
+                    # The job didn't finish, leave it for the bot's error to be cleared
+                    bot_error_command: BotError = self.resolver(BotError)
+                    bot_error_command(self.bot.id, e)
+                    self.bot.status = "error"
+                else:
+                    self.log.info("Driver's run method returned")
+
+                    finish_job_command = self.resolver(FinishJob)
+                    finish_job_command(self._current_job.id)
 
                 self._current_job = None
             else:
@@ -0,0 +1,247 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from bqclient.host.drivers.printrun import gcoder
+
+MAGIC = b"BQGA"
+VERSION = 1
+# Magic, version, length of the JSON header, number of arrays
+HEADER = struct.Struct("<4sIII")
+# Type code and length in bytes of every array
+ARRAY_HEADER = struct.Struct("<cQ")
+
+# Everything GCode._preprocess leaves behind besides the layers, so that
+# lines appended to a GCode loaded from the cache are parsed the same way
+GCODE_STATE = (
+    "imperial", "cutting", "relative", "relative_e", "current_tool",
+    "home_x", "home_y", "home_z",
+    "current_x", "current_y", "current_z", "current_e", "current_f",
+    "offset_x", "offset_y", "offset_z", "offset_e",
+    "total_e", "max_e",
+    "current_e_multi", "offset_e_multi", "total_e_multi", "max_e_multi",
+    "filament_length", "filament_length_multi",
+    "xmin", "xmax", "ymin", "ymax", "zmin", "zmax",
+    "width", "depth", "height", "est_layer_height",
+)
+
+
+def digest(data):
+    """Hashes a bytes-like object, a memory map of a file for one"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def file_digest(filename):
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class AnalysisCache(object):
+    """Analyses of G-code files saved to a directory, so a file that is
+    printed again doesn't have to be parsed again.
+
+    Every entry is a binary file holding a JSON header and a few arrays,
+    named after the hash of the file it was made from and the kind of
+    analysis. Once the entries take more than max_size bytes, the ones used
+    least recently are removed.
+    """
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".analysis")
+
+    def get(self, key):
+        """Returns the header and the arrays saved under key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                entry = self._read(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error):
+            logging.warning("Dropping unreadable G-code analysis %s" % path)
+            self._remove(path)
+            return None
+        try:
+            # Keep track of the last use for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, header, arrays):
+        """Saves the JSON-serializable header and a dict of arrays under
+        key. Failing to save them is logged and otherwise ignored, the cache
+        is only an optimization."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    self._write(fh, header, arrays)
+                os.replace(temporary, self._path(key))
+            except BaseException:
+                self._remove(temporary)
+                raise
+            self._evict()
+        except OSError as e:
+            logging.warning("Could not save G-code analysis: %s" % e)
+
+    def _read(self, fh):
+        (magic, version, header_length, count) = HEADER.unpack(fh.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a G-code analysis of this version")
+        header = json.loads(fh.read(header_length).decode("utf-8"))
+        if header.get("byteorder") != sys.byteorder:
+            raise ValueError("G-code analysis saved on another platform")
+        arrays = {}
+        for name in header["arrays"][:count]:
+            (typecode, length) = ARRAY_HEADER.unpack(fh.read(ARRAY_HEADER.size))
+            values = array(typecode.decode("ascii"))
+            data = fh.read(length)
+            if len(data) != length:
+                raise ValueError("Truncated G-code analysis")
+            values.frombytes(data)
+            arrays[name] = values
+        if len(arrays) != len(header["arrays"]):
+            raise ValueError("Truncated G-code analysis")
+        return header, arrays
+
+    def _write(self, fh, header, arrays):
+        names = list(arrays)
+        header = dict(header, arrays=names, byteorder=sys.byteorder)
+        encoded = json.dumps(header).encode("utf-8")
+        fh.write(HEADER.pack(MAGIC, VERSION, len(encoded), len(names)))
+        fh.write(encoded)
+        for name in names:
+            values = arrays[name]
+            fh.write(ARRAY_HEADER.pack(values.typecode.encode("ascii"), len(values) * values.itemsize))
+            values.tofile(fh)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(".analysis"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        # Never evict the entry that was just saved, however large
+        for (_, size, path) in entries[:-1]:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _float_or_nan(value):
+    return float("nan") if value is None else value
+
+
+def _float_or_none(value):
+    return None if math.isnan(value) else value
+
+
+def save_gcode(cache, key, gcode):
+    """Saves the analysis GCode.prepare made of a file"""
+    layer_zs = array('d', (_float_or_nan(layer.z) for layer in gcode.all_layers))
+    layer_durations = array('d', (layer.duration or 0.0 for layer in gcode.all_layers))
+    header = {name: getattr(gcode, name) for name in GCODE_STATE}
+    header["all_zs"] = list(gcode.all_zs)
+    header["duration"] = gcode.duration.total_seconds() if gcode.duration is not None else None
+    header["append_layer_id"] = gcode.append_layer_id
+    cache.put(key, header, {
+        "layer_idxs": gcode.layer_idxs,
+        "line_idxs": gcode.line_idxs,
+        "layer_zs": layer_zs,
+        "layer_durations": layer_durations,
+    })
+
+
+def restore_gcode(gcode, lines, entry):
+    """Sets up a deferred GCode of lines from a saved analysis, the way
+    GCode.prepare would have"""
+    (header, arrays) = entry
+    for name in GCODE_STATE:
+        setattr(gcode, name, header[name])
+    gcode.all_zs = set(header["all_zs"])
+    gcode.duration = datetime.timedelta(seconds=header["duration"]) if header["duration"] is not None else None
+    gcode.layer_idxs = arrays["layer_idxs"]
+    gcode.line_idxs = arrays["line_idxs"]
+    gcode.lines = lines
+
+    layer_count = len(arrays["layer_zs"])
+    counts = [0] * layer_count
+    for layer in gcode.layer_idxs:
+        counts[layer] += 1
+    all_layers = gcode.all_layers = []
+    start = 0
+    for (layer, count) in enumerate(counts):
+        new_layer = gcoder.Layer(lines[start:start + count], _float_or_none(arrays["layer_zs"][layer]))
+        new_layer.duration = arrays["layer_durations"][layer]
+        all_layers.append(new_layer)
+        start += count
+    gcode.append_layer_id = header["append_layer_id"]
+    gcode.append_layer = all_layers[gcode.append_layer_id]
+    gcode._finish_layers()
+
+
+def load_gcode(filename, cache=None, gcode_class=gcoder.LightGCode, workers=1):
+    """Loads a file into a GCode, using the analysis saved in cache when the
+    same file has been loaded before. Files that have to be parsed are
+    parsed by up to workers processes, see gcoder.parse_file."""
+    if cache is None:
+        return gcoder.parse_file(filename, gcode_class, workers)
+
+    key = "%s.%s" % (file_digest(filename), gcode_class.__name__)
+    entry = cache.get(key)
+    if entry is not None:
+        with open(filename, 'rb') as fh:
+            data = [i.strip().decode("utf-8") for i in fh.readlines()]
+        gcode = gcode_class(deferred=True)
+        lines = gcode._make_lines(data)
+        if len(lines) == len(entry[1]["layer_idxs"]):
+            restore_gcode(gcode, lines, entry)
+            return gcode
+
+    gcode = gcoder.parse_file(filename, gcode_class, workers)
+    if gcode.lines:
+        save_gcode(cache, key, gcode)
+    return gcode
@@ -0,0 +1,363 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.optimizer import HARMLESS, OptimizerStats, move_words, sent_size, trim
+
+# Fewest moves worth turning into an arc
+MIN_SEGMENTS = 3
+# Most moves fitted at once, which bounds the work done on long runs
+MAX_SEGMENTS = 100
+# Beyond this radius (mm) arcs are nearly straight lines, and firmwares work
+# them out poorly
+MAX_RADIUS = 1000.0
+# How much the filament per mm of the moves of an arc may differ from its
+# mean, relative to it
+EXTRUSION_TOLERANCE = 0.05
+
+
+def number(value, digits):
+    return trim("%.*f" % (digits, value))
+
+
+class Segment(object):
+    """A G1 move that could be part of an arc"""
+
+    __slots__ = ('text', 'x', 'y', 'x_text', 'y_text', 'e', 'e_text', 'f_text', 'length')
+
+    def __init__(self, text, x, y, x_text, y_text, e, e_text, f_text, length):
+        self.text = text
+        self.x = x
+        self.y = y
+        self.x_text = x_text
+        self.y_text = y_text
+        # Filament pushed by the move, None for travel
+        self.e = e
+        self.e_text = e_text
+        self.f_text = f_text
+        self.length = length
+
+
+class ArcFitter(object):
+    """Replaces runs of short G1 moves whose points lie on a circle by G2
+    and G3 arcs, like ArcWelder does.
+
+    A run becomes an arc when every point of it is within tolerance (mm) of
+    the arc and so is the middle of every move, which is a chord of it. The
+    arc ends exactly where the run did and pushes the same filament, spread
+    over it like the moves did. Only absolute XY moves in the plane, at one
+    feedrate, are fitted. Anything else is kept as it is and makes the
+    fitter forget what it can't be sure about, like the Optimizer.
+    """
+
+    def __init__(self, tolerance=0.05):
+        self.tolerance = tolerance
+        self.stats = OptimizerStats()
+        # Moves fitted, and arcs they were turned into
+        self.segments = 0
+        self.arcs = 0
+        self.relative = None
+        self.relative_e = None
+        self.x = self.y = self.e = None
+        self.x_text = self.y_text = None
+        self.feedrate = None
+        self.run = []
+        # The arc the moves of run make, if they make one
+        self.arc = None
+        # Where run starts
+        self.start = None
+        # Lines that are only comments, read since run started
+        self.comments = []
+        # Filament and length of the moves of run, and the least and most
+        # filament per mm of them
+        self._recount()
+
+    def _forget(self):
+        self.x = self.y = self.e = None
+        self.feedrate = None
+
+    def _segment(self, text, words):
+        """The Segment of a move, or None if it can't be part of an arc"""
+        if words[0] != "G1" or self.relative is not False or self.x is None or self.y is None:
+            return None
+        values = dict((word[0], word[1:]) for word in words[1:])
+        if "Z" in values or ("X" not in values and "Y" not in values):
+            return None
+        x_text = trim(values["X"]) if "X" in values else self.x_text
+        y_text = trim(values["Y"]) if "Y" in values else self.y_text
+        (x, y) = (float(x_text), float(y_text))
+        e = e_text = None
+        if "E" in values:
+            e_text = values["E"]
+            if self.relative_e:
+                e = float(e_text)
+            elif self.relative_e is None or self.e is None:
+                return None
+            else:
+                e = float(e_text) - self.e
+            if e <= 0:
+                return None
+        length = math.hypot(x - self.x, y - self.y)
+        if length == 0:
+            return None
+        return Segment(text, x, y, x_text, y_text, e, e_text, values.get("F"), length)
+
+    def _track(self, words):
+        """Follows a G0 or G1 move that isn't fitted"""
+        for word in words[1:]:
+            (code, value) = (word[0], trim(word[1:]))
+            if code == "X":
+                (self.x, self.x_text) = (float(value), value) if self.relative is False else (None, None)
+            elif code == "Y":
+                (self.y, self.y_text) = (float(value), value) if self.relative is False else (None, None)
+            elif code == "E":
+                self.e = float(value) if self.relative_e is False else None
+            elif code == "F":
+                self.feedrate = float(value) if words[0] == "G1" else None
+
+    def _command(self, text):
+        (command, pairs, _) = gcoder.tokenize(text)
+        if command in ("G90", "G91"):
+            self.relative = self.relative_e = command == "G91"
+        elif command in ("M82", "M83"):
+            self.relative_e = command == "M83"
+        if command == "G92" and len(pairs) > 1 and all(code in "xye" and value for (code, value) in pairs[1:]):
+            # The position is set to what it says
+            for (code, value) in pairs[1:]:
+                if code == "x":
+                    (self.x, self.x_text) = (float(value), trim(value))
+                elif code == "y":
+                    (self.y, self.y_text) = (float(value), trim(value))
+                else:
+                    self.e = float(value)
+        elif command not in HARMLESS:
+            self._forget()
+
+    def _sweep(self, arc, start, segments):
+        """How far round arc goes once it goes from start through the
+        points of segments, or None if they aren't on it"""
+        (i, j, clockwise, sweep) = arc
+        (cx, cy) = (self.start[0] + i, self.start[1] + j)
+        radius = math.hypot(i, j)
+        tolerance = self.tolerance
+        (px, py) = (start[0] - cx, start[1] - cy)
+        for segment in segments:
+            (qx, qy) = (segment.x - cx, segment.y - cy)
+            if abs(math.hypot(qx, qy) - radius) > tolerance:
+                return None
+            cross = px * qy - py * qx
+            if (cross < 0) != clockwise or cross == 0:
+                return None
+            sweep += math.atan2(abs(cross), px * qx + py * qy)
+            # How far the arc bulges from the move
+            half = segment.length / 2
+            if half > radius or radius - math.sqrt(radius * radius - half * half) > tolerance:
+                return None
+            (px, py) = (qx, qy)
+        if sweep >= 2 * math.pi:
+            return None
+        return sweep
+
+    def _even(self):
+        """Whether the moves of run push about as much filament per mm"""
+        if self.run[0].e is None:
+            return True
+        rate = self.e_total / self.length_total
+        return self.rate_max - rate <= EXTRUSION_TOLERANCE * rate and \
+            rate - self.rate_min <= EXTRUSION_TOLERANCE * rate
+
+    def _fit(self):
+        """The (I, J, clockwise, sweep) of the arc through the points of
+        run, or None if they aren't on one"""
+        run = self.run
+        if not self._even():
+            return None
+        (x0, y0) = self.start
+        middle = run[len(run) // 2 - 1]
+        end = run[-1]
+        (ax, ay) = (middle.x - x0, middle.y - y0)
+        (bx, by) = (end.x - x0, end.y - y0)
+        det = 2 * (ax * by - ay * bx)
+        if abs(det) < 1e-9:
+            return None
+        a2 = ax * ax + ay * ay
+        b2 = bx * bx + by * by
+        # The center, where the firmware will see it
+        i = round((by * a2 - ay * b2) / det, 3)
+        j = round((ax * b2 - bx * a2) / det, 3)
+        if math.hypot(i, j) > MAX_RADIUS:
+            return None
+        arc = (i, j, det < 0, 0.0)
+        sweep = self._sweep(arc, self.start, run)
+        if sweep is None:
+            return None
+        return i, j, det < 0, sweep
+
+    def _extend(self):
+        """The arc of run if the arc of all its moves but the last goes on
+        to it, or None"""
+        if not self._even():
+            return None
+        previous = self.run[-2]
+        sweep = self._sweep(self.arc, (previous.x, previous.y), self.run[-1:])
+        if sweep is None:
+            return None
+        return self.arc[:3] + (sweep,)
+
+    def _count(self, segments):
+        """Adds segments to the totals of run"""
+        for segment in segments:
+            if segment.e is None:
+                continue
+            rate = segment.e / segment.length
+            self.e_total += segment.e
+            self.length_total += segment.length
+            self.rate_min = min(self.rate_min, rate)
+            self.rate_max = max(self.rate_max, rate)
+
+    def _arc_line(self):
+        run = self.run
+        (i, j, clockwise, _) = self.arc
+        end = run[-1]
+        words = ["G2" if clockwise else "G3", "X" + end.x_text, "Y" + end.y_text,
+                 "I" + number(i, 3), "J" + number(j, 3)]
+        if end.e is not None:
+            if self.relative_e:
+                words.append("E" + number(self.e_total, 5))
+            else:
+                words.append("E" + trim(end.e_text))
+        if run[0].f_text is not None:
+            words.append("F" + trim(run[0].f_text))
+        self.segments += len(run)
+        self.arcs += 1
+        return " ".join(words)
+
+    def _take(self, count):
+        """Drops the first count moves of run, which have been written"""
+        self.start = (self.run[count - 1].x, self.run[count - 1].y)
+        del self.run[:count]
+        self.arc = None
+        self._recount()
+
+    def _recount(self):
+        self.e_total = self.length_total = 0.0
+        self.rate_min = math.inf
+        self.rate_max = 0.0
+        self._count(self.run)
+
+    def _flush(self):
+        """The lines of the moves of run, which can't be made longer, and
+        the comments read along them"""
+        if not self.run:
+            return []
+        if self.arc is not None:
+            lines = [self._arc_line()]
+        else:
+            lines = [segment.text for segment in self.run]
+        self._take(len(self.run))
+        lines.extend(self.comments)
+        del self.comments[:]
+        return lines
+
+    def _add(self, segment):
+        """Adds a move to run, returns the lines that are done with"""
+        lines = []
+        if self.run:
+            first = self.run[0]
+            if (segment.e is None) != (first.e is None) or \
+               (segment.f_text is not None and float(segment.f_text) != self.feedrate):
+                lines.extend(self._flush())
+        if not self.run:
+            self.start = (self.x, self.y)
+        self.run.append(segment)
+        self._count([segment])
+        while len(self.run) >= MIN_SEGMENTS:
+            arc = None
+            if self.arc is not None:
+                arc = self._extend()
+            if arc is None:
+                arc = self._fit()
+            if arc is not None:
+                self.arc = arc
+                if len(self.run) >= MAX_SEGMENTS:
+                    lines.extend(self._flush())
+                break
+            if self.arc is not None:
+                # The moves before this one make an arc
+                self.run.pop()
+                self._recount()
+                lines.append(self._arc_line())
+                self._take(len(self.run))
+                self.run.append(segment)
+                self._count([segment])
+            else:
+                lines.append(self.run[0].text)
+                self._take(1)
+        return lines
+
+    def _move(self, segment):
+        self.x = segment.x
+        self.y = segment.y
+        self.x_text = segment.x_text
+        self.y_text = segment.y_text
+        if segment.e is not None and not self.relative_e:
+            self.e = float(segment.e_text)
+        if segment.f_text is not None:
+            self.feedrate = float(segment.f_text)
+
+    def _line(self, line):
+        """The lines to write once line is read"""
+        if line.startswith(";@"):
+            self._forget()
+            return self._flush() + [line]
+        stripped = gcoder.strip_comments(line)
+        if not stripped:
+            if self.run:
+                self.comments.append(line)
+                return []
+            return [line]
+        if not line.startswith(stripped):
+            self._forget()
+            return self._flush() + [line]
+        words = move_words(stripped)
+        if words is not None:
+            segment = self._segment(stripped, words)
+            if segment is not None:
+                lines = self._add(segment)
+                self._move(segment)
+                return lines
+            lines = self._flush()
+            self._track(words)
+            return lines + [stripped]
+        lines = self._flush()
+        self._command(stripped)
+        return lines + [stripped]
+
+    def lines(self, lines):
+        """Fits arcs to lines"""
+        for line in lines:
+            line = line.strip()
+            self.stats.lines_read += 1
+            self.stats.bytes_read += sent_size(line)
+            for fitted in self._line(line):
+                self.stats.lines_written += 1
+                self.stats.bytes_written += sent_size(fitted)
+                yield fitted
+        for fitted in self._flush():
+            self.stats.lines_written += 1
+            self.stats.bytes_written += sent_size(fitted)
+            yield fitted
@@ -0,0 +1,54 @@
+#cython: language_level=3
+#
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from libc.stdio cimport snprintf
+from libc.string cimport memcpy
+
+cdef inline unsigned char xor_bytes(const char * data, Py_ssize_t length):
+    cdef unsigned char cs = 0
+    cdef Py_ssize_t i
+    for i in range(length):
+        cs ^= <unsigned char> data[i]
+    return cs
+
+def checksum(bytes command):
+    """XOR of all the bytes of command, as used by RepRap firmwares"""
+    return xor_bytes(command, len(command))
+
+def frame(bytes command, long long lineno):
+    """Builds the b"N<lineno> <command>*<checksum>\\n" line for command in a
+    single pass"""
+    cdef char prefix[24]
+    cdef int prefix_length = snprintf(prefix, sizeof(prefix), b"N%lld ", lineno)
+    cdef Py_ssize_t command_length = len(command)
+    cdef unsigned char cs = xor_bytes(prefix, prefix_length) ^ xor_bytes(command, command_length)
+    cdef int digits = 1 if cs < 10 else (2 if cs < 100 else 3)
+    cdef Py_ssize_t length = prefix_length + command_length + digits + 2
+
+    result = PyBytes_FromStringAndSize(NULL, length)
+    cdef char * out = PyBytes_AS_STRING(result)
+    memcpy(out, prefix, prefix_length)
+    memcpy(out + prefix_length, <const char *> command, command_length)
+    out += prefix_length + command_length
+    out[0] = c'*'
+    out[digits + 1] = c'\n'
+    while digits > 0:
+        out[digits] = c'0' + cs % 10
+        cs //= 10
+        digits -= 1
+    return result
@@ -16,6 +16,7 @@
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import os
 import re
 import math
 import datetime
@@ -61,10 +62,164 @@ try:
     Line = gcoder_line.GLine
     LightLine = gcoder_line.GLightLine
 except Exception as e:
-    logging.warning("Memory-efficient GCoder implementation unavailable: %s" % e)
+    logging.warning("Memory-efficient GCoder implementation unavailable, "
+                    "using pure Python lines: %s" % e)
+    gcoder_line = None
     Line = PyLine
     LightLine = PyLightLine
 
+try:
+    from bqclient.host.drivers.printrun import gcoder_columnar
+except ImportError as e:
+    logging.info("Columnar GCoder analysis unavailable: %s" % e)
+    gcoder_columnar = None
+
+try:
+    from bqclient.host.drivers.printrun import gcoder_preprocess
+except ImportError as e:
+    logging.info("Compiled GCoder preprocessing unavailable: %s" % e)
+    gcoder_preprocess = None
+
+def single_precision():
+    """Whether lines are the compiled GLine, which keeps coordinates as
+    single precision floats"""
+    return gcoder_line is not None and Line is gcoder_line.GLine
+
+def line_size(line):
+    """Rough number of bytes a line keeps, counting the strings and
+    numbers it holds"""
+    size = sys.getsizeof(line)
+    if gcoder_line is not None \
+       and isinstance(line, (gcoder_line.GLine, gcoder_line.GLightLine)):
+        # The compiled lines keep their strings in their own buffers
+        for value in (line.raw, line.command):
+            if value is not None:
+                size += len(value.encode("utf-8")) + 1
+        return size
+    for name in type(line).__slots__:
+        value = getattr(line, name, None)
+        if isinstance(value, (str, float)):
+            size += sys.getsizeof(value)
+    return size
+
+def implementation():
+    """Says whether the G-code lines in use are the compiled ones or the
+    pure Python ones, and how many bytes a parsed move takes with them"""
+    sample = "G1 X103.125 Y97.25 E1.5625"
+    gcode = GCode(deferred = True)
+    gcode.prepare(["G1 Z0.2 F1800", sample])
+    light = LightLine(sample)
+    light.command = "G1"
+    kind = "compiled" if gcoder_line is not None else "pure Python"
+    return ("Using %s G-code lines, about %d bytes per move, %d for light lines"
+            % (kind, line_size(gcode.lines[-1]), line_size(light)))
+
+# Codes of the words a move line has when the fast path of tokenize can
+# split it on whitespace, by their upper case letter
+fast_codes = dict((code.upper(), code) for code in to_parse)
+
+def _number_end(text, i, n):
+    r"""Where the number starting at i ends, like [-+]?[0-9]*\.?[0-9]*"""
+    if i < n and (text[i] == "-" or text[i] == "+"):
+        i += 1
+    while i < n and "0" <= text[i] <= "9":
+        i += 1
+    if i < n and text[i] == ".":
+        i += 1
+    while i < n and "0" <= text[i] <= "9":
+        i += 1
+    return i
+
+def _comment_end(text, i, n):
+    """Where the comment starting at i ends, or -1 if there isn't one, like
+    the comment alternatives of gcode_strip_comment_exp"""
+    char = text[i]
+    if char == ";":
+        newline = text.find("\n", i + 1)
+        return newline if newline != -1 else n
+    if char == "(":
+        close = text.find(")", i + 1)
+        if close == -1:
+            return -1
+        opening = text.find("(", i + 1, close)
+        return close + 1 if opening == -1 else -1
+    # / or *, up to the end of the line
+    newline = text.find("\n", i + 1)
+    return newline + 1 if newline != -1 else -1
+
+def _scan(text, codes):
+    """Finds the words with one of codes in text and the comments, in one
+    pass. Returns the (code, value) pairs gcode_exp.findall would, and the
+    (start, end) spans of text outside comments."""
+    words = []
+    spans = []
+    start = i = 0
+    n = len(text)
+    while i < n:
+        char = text[i]
+        if char in codes:
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            i = _number_end(text, j, n)
+            words.append((char, text[j:i]))
+            continue
+        if char in "(;/*":
+            end = _comment_end(text, i, n)
+            if end != -1:
+                words.append(("", ""))
+                spans.append((start, i))
+                start = i = end
+                continue
+        i += 1
+    spans.append((start, n))
+    return words, spans
+
+def strip_comments(raw):
+    """raw without its comments, like gcode_strip_comment_exp.sub("", raw)
+    and strip"""
+    if ";" not in raw and "(" not in raw and "/" not in raw and "*" not in raw:
+        return raw.strip()
+    (_, spans) = _scan(raw, "")
+    return "".join(raw[start:end] for (start, end) in spans).strip()
+
+def tokenize(raw):
+    """Splits a line in one pass, without regular expressions.
+
+    Returns a tuple of the command of the line, the (code, value) pairs
+    gcode_exp.findall finds in it, starting with the command's own and
+    without a line number before it, and the line without its comments.
+    The command is "" when the line starts with a comment, and None when
+    there is nothing to parse in it.
+
+    Moves made of a command and words that are a code and a number each,
+    which are most of the lines of sliced files, are split on whitespace.
+    """
+    words = raw.split()
+    if words and words[0] in move_gcodes and raw.isascii():
+        pairs = [("g", words[0][1:])]
+        for word in words[1:]:
+            code = fast_codes.get(word[0])
+            value = word[1:]
+            # All of it has to be a number, as gcode_exp reads them
+            digits = value[1:] if value[:1] in "-+" else value
+            if code is None or not digits.replace(".", "", 1).isdigit():
+                break
+            pairs.append((code, value))
+        else:
+            return words[0], pairs, raw.strip()
+    lowered = raw.lower()
+    (pairs, spans) = _scan(lowered, to_parse)
+    if len(lowered) != len(raw):
+        # Lower casing changed where the comments are
+        (_, spans) = _scan(raw, "")
+    if pairs and pairs[0][0] == "n":
+        del pairs[0]
+    stripped = "".join(raw[start:end] for (start, end) in spans).strip()
+    if not pairs:
+        return None, pairs, stripped
+    return pairs[0][0].upper() + pairs[0][1], pairs, stripped
+
 def find_specific_code(line, code):
     exp = specific_exp % code
     bits = [bit for bit in re.findall(exp, line.raw) if bit]
@@ -112,6 +267,13 @@ class Layer(list):
 class GCode:
 
     line_class = Line
+    # Analyse files with gcoder_columnar when NumPy is available. Only light
+    # lines are analysed that way, since it doesn't set the attributes of
+    # every line.
+    columnar = True
+    # Preprocess lines with gcoder_preprocess when it is built, it is
+    # faster than both the loop below and the columnar engine
+    compiled = True
 
     lines = None
     layers = None
@@ -136,11 +298,8 @@ class GCode:
     current_z = 0
     # For E this is the absolute position from machine start
     current_e = 0
-    current_e_multi=[0]
     total_e = 0
-    total_e_multi=[0]
     max_e = 0
-    max_e_multi=[0]
     # Current feedrate
     current_f = 0
     # Offset: current offset between the machine origin and the machine current
@@ -149,7 +308,6 @@ class GCode:
     offset_y = 0
     offset_z = 0
     offset_e = 0
-    offset_e_multi = [0]
 
     # Expected behavior:
     # - G28 X => X axis is homed, offset_x <- 0, current_x <- home_x
@@ -161,7 +319,6 @@ class GCode:
     # current abs X in machine current coordinate system: current_x - offset_x
 
     filament_length = None
-    filament_length_multi=[0]
     duration = None
     xmin = None
     xmax = None
@@ -222,20 +379,29 @@ class GCode:
                  layer_callback = None, deferred = False,
                  cutting_as_extrusion = False):
         self.cutting_as_extrusion = cutting_as_extrusion
+        # The E positions of every tool, which tool changes add to
+        self.current_e_multi = [0]
+        self.offset_e_multi = [0]
+        self.total_e_multi = [0]
+        self.max_e_multi = [0]
+        self.filament_length_multi = [0]
         if not deferred:
             self.prepare(data, home_pos, layer_callback)
 
     def prepare(self, data = None, home_pos = None, layer_callback = None):
         self.home_pos = home_pos
         if data:
-            line_class = self.line_class
-            self.lines = [line_class(l2) for l2 in
-                          (l.strip() for l in data)
-                          if l2]
-            self._preprocess(build_layers = True,
-                             layer_callback = layer_callback)
+            self.lines = self._make_lines(data)
+            if self.columnar and gcoder_columnar is not None \
+                    and not self._compiled() \
+                    and self.line_class != Line and layer_callback is None:
+                gcoder_columnar.preprocess(self)
+            else:
+                self._preprocess(build_layers = True,
+                                 layer_callback = layer_callback)
+            self._finish_layers()
         else:
-            self.lines = []
+            self.lines = self._make_lines([])
             self.append_layer_id = 0
             self.append_layer = Layer([])
             self.all_layers = [self.append_layer]
@@ -244,6 +410,15 @@ class GCode:
             self.layer_idxs = array('I', [])
             self.line_idxs = array('I', [])
 
+    def _make_lines(self, data):
+        """Line objects of the lines of data that aren't empty"""
+        line_class = self.line_class
+        return [line_class(l2) for l2 in (l.strip() for l in data) if l2]
+
+    def _finish_layers(self):
+        """Called once the layers of the lines are built"""
+        pass
+
     def has_index(self, i):
         return i < len(self)
     def __len__(self):
@@ -323,9 +498,15 @@ class GCode:
             self.line_idxs.append(len(self.append_layer)-1)
         return gline
 
+    def _compiled(self):
+        return self.compiled and gcoder_preprocess is not None
+
     def _preprocess(self, lines = None, build_layers = False,
                     layer_callback = None):
         """Checks for imperial/relativeness settings and tool changes"""
+        if self._compiled():
+            return gcoder_preprocess.preprocess(self, lines, build_layers,
+                                                layer_callback)
         if not lines:
             lines = self.lines
         imperial = self.imperial
@@ -747,6 +928,25 @@ class GCode:
 class LightGCode(GCode):
     line_class = LightLine
 
+def parse_file(filename, gcode_class = None, workers = 1,
+               min_parallel_size = 32 * 1024 * 1024):
+    """Loads a file into a gcode_class, LightGCode by default. Files of at
+    least min_parallel_size bytes are tokenized by up to workers processes
+    when the columnar engine can analyse gcode_class and gcoder_preprocess,
+    which is faster in a single process, isn't built. More processes than
+    cores would only slow it down."""
+    if gcode_class is None:
+        gcode_class = LightGCode
+    workers = min(workers, os.cpu_count() or 1)
+    if workers > 1 and gcoder_columnar is not None and gcode_class.columnar \
+            and not (gcode_class.compiled and gcoder_preprocess is not None) \
+            and gcode_class.line_class != Line \
+            and os.path.getsize(filename) >= min_parallel_size:
+        return gcoder_columnar.parse_file(filename, gcode_class, workers)
+    with open(filename, 'rb') as fh:
+        data = [i.strip().decode("utf-8") for i in fh.readlines()]
+    return gcode_class(data)
+
 def main():
     if len(sys.argv) < 2:
         print("usage: %s filename.gcode" % sys.argv[0])
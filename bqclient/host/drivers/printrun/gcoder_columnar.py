@@ -0,0 +1,699 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar version of GCode._preprocess(build_layers = True), using NumPy.
+
+The lines are tokenized into one array per field, and the positions,
+extrusion, bounding box, durations and layers are computed from the arrays a
+run of lines at a time instead of line by line. The results are the same as
+the ones of GCode._preprocess, down to the last bit of every float: sums are
+accumulated in the same order, and math.hypot is used for distances since
+numpy.hypot rounds differently.
+
+Only the results that outlive the loop are computed, the attributes
+_preprocess sets on every line aren't, so this is only used for GCode
+classes that keep light lines."""
+
+import datetime
+import logging
+import math
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from operator import itemgetter
+
+import numpy
+
+from bqclient.host.drivers.printrun import gcoder
+
+# What a line does, as far as the analysis is concerned
+NONE = 0
+OTHER = 1
+MOVE = 2
+ARC = 3
+HOME = 4
+SET_POSITION = 5
+DWELL = 6
+INCHES = 7
+MILLIMETERS = 8
+ABSOLUTE = 9
+RELATIVE = 10
+ABSOLUTE_E = 11
+RELATIVE_E = 12
+TOOL = 13
+CUTTING = 14
+NOT_CUTTING = 15
+
+KINDS = {
+    "G0": MOVE,
+    "G1": MOVE,
+    "G2": ARC,
+    "G3": ARC,
+    "G28": HOME,
+    "G92": SET_POSITION,
+    "G4": DWELL,
+    "G20": INCHES,
+    "G21": MILLIMETERS,
+    "G90": ABSOLUTE,
+    "G91": RELATIVE,
+    "M82": ABSOLUTE_E,
+    "M83": RELATIVE_E,
+    "M3": CUTTING,
+    "M4": CUTTING,
+    "M5": NOT_CUTTING,
+}
+
+# Lines that change the state the moves after them are interpreted in
+STATE_KINDS = (HOME, SET_POSITION, ABSOLUTE, RELATIVE, ABSOLUTE_E, RELATIVE_E,
+               TOOL, CUTTING, NOT_CUTTING)
+
+ACCELERATION = 2000.0  # mm/s^2
+
+NAN = float("nan")
+
+# gcoder.gcode_exp for a whole file at once. Comments can't reach the next
+# line, and newlines are codes of their own to tell the lines apart. The
+# number a newline picks up would have been skipped anyway, since it isn't
+# preceded by a code.
+token_exp = re.compile(r"\([^\(\)\n]*\)|;[^\n]*|([\n%s])[^\S\n]*([-+]?[0-9]*\.?[0-9]*)" % gcoder.to_parse)
+
+
+class Columns(object):
+    """The fields of every line, with NaN for the ones a line doesn't have"""
+
+    def __init__(self, count):
+        self.count = count
+        self.kind = numpy.zeros(count, numpy.int8)
+        self.x = numpy.full(count, NAN)
+        self.y = numpy.full(count, NAN)
+        self.z = numpy.full(count, NAN)
+        self.e = numpy.full(count, NAN)
+        self.f = numpy.full(count, NAN)
+        # Commands of the lines that change tools
+        self.tools = {}
+        # Lines gcoder.split couldn't make sense of
+        self.unparsed = []
+        self.raws = None
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Columns of the lines of every one of parts, one after another"""
+        columns = cls(0)
+        columns.count = sum(part.count for part in parts)
+        for name in ("kind", "x", "y", "z", "e", "f"):
+            setattr(columns, name, numpy.concatenate([getattr(part, name) for part in parts]))
+        start = 0
+        for part in parts:
+            columns.tools.update((start + line, command) for (line, command) in part.tools.items())
+            columns.unparsed.extend(start + line for line in part.unparsed)
+            start += part.count
+        return columns
+
+
+def tokenize(raws):
+    """Splits lines like gcoder.split and gcoder.parse_coordinates do, but
+    all at once. Coordinates are left in the units of the file, see
+    apply_units."""
+    count = len(raws)
+    columns = Columns(count)
+    tokens = token_exp.findall("\n".join(raws).lower())
+    codes = list(map(itemgetter(0), tokens))
+    values = list(map(itemgetter(1), tokens))
+    code_array = numpy.array(codes) if codes else numpy.zeros(0, "U1")
+    newlines = code_array == "\n"
+    line_of = numpy.cumsum(newlines)
+
+    # The first token of every line with tokens, skipping line numbers
+    tokens = numpy.flatnonzero(~newlines)
+    token_lines = line_of[tokens]
+    starts = numpy.flatnonzero(numpy.diff(token_lines, prepend=-1))
+    ends = numpy.append(starts[1:], len(tokens))
+    first = starts + (code_array[tokens[starts]] == "n")
+    parsed = first < ends
+    lines = token_lines[starts[parsed]]
+    first = tokens[first[parsed]].tolist()
+
+    line_codes = [codes[i] for i in first]
+    commands = [codes[i].upper() + values[i] for i in first]
+    get_kind = KINDS.get
+    kinds = numpy.full(count, OTHER, numpy.int8)
+    kinds[lines] = [get_kind(command, OTHER) if command else NONE for command in commands]
+    for (line, code, command) in zip(lines.tolist(), line_codes, commands):
+        if code == "t":
+            kinds[line] = TOOL
+            columns.tools[line] = command
+    columns.kind = kinds
+    has_tokens = numpy.zeros(count, bool)
+    has_tokens[lines] = True
+    columns.unparsed = numpy.flatnonzero(~has_tokens).tolist()
+
+    # Only the arguments of G commands are parsed
+    g_lines = numpy.zeros(count, bool)
+    g_lines[lines] = [code == "g" for code in line_codes]
+    arguments = g_lines[line_of] & numpy.fromiter(map(bool, values), bool, len(values))
+    for name in ("x", "y", "z", "e", "f"):
+        selected = numpy.flatnonzero(arguments & (code_array == name))
+        if not len(selected):
+            continue
+        # Later values of a field on the same line win, like they do with
+        # setattr in parse_coordinates
+        getattr(columns, name)[line_of[selected]] = list(map(float, [values[i] for i in selected.tolist()]))
+    return columns
+
+
+def read_lines(data):
+    """The lines of the bytes of a file, stripped and without the empty
+    ones, the way GCode gets them from the driver"""
+    return [line for line in (raw.strip().decode("utf-8").strip() for raw in data.split(b"\n")) if line]
+
+
+def split_file(filename, count):
+    """Splits a file into up to count byte ranges that start and end on line
+    boundaries"""
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as fh:
+        for i in range(1, count):
+            fh.seek(max(size * i // count, bounds[-1]))
+            # Move on to the start of the next line
+            fh.readline()
+            bounds.append(min(fh.tell(), size))
+    bounds.append(size)
+    return [(start, end) for (start, end) in zip(bounds, bounds[1:]) if end > start]
+
+
+def tokenize_range(filename, start, end):
+    """Tokenizes the lines of a byte range of a file, in a worker process"""
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    return tokenize(read_lines(data))
+
+
+def parse_file(filename, gcode_class, workers):
+    """Loads a file into a gcode_class like gcode_class(lines) would, with
+    the file split into byte ranges tokenized by workers processes. The
+    state of the lines, like units and positions, depends on the lines
+    before them, so it's only worked out once all the ranges are back."""
+    ranges = split_file(filename, workers)
+    # Workers are spawned rather than forked, the client runs threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(ranges) or 1, mp_context=context) as executor:
+        futures = [executor.submit(tokenize_range, filename, start, end) for (start, end) in ranges]
+        # Make the line objects while the workers tokenize
+        gcode = gcode_class(deferred=True)
+        with open(filename, 'rb') as fh:
+            gcode.lines = gcode._make_lines(read_lines(fh.read()))
+        columns = Columns.concatenate([future.result() for future in futures])
+    if not gcode.lines:
+        gcode.prepare()
+        return gcode
+    if columns.count != len(gcode.lines):
+        raise ValueError("Tokenized %d lines of %s instead of %d" % (columns.count, filename, len(gcode.lines)))
+    preprocess(gcode, columns)
+    gcode._finish_layers()
+    return gcode
+
+
+def apply_units(columns, imperial):
+    """Converts the coordinates of lines after a G20 to millimeters, like
+    parse_coordinates does. Returns whether the file ends in inches."""
+    kinds = columns.kind
+    unit_lines = numpy.flatnonzero((kinds == INCHES) | (kinds == MILLIMETERS))
+    if len(unit_lines):
+        units = numpy.full(columns.count, NAN)
+        units[unit_lines] = kinds[unit_lines] == INCHES
+        inches = forward_fill(units, float(imperial)) == 1
+    elif imperial:
+        inches = numpy.ones(columns.count, bool)
+    else:
+        return imperial
+    for name in ("x", "y", "z", "e", "f"):
+        values = getattr(columns, name)
+        values[inches] = 25.4 * values[inches]
+    return bool(inches[-1]) if columns.count else imperial
+
+
+def single_precision():
+    """Whether the heavy lines _preprocess reads coordinates back from are
+    the compiled GLine, which keeps them as single precision floats"""
+    return gcoder.single_precision()
+
+
+def to_single(values):
+    """Rounds values to single precision floats and back"""
+    return values.astype(numpy.float32).astype(float)
+
+
+def accumulate(start, values):
+    """Running sum of values starting from start, added in order"""
+    return numpy.cumsum(numpy.concatenate(([start], values)))[1:]
+
+
+def forward_fill(values, start):
+    """Replaces every NaN with the last number before it, or start"""
+    present = ~numpy.isnan(values)
+    positions = numpy.where(present, numpy.arange(len(values)), -1)
+    numpy.maximum.accumulate(positions, out=positions)
+    filled = numpy.where(positions >= 0, values[numpy.maximum(positions, 0)], start)
+    return filled
+
+
+class State(object):
+    """What GCode._preprocess keeps in local variables between lines"""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.relative = gcode.relative
+        self.relative_e = gcode.relative_e
+        self.current_tool = gcode.current_tool
+        self.cutting = gcode.cutting
+        self.current_x = gcode.current_x
+        self.current_y = gcode.current_y
+        self.current_z = gcode.current_z
+        self.offset_x = gcode.offset_x
+        self.offset_y = gcode.offset_y
+        self.offset_z = gcode.offset_z
+        self.current_e = gcode.current_e
+        self.offset_e = gcode.offset_e
+        self.total_e = gcode.total_e
+        self.max_e = gcode.max_e
+
+    def change(self, kind, index, columns):
+        """Applies a line that changes the state"""
+        gcode = self.gcode
+        if kind == ABSOLUTE:
+            self.relative = False
+            self.relative_e = False
+        elif kind == RELATIVE:
+            self.relative = True
+            self.relative_e = True
+        elif kind == ABSOLUTE_E:
+            self.relative_e = False
+        elif kind == RELATIVE_E:
+            self.relative_e = True
+        elif kind == TOOL:
+            try:
+                self.current_tool = int(columns.tools[index][1:])
+            except:
+                pass  # handle T? by treating it as no tool change
+            while self.current_tool + 1 > len(gcode.current_e_multi):
+                gcode.current_e_multi += [0]
+                gcode.offset_e_multi += [0]
+                gcode.total_e_multi += [0]
+                gcode.max_e_multi += [0]
+        elif kind == CUTTING:
+            self.cutting = True
+        elif kind == NOT_CUTTING:
+            self.cutting = False
+        elif kind == HOME:
+            x = self._field(columns.x, index)
+            y = self._field(columns.y, index)
+            z = self._field(columns.z, index)
+            home_all = not any([x, y, z])
+            if home_all or x is not None:
+                self.offset_x = 0
+                self.current_x = gcode.home_x
+            if home_all or y is not None:
+                self.offset_y = 0
+                self.current_y = gcode.home_y
+            if home_all or z is not None:
+                self.offset_z = 0
+                self.current_z = gcode.home_z
+        elif kind == SET_POSITION:
+            x = self._field(columns.x, index)
+            y = self._field(columns.y, index)
+            z = self._field(columns.z, index)
+            e = self._field(columns.e, index)
+            if x is not None: self.offset_x = self.current_x - x
+            if y is not None: self.offset_y = self.current_y - y
+            if z is not None: self.offset_z = self.current_z - z
+            if e is not None:
+                tool = self.current_tool
+                self.offset_e = self.current_e - e
+                gcode.offset_e_multi[tool] = gcode.current_e_multi[tool] - e
+
+    def _field(self, column, index):
+        value = column[index]
+        return None if math.isnan(value) else float(value)
+
+    def _position(self, current, offset, values, relative):
+        """Returns the position after every one of a run of moves and the
+        position after the last"""
+        if numpy.isnan(values).all():
+            # Leave ints alone, like _preprocess does
+            return numpy.full(len(values), current, float), current
+        if relative:
+            positions = accumulate(current, numpy.nan_to_num(values))
+        else:
+            positions = forward_fill(values + offset, current)
+        return positions, float(positions[-1])
+
+    def move(self, moves, columns, results):
+        """Moves the head along moves, the indexes of move lines interpreted
+        in the current state"""
+        x = columns.x[moves]
+        y = columns.y[moves]
+        z = columns.z[moves]
+        (current_x, self.current_x) = self._position(self.current_x, self.offset_x, x, self.relative)
+        (current_y, self.current_y) = self._position(self.current_y, self.offset_y, y, self.relative)
+        (_, self.current_z) = self._position(self.current_z, self.offset_z, z, self.relative)
+        results.current_x[moves] = current_x
+        results.current_y[moves] = current_y
+        results.relative[moves] = self.relative
+        results.relative_e[moves] = self.relative_e
+
+        feedrates = columns.f[moves]
+        feedrates = feedrates[~numpy.isnan(feedrates)]
+        if len(feedrates):
+            self.gcode.current_f = float(feedrates[-1])
+
+        extruding = ~numpy.isnan(columns.e[moves])
+        if extruding.any():
+            self._extrude(moves[extruding], columns, results)
+        if self.cutting and self.gcode.cutting_as_extrusion:
+            results.extruding_or_cutting[moves] = True
+
+    def _extrude(self, moves, columns, results):
+        gcode = self.gcode
+        tool = self.current_tool
+        e = columns.e[moves]
+        if self.relative_e:
+            extruding = e > 0
+            total_e = accumulate(self.total_e, e)
+            self.current_e = float(accumulate(self.current_e, e)[-1])
+            total_e_multi = accumulate(gcode.total_e_multi[tool], e)
+            gcode.current_e_multi[tool] = float(accumulate(gcode.current_e_multi[tool], e)[-1])
+        else:
+            new_e = e + self.offset_e
+            previous_e = numpy.concatenate(([self.current_e], new_e[:-1]))
+            extruding = new_e > previous_e
+            total_e = accumulate(self.total_e, new_e - previous_e)
+            self.current_e = float(new_e[-1])
+            new_e_multi = e + gcode.offset_e_multi[tool]
+            previous_e_multi = numpy.concatenate(([gcode.current_e_multi[tool]], new_e_multi[:-1]))
+            total_e_multi = accumulate(gcode.total_e_multi[tool], new_e_multi - previous_e_multi)
+            gcode.current_e_multi[tool] = float(new_e_multi[-1])
+        max_e = numpy.maximum.accumulate(numpy.concatenate(([self.max_e], total_e)))[1:]
+        self.total_e = float(total_e[-1])
+        self.max_e = max(self.max_e, float(total_e.max()))
+        gcode.total_e_multi[tool] = float(total_e_multi[-1])
+        gcode.max_e_multi[tool] = max(gcode.max_e_multi[tool], float(total_e_multi.max()))
+        results.extruding[moves] = extruding
+        results.extruding_or_cutting[moves] = extruding
+        results.max_e[moves] = max_e
+
+    def save(self):
+        gcode = self.gcode
+        gcode.relative = self.relative
+        gcode.relative_e = self.relative_e
+        gcode.current_tool = self.current_tool
+        gcode.cutting = self.cutting
+        gcode.current_x = self.current_x
+        gcode.current_y = self.current_y
+        gcode.current_z = self.current_z
+        gcode.offset_x = self.offset_x
+        gcode.offset_y = self.offset_y
+        gcode.offset_z = self.offset_z
+        gcode.current_e = self.current_e
+        gcode.offset_e = self.offset_e
+        gcode.total_e = self.total_e
+        gcode.max_e = self.max_e
+
+
+class Results(object):
+    """What _preprocess works out for every line"""
+
+    def __init__(self, count, max_e):
+        self.current_x = numpy.full(count, NAN)
+        self.current_y = numpy.full(count, NAN)
+        self.relative = numpy.zeros(count, bool)
+        self.relative_e = numpy.zeros(count, bool)
+        self.extruding = numpy.zeros(count, bool)
+        self.extruding_or_cutting = numpy.zeros(count, bool)
+        # Highest total extrusion so far, at the lines that extrude
+        self.max_e = numpy.full(count, NAN)
+        self.initial_max_e = max_e
+
+
+def interpret(gcode, columns):
+    """Works out the position and extrusion of every move"""
+    state = State(gcode)
+    results = Results(columns.count, gcode.max_e)
+    kind = columns.kind
+    is_move = (kind == MOVE) | (kind == ARC)
+    changes = numpy.flatnonzero(numpy.isin(kind, STATE_KINDS))
+    start = 0
+    for change in numpy.append(changes, columns.count).tolist():
+        moves = numpy.flatnonzero(is_move[start:change]) + start
+        if len(moves):
+            state.move(moves, columns, results)
+        if change < columns.count:
+            state.change(int(kind[change]), change, columns)
+        start = change + 1
+    state.save()
+    return results, is_move
+
+
+def durations(columns, results):
+    """Estimated duration of every line, see GCode._preprocess"""
+    kind = columns.kind
+    duration = numpy.zeros(columns.count)
+    moves = numpy.flatnonzero(kind == MOVE)
+    if len(moves):
+        line_x = columns.x[moves]
+        line_y = columns.y[moves]
+        line_z = columns.z[moves]
+        line_e = columns.e[moves]
+        line_f = columns.f[moves]
+        x = forward_fill(line_x, 0.0)
+        y = forward_fill(line_y, 0.0)
+        z = forward_fill(line_z, 0.0)
+        e = forward_fill(line_e, 0.0)
+        # mm/s vs mm/m => divide by 60
+        f = forward_fill(line_f / 60.0, 0.0)
+        lastx = numpy.concatenate(([0.0], x[:-1]))
+        lasty = numpy.concatenate(([0.0], y[:-1]))
+        lastz = numpy.concatenate(([0.0], z[:-1]))
+        laste = numpy.concatenate(([0.0], e[:-1]))
+        lastf = numpy.concatenate(([0.0], f[:-1]))
+        dx = x - lastx
+        dy = y - lasty
+        lastdx = numpy.concatenate(([0.0], dx[:-1]))
+        lastdy = numpy.concatenate(([0.0], dy[:-1]))
+        # Moves in another direction than the one before start from a stop
+        lastf[dx * lastdx + dy * lastdy <= 0] = 0
+
+        travel = numpy.array(list(map(math.hypot, dx.tolist(), dy.tolist())))
+        still = travel == 0
+        has_z = still & ~numpy.isnan(line_z)
+        relative = results.relative[moves]
+        travel[has_z] = numpy.where(relative[has_z], numpy.abs(line_z[has_z]),
+                                    numpy.abs(line_z[has_z] - lastz[has_z]))
+        has_e = still & numpy.isnan(line_z) & ~numpy.isnan(line_e)
+        relative_e = results.relative_e[moves]
+        travel[has_e] = numpy.where(relative_e[has_e], numpy.abs(line_e[has_e]),
+                                    numpy.abs(line_e[has_e] - laste[has_e]))
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # Feedrate hasn't changed, no acceleration/decceleration planned
+            constant = numpy.where(f != 0, travel / f, 0.)
+            distance = 2 * numpy.abs(((lastf + f) * (f - lastf) * 0.5) / ACCELERATION)
+            full_speed = (distance <= travel) & (lastf + f != 0) & (f != 0)
+            accelerated = 2 * distance / (lastf + f) + (travel - distance) / f
+            slow = 2 * travel / (lastf + f)
+            move_duration = numpy.where(f == lastf, constant, numpy.where(full_speed, accelerated, slow))
+        duration[moves] = move_duration
+
+    for dwell in numpy.flatnonzero(kind == DWELL).tolist():
+        move_duration = gcoder.P(gcoder.PyLightLine(columns.raws[dwell]))
+        if move_duration:
+            duration[dwell] = move_duration / 1000.0
+    return duration
+
+
+def layer_heights(columns, results, is_move):
+    """Height every line is at as far as layers are concerned, which isn't
+    quite the position of the head. Returns the lines the height changes at
+    and the height from then on."""
+    kind = columns.kind
+    changes = []
+    heights = []
+    cur_z = None
+    for index in numpy.flatnonzero(~numpy.isnan(columns.z)).tolist():
+        z = float(columns.z[index])
+        previous = cur_z
+        if kind[index] == SET_POSITION:
+            cur_z = z
+        elif is_move[index]:
+            if results.relative[index] and cur_z is not None:
+                cur_z += z
+            else:
+                cur_z = z
+        else:
+            continue
+        if cur_z != previous:
+            changes.append(index)
+            heights.append(cur_z)
+    return changes, heights
+
+
+def build_layers(gcode, lines, columns, results, is_move, duration):
+    """Splits lines into layers like _preprocess does"""
+    total_duration = numpy.cumsum(duration)
+    # Lines that extruded up to every line, for cur_layer_has_extrusion
+    extruded = numpy.concatenate(([0], numpy.cumsum(results.extruding)))
+    all_layers = gcode.all_layers = []
+    all_zs = gcode.all_zs = set()
+    boundaries = []
+
+    layer_start = 0
+    extrusion_start = 0
+    layerbeginduration = 0.0
+    last_layer_z = None
+    prev_z = None
+    prev_base_z = (None, None)
+    for (index, cur_z) in zip(*layer_heights(columns, results, is_move)):
+        if prev_z is not None and last_layer_z is not None:
+            offset = gcode.est_layer_height if gcode.est_layer_height else 0.01
+            if abs(prev_z - last_layer_z) < offset:
+                if gcode.est_layer_height is None:
+                    zs = sorted([l.z for l in all_layers if l.z is not None])
+                    heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
+                    heights = [height for height in heights if height]
+                    if len(heights) >= 2: gcode.est_layer_height = heights[1]
+                    elif heights: gcode.est_layer_height = heights[0]
+                    else: gcode.est_layer_height = 0.1
+                base_z = round(prev_z - (prev_z % gcode.est_layer_height), 2)
+            else:
+                base_z = round(prev_z, 2)
+        else:
+            base_z = prev_z
+
+        if base_z != prev_base_z:
+            totalduration = float(total_duration[index])
+            new_layer = gcoder.Layer(lines[layer_start:index], base_z)
+            new_layer.duration = totalduration - layerbeginduration
+            layerbeginduration = totalduration
+            all_layers.append(new_layer)
+            boundaries.append(index)
+            if extruded[index + 1] > extruded[extrusion_start] and prev_z not in all_zs:
+                all_zs.add(prev_z)
+            layer_start = index
+            extrusion_start = index + 1
+            last_layer_z = base_z
+
+        prev_base_z = base_z
+        prev_z = cur_z
+
+    if layer_start < len(lines):
+        totalduration = float(total_duration[-1])
+        new_layer = gcoder.Layer(lines[layer_start:], prev_z)
+        new_layer.duration = totalduration - layerbeginduration
+        all_layers.append(new_layer)
+        if extruded[-1] > extruded[extrusion_start] and prev_z not in all_zs:
+            all_zs.add(prev_z)
+
+    counts = numpy.diff(numpy.array([0] + boundaries + [len(lines)]))
+    layer_ids = numpy.arange(len(counts), dtype=numpy.uint32)
+    # Layers made at the first line are empty and get no lines
+    layer_idxs = numpy.repeat(layer_ids, counts)
+    starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    line_idxs = numpy.arange(len(lines)) - starts
+    gcode.layer_idxs = array('I', layer_idxs.astype(numpy.uint32).tobytes())
+    gcode.line_idxs = array('I', line_idxs.astype(numpy.uint32).tobytes())
+
+    gcode.append_layer_id = len(all_layers)
+    gcode.append_layer = gcoder.Layer([])
+    gcode.append_layer.duration = 0
+    all_layers.append(gcode.append_layer)
+    return float(total_duration[-1]) if len(total_duration) else 0.0
+
+
+def bounding_box(gcode, results, is_move):
+    """Sets the bounding box of the extruding moves, or of every move for
+    prints that don't extrude"""
+    inf = float("inf")
+    extruding = is_move & results.extruding_or_cutting
+    # Moves made before anything was extruded
+    max_e = forward_fill(results.max_e, results.initial_max_e)
+    travelling = is_move & (max_e <= 0)
+
+    def limits(mask, values):
+        if not mask.any():
+            return inf, -inf
+        selected = values[mask]
+        if single_precision():
+            selected = to_single(selected)
+        return float(selected.min()), float(selected.max())
+
+    (xmin_e, xmax_e) = limits(extruding, results.current_x)
+    (ymin_e, ymax_e) = limits(extruding, results.current_y)
+    (xmin, xmax) = limits(travelling, results.current_x)
+    (ymin, ymax) = limits(travelling, results.current_y)
+
+    # Compute bounding box
+    zmin = 0
+    all_zs = gcode.all_zs.union({zmin}).difference({None})
+    zmin = min(all_zs)
+    zmax = max(all_zs)
+
+    gcode.filament_length = gcode.max_e
+    while len(gcode.filament_length_multi) < len(gcode.max_e_multi):
+        gcode.filament_length_multi += [0]
+    for i in enumerate(gcode.max_e_multi):
+        gcode.filament_length_multi[i[0]] = i[1]
+
+    if gcode.filament_length > 0:
+        gcode.xmin = xmin_e if not math.isinf(xmin_e) else 0
+        gcode.xmax = xmax_e if not math.isinf(xmax_e) else 0
+        gcode.ymin = ymin_e if not math.isinf(ymin_e) else 0
+        gcode.ymax = ymax_e if not math.isinf(ymax_e) else 0
+    else:
+        gcode.xmin = xmin if not math.isinf(xmin) else 0
+        gcode.xmax = xmax if not math.isinf(xmax) else 0
+        gcode.ymin = ymin if not math.isinf(ymin) else 0
+        gcode.ymax = ymax if not math.isinf(ymax) else 0
+    gcode.zmin = zmin if not math.isinf(zmin) else 0
+    gcode.zmax = zmax if not math.isinf(zmax) else 0
+    gcode.width = gcode.xmax - gcode.xmin
+    gcode.depth = gcode.ymax - gcode.ymin
+    gcode.height = gcode.zmax - gcode.zmin
+
+
+def preprocess(gcode, columns=None):
+    """Does what gcode._preprocess(build_layers = True) does for the lines
+    of gcode, tokenizing them unless given their columns"""
+    lines = gcode.lines
+    raws = [line.raw for line in lines]
+    if columns is None:
+        columns = tokenize(raws)
+    gcode.imperial = apply_units(columns, gcode.imperial)
+    if single_precision():
+        for name in ("x", "y", "z", "e", "f"):
+            setattr(columns, name, to_single(getattr(columns, name)))
+    columns.raws = raws
+    for index in columns.unparsed:
+        logging.warning("raw G-Code line \"%s\" could not be parsed" % raws[index])
+
+    (results, is_move) = interpret(gcode, columns)
+    totalduration = build_layers(gcode, lines, columns, results, is_move, durations(columns, results))
+    bounding_box(gcode, results, is_move)
+
+    # Finalize duration
+    totaltime = datetime.timedelta(seconds=int(totalduration))
+    gcode.duration = totaltime
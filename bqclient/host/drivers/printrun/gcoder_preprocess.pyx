@@ -0,0 +1,701 @@
+#cython: language_level=3
+#
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compiled version of GCode._preprocess.
+
+Lines are split by a tokenizer reading the characters of every line in
+place, which matches what gcode_exp finds, instead of by gcoder.split, and
+the state is kept in C variables instead of being set on a heavy copy of
+every light line. The results are the same as the ones of
+GCode._preprocess, down to the rounding of coordinates to the single
+precision floats of the compiled GLine when it is used. Lines with
+characters other than ASCII ones are split by gcoder.split."""
+
+import datetime
+import logging
+import math
+from array import array
+
+from libc.math cimport fabs
+from libc.string cimport memcpy
+
+from bqclient.host.drivers.printrun import gcoder
+
+cdef extern from "Python.h":
+    bint PyUnicode_IS_ASCII(object)
+    const char * PyUnicode_AsUTF8AndSize(object, Py_ssize_t *) except NULL
+    double PyOS_string_to_double(const char *, char **, void *) except? -1.0
+
+# What a line does, as far as _preprocess is concerned
+cdef enum Kind:
+    NONE
+    OTHER
+    MOVE
+    ARC
+    HOME
+    SET_POSITION
+    DWELL
+    INCHES
+    MILLIMETERS
+    ABSOLUTE
+    RELATIVE
+    ABSOLUTE_E
+    RELATIVE_E
+    TOOL
+    CUTTING
+    NOT_CUTTING
+
+# Fields of the arguments parse_coordinates sets
+cdef enum Field:
+    X
+    Y
+    Z
+    E
+    F
+    I
+    J
+    FIELDS
+    # Codes that aren't arguments, and characters that aren't codes
+    NOT_ARGUMENT
+    NOT_CODE
+
+KINDS = {
+    "G0": MOVE,
+    "G1": MOVE,
+    "G2": ARC,
+    "G3": ARC,
+    "G28": HOME,
+    "G92": SET_POSITION,
+    "G4": DWELL,
+    "G20": INCHES,
+    "G21": MILLIMETERS,
+    "G90": ABSOLUTE,
+    "G91": RELATIVE,
+    "M82": ABSOLUTE_E,
+    "M83": RELATIVE_E,
+    "M3": CUTTING,
+    "M4": CUTTING,
+    "M5": NOT_CUTTING,
+}
+
+FIELD_NAMES = ("x", "y", "z", "e", "f", "i", "j")
+
+cdef struct Split:
+    # The line has a token other than a line number
+    bint parsed
+    Kind kind
+    # The command starts with a G, its arguments are parsed
+    bint g_command
+    int has
+    double values[FIELDS]
+
+cdef inline bint is_space(char c):
+    # What \s matches in the ASCII range of a str
+    return c == c' ' or c'\t' <= c <= c'\r' or 28 <= c <= 31
+
+cdef inline bint is_digit(char c):
+    return c'0' <= c <= c'9'
+
+cdef inline char lower(char c):
+    return c + 32 if c'A' <= c <= c'Z' else c
+
+cdef inline Field field_of(char code):
+    if code == c'x': return X
+    if code == c'y': return Y
+    if code == c'z': return Z
+    if code == c'e': return E
+    if code == c'f': return F
+    if code == c'i': return I
+    if code == c'j': return J
+    if code == c'g' or code == c't' or code == c'm' or code == c'n':
+        return NOT_ARGUMENT
+    return NOT_CODE
+
+cdef inline bint equals(const char * value, Py_ssize_t length, const char * expected):
+    cdef Py_ssize_t i
+    for i in range(length):
+        if expected[i] != value[i]:
+            return False
+    return expected[length] == 0
+
+cdef Kind classify(char code, const char * value, Py_ssize_t length):
+    """Same as KINDS.get(command, OTHER) for the command made of code and
+    value"""
+    if code == c'g':
+        if equals(value, length, b"0") or equals(value, length, b"1"): return MOVE
+        if equals(value, length, b"2") or equals(value, length, b"3"): return ARC
+        if equals(value, length, b"28"): return HOME
+        if equals(value, length, b"92"): return SET_POSITION
+        if equals(value, length, b"4"): return DWELL
+        if equals(value, length, b"20"): return INCHES
+        if equals(value, length, b"21"): return MILLIMETERS
+        if equals(value, length, b"90"): return ABSOLUTE
+        if equals(value, length, b"91"): return RELATIVE
+    elif code == c'm':
+        if equals(value, length, b"82"): return ABSOLUTE_E
+        if equals(value, length, b"83"): return RELATIVE_E
+        if equals(value, length, b"3") or equals(value, length, b"4"): return CUTTING
+        if equals(value, length, b"5"): return NOT_CUTTING
+    elif code == c't':
+        return TOOL
+    return OTHER
+
+cdef double to_double(const char * value, Py_ssize_t length) except? -1.0:
+    """float() of the length characters at value"""
+    cdef char buffer[64]
+    if length >= 64:
+        return float(value[:length])
+    memcpy(buffer, value, length)
+    buffer[length] = 0
+    return PyOS_string_to_double(buffer, NULL, NULL)
+
+cdef object split_ascii(const char * s, Py_ssize_t n, Split * split, bint with_command):
+    """Splits the line of n ASCII characters at s like gcoder.split does,
+    finding what gcode_exp finds in it, and stores the arguments of G
+    commands like parse_coordinates would. Returns the command when asked
+    for it or when it is a tool change."""
+    cdef Py_ssize_t pos = 0, start, end, following
+    cdef Py_ssize_t tokens = 0
+    cdef bint first_skipped = False
+    cdef char c, code
+    cdef Field field
+    cdef char buffer[32]
+    command = None
+    split.has = 0
+    split.g_command = False
+    while pos < n:
+        c = lower(s[pos])
+        start = end = pos
+        field = NOT_ARGUMENT
+        if c == c'(':
+            # \([^\(\)]*\)
+            following = pos + 1
+            while following < n and s[following] != c'(' and s[following] != c')':
+                following += 1
+            if following == n or s[following] != c')':
+                pos += 1
+                continue
+            code = 0
+            following += 1
+        elif c == c';':
+            # ;.*
+            following = pos + 1
+            while following < n and s[following] != c'\n':
+                following += 1
+            code = 0
+        elif c == c'/' or c == c'*':
+            # [/\*].*\n
+            following = pos + 1
+            while following < n and s[following] != c'\n':
+                following += 1
+            if following == n:
+                pos += 1
+                continue
+            code = 0
+            following += 1
+        else:
+            # ([xyzefgtmnij])\s*([-+]?[0-9]*\.?[0-9]*)
+            field = field_of(c)
+            if field == NOT_CODE:
+                pos += 1
+                continue
+            code = c
+            end = pos + 1
+            while end < n and is_space(s[end]):
+                end += 1
+            start = end
+            if end < n and (s[end] == c'-' or s[end] == c'+'):
+                end += 1
+            while end < n and is_digit(s[end]):
+                end += 1
+            if end < n and s[end] == c'.':
+                end += 1
+            while end < n and is_digit(s[end]):
+                end += 1
+            following = end
+        pos = following
+
+        if tokens == 0:
+            # Line numbers are dropped
+            if code == c'n' and not first_skipped:
+                first_skipped = True
+                continue
+            if code == 0:
+                split.kind = NONE
+                command = ""
+            else:
+                split.kind = classify(code, s + start, end - start)
+                split.g_command = code == c'g'
+                if with_command or split.kind == TOOL:
+                    if end - start < 31:
+                        buffer[0] = c - 32
+                        memcpy(buffer + 1, s + start, end - start)
+                        command = buffer[:end - start + 1].decode("ascii")
+                    else:
+                        command = chr(c - 32) + s[start:end].decode("ascii")
+        elif split.g_command and field < FIELDS and end > start:
+            split.values[<int> field] = to_double(s + start, end - start)
+            split.has |= 1 << field
+        tokens += 1
+    split.parsed = tokens > 0
+    return command
+
+cdef object split_line(raw, Split * split, bint with_command):
+    """Splits raw, returning its command like split_ascii does, or raw
+    for lines gcoder.split can't parse either"""
+    cdef Py_ssize_t length
+    cdef const char * s
+    cdef int field
+    if PyUnicode_IS_ASCII(raw):
+        s = PyUnicode_AsUTF8AndSize(raw, &length)
+        command = split_ascii(s, length, split, with_command)
+        if not split.parsed:
+            logging.warning("raw G-Code line \"%s\" could not be parsed" % raw)
+            split.kind = OTHER
+            split.g_command = False
+            return raw
+        return command
+    line = gcoder.PyLine(raw)
+    split_raw = gcoder.split(line)
+    command = line.command
+    split.has = 0
+    split.kind = KINDS.get(command, OTHER) if command else NONE
+    if split.kind == OTHER and command[0] == "T":
+        split.kind = TOOL
+    split.g_command = command[:1] == "G"
+    if split.g_command:
+        for bit in split_raw:
+            if bit[1]:
+                field = field_of(ord(bit[0]))
+                if field < FIELDS:
+                    split.values[field] = float(bit[1])
+                    split.has |= 1 << field
+    return command
+
+def preprocess(gcode, lines = None, build_layers = False,
+               layer_callback = None):
+    """Does what GCode._preprocess does"""
+    cdef Split split
+    cdef int field
+    cdef bint heavy = gcode.line_class == gcoder.Line
+    # Coordinates are read back from lines that keep them as floats
+    cdef bint single = gcoder.single_precision()
+    cdef bint cutting_as_extrusion = gcode.cutting_as_extrusion
+    cdef bint is_move, has_x, has_y, has_z, has_e, has_f
+    cdef double line_x, line_y, line_z, line_e, line_f
+    cdef bint line_relative = False, line_relative_e = False, extruding
+    cdef double read_x, read_y
+    cdef double unit_factor
+
+    if not lines:
+        lines = gcode.lines
+    cdef bint imperial = gcode.imperial
+    cdef bint relative = gcode.relative
+    cdef bint relative_e = gcode.relative_e
+    current_tool = gcode.current_tool
+    cdef double current_x = gcode.current_x
+    cdef double current_y = gcode.current_y
+    cdef double current_z = gcode.current_z
+    cdef double offset_x = gcode.offset_x
+    cdef double offset_y = gcode.offset_y
+    cdef double offset_z = gcode.offset_z
+    cdef double home_x = gcode.home_x
+    cdef double home_y = gcode.home_y
+    cdef double home_z = gcode.home_z
+
+    # Extrusion computation
+    cdef double current_e = gcode.current_e
+    cdef double offset_e = gcode.offset_e
+    cdef double total_e = gcode.total_e
+    cdef double max_e = gcode.max_e
+    cdef bint cutting = gcode.cutting
+    cdef double new_e, new_e_multi
+
+    cdef double current_e_multi = gcode.current_e_multi[current_tool]
+    cdef double offset_e_multi = gcode.offset_e_multi[current_tool]
+    cdef double total_e_multi = gcode.total_e_multi[current_tool]
+    cdef double max_e_multi = gcode.max_e_multi[current_tool]
+    cdef double current_f = 0
+    cdef bint current_f_set = False
+
+    cdef bint cur_layer_has_extrusion = False
+
+    # Bounding box computation
+    cdef double inf = float("inf")
+    cdef double xmin = inf, ymin = inf, xmax = -inf, ymax = -inf
+    cdef double xmin_e = inf, ymin_e = inf, xmax_e = -inf, ymax_e = -inf
+
+    # Duration estimation, see GCode._preprocess
+    cdef double lastx = 0.0, lasty = 0.0, lastz = 0.0, laste = 0.0, lastf = 0.0
+    cdef double lastdx = 0, lastdy = 0
+    cdef double x, y, z, e, f, dx, dy
+    cdef double currenttravel = 0.0, moveduration = 0.0, totalduration = 0.0
+    cdef double acceleration = 2000.0  # mm/s^2
+    cdef double distance
+    cdef double layerbeginduration = 0.0
+    hypot = math.hypot
+
+    # Layers
+    cdef unsigned int layer_id = 0, layer_line = 0
+    cdef double cur_z = 0, prev_z = 0
+    cdef bint has_cur_z = False, has_prev_z = False
+    last_layer_z = None
+    prev_base_z = (None, None)
+    if build_layers:
+        all_layers = gcode.all_layers = []
+        all_zs = gcode.all_zs = set()
+        layer_idxs = gcode.layer_idxs = []
+        line_idxs = gcode.line_idxs = []
+        cur_lines = []
+
+    current_e_multis = gcode.current_e_multi
+    offset_e_multis = gcode.offset_e_multi
+    total_e_multis = gcode.total_e_multi
+    max_e_multis = gcode.max_e_multi
+
+    for true_line in lines:
+        command = split_line(true_line.raw, &split, heavy)
+        if heavy:
+            true_line.command = command
+            true_line.is_move = split.kind == MOVE or split.kind == ARC
+        if split.kind != NONE:
+            # Update properties
+            is_move = split.kind == MOVE or split.kind == ARC
+            if is_move:
+                line_relative = relative
+                line_relative_e = relative_e
+                if heavy:
+                    true_line.relative = relative
+                    true_line.relative_e = relative_e
+                    true_line.current_tool = current_tool
+            elif split.kind == INCHES:
+                imperial = True
+            elif split.kind == MILLIMETERS:
+                imperial = False
+            elif split.kind == ABSOLUTE:
+                relative = False
+                relative_e = False
+            elif split.kind == RELATIVE:
+                relative = True
+                relative_e = True
+            elif split.kind == ABSOLUTE_E:
+                relative_e = False
+            elif split.kind == RELATIVE_E:
+                relative_e = True
+            elif split.kind == TOOL:
+                current_e_multis[current_tool] = current_e_multi
+                offset_e_multis[current_tool] = offset_e_multi
+                total_e_multis[current_tool] = total_e_multi
+                max_e_multis[current_tool] = max_e_multi
+                try:
+                    current_tool = int(command[1:])
+                except:
+                    pass  # handle T? by treating it as no tool change
+                while current_tool + 1 > len(current_e_multis):
+                    current_e_multis += [0]
+                    offset_e_multis += [0]
+                    total_e_multis += [0]
+                    max_e_multis += [0]
+                current_e_multi = current_e_multis[current_tool]
+                offset_e_multi = offset_e_multis[current_tool]
+                total_e_multi = total_e_multis[current_tool]
+                max_e_multi = max_e_multis[current_tool]
+            elif split.kind == CUTTING:
+                cutting = True
+            elif split.kind == NOT_CUTTING:
+                cutting = False
+
+            if split.has:
+                unit_factor = 25.4 if imperial else 1
+                for field in range(FIELDS):
+                    if split.has & (1 << field):
+                        split.values[field] = unit_factor * split.values[field]
+                        if single:
+                            split.values[field] = <float> split.values[field]
+                        if heavy:
+                            setattr(true_line, FIELD_NAMES[field], split.values[field])
+            has_x = split.has & (1 << X)
+            has_y = split.has & (1 << Y)
+            has_z = split.has & (1 << Z)
+            has_e = split.has & (1 << E)
+            has_f = split.has & (1 << F)
+            line_x = split.values[<int> X] if has_x else 0
+            line_y = split.values[<int> Y] if has_y else 0
+            line_z = split.values[<int> Z] if has_z else 0
+            line_e = split.values[<int> E] if has_e else 0
+            line_f = split.values[<int> F] if has_f else 0
+
+            # Compute current position
+            if is_move:
+                if has_f:
+                    current_f = line_f
+                    current_f_set = True
+
+                if line_relative:
+                    current_x = current_x + line_x
+                    current_y = current_y + line_y
+                    current_z = current_z + line_z
+                else:
+                    if has_x: current_x = line_x + offset_x
+                    if has_y: current_y = line_y + offset_y
+                    if has_z: current_z = line_z + offset_z
+
+            elif split.kind == HOME:
+                home_all = not (line_x or line_y or line_z)
+                if home_all or has_x:
+                    offset_x = 0
+                    current_x = home_x
+                if home_all or has_y:
+                    offset_y = 0
+                    current_y = home_y
+                if home_all or has_z:
+                    offset_z = 0
+                    current_z = home_z
+
+            elif split.kind == SET_POSITION:
+                if has_x: offset_x = current_x - line_x
+                if has_y: offset_y = current_y - line_y
+                if has_z: offset_z = current_z - line_z
+
+            if heavy:
+                true_line.current_x = current_x
+                true_line.current_y = current_y
+                true_line.current_z = current_z
+
+            # Process extrusion
+            extruding = False
+            if has_e:
+                if is_move:
+                    if line_relative_e:
+                        extruding = line_e > 0
+                        total_e += line_e
+                        current_e += line_e
+                        total_e_multi += line_e
+                        current_e_multi += line_e
+                    else:
+                        new_e = line_e + offset_e
+                        extruding = new_e > current_e
+                        total_e += new_e - current_e
+                        current_e = new_e
+                        new_e_multi = line_e + offset_e_multi
+                        total_e_multi += new_e_multi - current_e_multi
+                        current_e_multi = new_e_multi
+                    if heavy:
+                        true_line.extruding = extruding
+
+                    if total_e > max_e: max_e = total_e
+                    if total_e_multi > max_e_multi: max_e_multi = total_e_multi
+                    cur_layer_has_extrusion |= extruding
+                elif split.kind == SET_POSITION:
+                    offset_e = current_e - line_e
+                    offset_e_multi = current_e_multi - line_e
+            if cutting and cutting_as_extrusion:
+                extruding = True
+                if heavy:
+                    true_line.extruding = True
+
+            # Create layers and perform global computations
+            if build_layers:
+                # Update bounding box
+                if is_move:
+                    read_x = <float> current_x if single else current_x
+                    read_y = <float> current_y if single else current_y
+                    if extruding:
+                        if read_x < xmin_e: xmin_e = read_x
+                        if read_x > xmax_e: xmax_e = read_x
+                        if read_y < ymin_e: ymin_e = read_y
+                        if read_y > ymax_e: ymax_e = read_y
+                    if max_e <= 0:
+                        if read_x < xmin: xmin = read_x
+                        if read_x > xmax: xmax = read_x
+                        if read_y < ymin: ymin = read_y
+                        if read_y > ymax: ymax = read_y
+
+                # Compute duration
+                if split.kind == MOVE:
+                    x = line_x if has_x else lastx
+                    y = line_y if has_y else lasty
+                    z = line_z if has_z else lastz
+                    e = line_e if has_e else laste
+                    # mm/s vs mm/m => divide by 60
+                    f = line_f / 60.0 if has_f else lastf
+
+                    dx = x - lastx
+                    dy = y - lasty
+                    if dx * lastdx + dy * lastdy <= 0:
+                        lastf = 0
+
+                    currenttravel = hypot(dx, dy)
+                    if currenttravel == 0:
+                        if has_z:
+                            currenttravel = fabs(line_z) if line_relative else fabs(line_z - lastz)
+                        elif has_e:
+                            currenttravel = fabs(line_e) if line_relative_e else fabs(line_e - laste)
+                    # Feedrate hasn't changed, no acceleration/decceleration planned
+                    if f == lastf:
+                        moveduration = currenttravel / f if f != 0 else 0.
+                    else:
+                        distance = 2 * fabs(((lastf + f) * (f - lastf) * 0.5) / acceleration)
+                        if distance <= currenttravel and lastf + f != 0 and f != 0:
+                            moveduration = 2 * distance / (lastf + f)
+                            moveduration += (currenttravel - distance) / f
+                        else:
+                            moveduration = 2 * currenttravel / (lastf + f)
+
+                    lastdx = dx
+                    lastdy = dy
+
+                    totalduration += moveduration
+
+                    lastx = x
+                    lasty = y
+                    lastz = z
+                    laste = e
+                    lastf = f
+                elif split.kind == DWELL:
+                    dwell = gcoder.P(true_line)
+                    if dwell:
+                        dwell /= 1000.0
+                        totalduration += dwell
+
+                if has_z:
+                    if split.kind == SET_POSITION:
+                        cur_z = line_z
+                        has_cur_z = True
+                    elif is_move:
+                        if line_relative and has_cur_z:
+                            cur_z += line_z
+                        else:
+                            cur_z = line_z
+                            has_cur_z = True
+
+                if has_cur_z != has_prev_z or (has_cur_z and cur_z != prev_z):
+                    # Layers change seldom, this is GCode._preprocess as is
+                    prev_z_value = prev_z if has_prev_z else None
+                    if prev_z_value is not None and last_layer_z is not None:
+                        offset = gcode.est_layer_height if gcode.est_layer_height else 0.01
+                        if abs(prev_z_value - last_layer_z) < offset:
+                            if gcode.est_layer_height is None:
+                                zs = sorted([l.z for l in all_layers if l.z is not None])
+                                heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
+                                heights = [height for height in heights if height]
+                                if len(heights) >= 2: gcode.est_layer_height = heights[1]
+                                elif heights: gcode.est_layer_height = heights[0]
+                                else: gcode.est_layer_height = 0.1
+                            base_z = round(prev_z_value - (prev_z_value % gcode.est_layer_height), 2)
+                        else:
+                            base_z = round(prev_z_value, 2)
+                    else:
+                        base_z = prev_z_value
+
+                    if base_z != prev_base_z:
+                        new_layer = gcoder.Layer(cur_lines, base_z)
+                        new_layer.duration = totalduration - layerbeginduration
+                        layerbeginduration = totalduration
+                        all_layers.append(new_layer)
+                        if cur_layer_has_extrusion and prev_z_value not in all_zs:
+                            all_zs.add(prev_z_value)
+                        cur_lines = []
+                        cur_layer_has_extrusion = False
+                        layer_id += 1
+                        layer_line = 0
+                        last_layer_z = base_z
+                        if layer_callback is not None:
+                            layer_callback(gcode, len(all_layers) - 1)
+
+                    prev_base_z = base_z
+
+        if build_layers:
+            cur_lines.append(true_line)
+            layer_idxs.append(layer_id)
+            line_idxs.append(layer_line)
+            layer_line += 1
+            prev_z = cur_z
+            has_prev_z = has_cur_z
+
+    # Store current status
+    gcode.imperial = imperial
+    gcode.relative = relative
+    gcode.relative_e = relative_e
+    gcode.current_tool = current_tool
+    gcode.current_x = current_x
+    gcode.current_y = current_y
+    gcode.current_z = current_z
+    gcode.offset_x = offset_x
+    gcode.offset_y = offset_y
+    gcode.offset_z = offset_z
+    gcode.current_e = current_e
+    gcode.offset_e = offset_e
+    gcode.max_e = max_e
+    gcode.total_e = total_e
+    if current_f_set:
+        gcode.current_f = current_f
+    current_e_multis[current_tool] = current_e_multi
+    offset_e_multis[current_tool] = offset_e_multi
+    max_e_multis[current_tool] = max_e_multi
+    total_e_multis[current_tool] = total_e_multi
+    gcode.cutting = cutting
+
+    # Finalize layers
+    if build_layers:
+        prev_z_value = prev_z if has_prev_z else None
+        if cur_lines:
+            new_layer = gcoder.Layer(cur_lines, prev_z_value)
+            new_layer.duration = totalduration - layerbeginduration
+            layerbeginduration = totalduration
+            all_layers.append(new_layer)
+            if cur_layer_has_extrusion and prev_z_value not in all_zs:
+                all_zs.add(prev_z_value)
+
+        gcode.append_layer_id = len(all_layers)
+        gcode.append_layer = gcoder.Layer([])
+        gcode.append_layer.duration = 0
+        all_layers.append(gcode.append_layer)
+        gcode.layer_idxs = array('I', layer_idxs)
+        gcode.line_idxs = array('I', line_idxs)
+
+        # Compute bounding box
+        zmin = 0
+        all_zs = gcode.all_zs.union({zmin}).difference({None})
+        zmin = min(all_zs)
+        zmax = max(all_zs)
+
+        gcode.filament_length = gcode.max_e
+        while len(gcode.filament_length_multi) < len(gcode.max_e_multi):
+            gcode.filament_length_multi += [0]
+        for i in enumerate(gcode.max_e_multi):
+            gcode.filament_length_multi[i[0]] = i[1]
+
+        if gcode.filament_length > 0:
+            gcode.xmin = xmin_e if not math.isinf(xmin_e) else 0
+            gcode.xmax = xmax_e if not math.isinf(xmax_e) else 0
+            gcode.ymin = ymin_e if not math.isinf(ymin_e) else 0
+            gcode.ymax = ymax_e if not math.isinf(ymax_e) else 0
+        else:
+            gcode.xmin = xmin if not math.isinf(xmin) else 0
+            gcode.xmax = xmax if not math.isinf(xmax) else 0
+            gcode.ymin = ymin if not math.isinf(ymin) else 0
+            gcode.ymax = ymax if not math.isinf(ymax) else 0
+        gcode.zmin = zmin if not math.isinf(zmin) else 0
+        gcode.zmax = zmax if not math.isinf(zmax) else 0
+        gcode.width = gcode.xmax - gcode.xmin
+        gcode.depth = gcode.ymax - gcode.ymin
+        gcode.height = gcode.zmax - gcode.zmin
+
+        # Finalize duration
+        totaltime = datetime.timedelta(seconds = int(totalduration))
+        gcode.duration = totaltime
@@ -0,0 +1,160 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+from array import array
+
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.analysis_cache import digest
+from bqclient.host.drivers.printrun.streaming import LayerCounter
+
+
+class MappedGCode(object):
+    """A print queue backed by a memory mapped file.
+
+    Only the offset in the file every line starts at is kept, along with the
+    layer_idxs and line_idxs arrays GCode has, 16 bytes a line in all. Line
+    objects are made when a line is looked up, so any line can be reached
+    in constant time to resume or seek a print, and bots printing the same
+    file share its pages in the page cache.
+
+    Lines are numbered like GCode numbers them, skipping empty ones. Layers
+    are counted like StreamingGCode counts them, see LayerCounter. Given an
+    AnalysisCache, the index of a file that was printed before is loaded
+    from it instead.
+    """
+
+    def __init__(self, filename, batch_lines=4096, cache=None):
+        self._file = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._map = b""
+        self.offsets = array('Q')
+        self.layer_idxs = array('I')
+        self.line_idxs = array('I')
+        if cache is None:
+            self._index(batch_lines)
+        else:
+            self._load(cache, batch_lines)
+        self.layer_count = self.layer_idxs[-1] + 1 if self.layer_idxs else 0
+        # Lines sent with printcore.send while printing, printed after the file
+        self.append_layer_id = self.layer_count
+        self._file_lines = len(self.offsets)
+        self._appended = []
+
+    def _load(self, cache, batch_lines):
+        key = "%s.%s" % (digest(self._map), type(self).__name__)
+        entry = cache.get(key)
+        if entry is not None:
+            arrays = entry[1]
+            self.offsets = arrays["offsets"]
+            self.layer_idxs = arrays["layer_idxs"]
+            self.line_idxs = arrays["line_idxs"]
+            return
+        self._index(batch_lines)
+        if self.offsets:
+            cache.put(key, {}, {
+                "offsets": self.offsets,
+                "layer_idxs": self.layer_idxs,
+                "line_idxs": self.line_idxs,
+            })
+
+    def _index(self, batch_lines):
+        offsets = self.offsets
+        counter = LayerCounter()
+        readline = self._map.readline if self._map else (lambda: b"")
+        offset = 0
+        lines = []
+        while True:
+            raw = readline()
+            if not raw:
+                break
+            start = offset
+            offset += len(raw)
+            raw = raw.strip()
+            if raw:
+                lines.append(gcoder.Line(raw.decode("utf-8")))
+                offsets.append(start)
+                if len(lines) == batch_lines:
+                    counter.count(lines, self.layer_idxs)
+                    lines = []
+        if lines:
+            counter.count(lines, self.layer_idxs)
+        layer_idxs = self.layer_idxs
+        line_idxs = self.line_idxs
+        position = 0
+        for i in range(len(layer_idxs)):
+            if i and layer_idxs[i] != layer_idxs[i - 1]:
+                position = 0
+            line_idxs.append(position)
+            position += 1
+
+    def __len__(self):
+        return len(self.layer_idxs)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.line_at(i)[1]
+
+    @property
+    def complete(self):
+        return True
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def has_index(self, i):
+        return i < len(self)
+
+    def idxs(self, i):
+        return self.layer_idxs[i], self.line_idxs[i]
+
+    def raw_at(self, index):
+        """Returns the text of the line at index"""
+        start = self.offsets[index]
+        end = self._map.find(b"\n", start)
+        if end < 0:
+            end = len(self._map)
+        return self._map[start:end].strip().decode("utf-8")
+
+    def line_at(self, index):
+        """Returns the layer and the line at index, or None past the end"""
+        if index < self._file_lines:
+            return self.layer_idxs[index], gcoder.LightLine(self.raw_at(index))
+        if index < len(self):
+            return self.append_layer_id, self._appended[index - self._file_lines]
+        return None
+
+    def append(self, command, store=True):
+        command = command.strip()
+        if not command:
+            return
+        gline = gcoder.Line(command)
+        gcoder.split(gline)
+        if store:
+            self._appended.append(gline)
+            self.layer_idxs.append(self.append_layer_id)
+            self.line_idxs.append(len(self._appended) - 1)
+        return gline
+
+    def progress(self, index):
+        """Fraction of the file that comes before line index"""
+        if index >= self._file_lines or not len(self._map):
+            return 1.0
+        return self.offsets[index] / len(self._map)
@@ -0,0 +1,202 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""MeatPack, the packed serial encoding of G-code Marlin can unpack.
+
+The characters G-code is mostly made of are sent as 4 bit codes, two to a
+byte, the first in the low half. Any other character takes a code of all
+ones, and follows the byte as is. Two 0xFF bytes and a command byte switch
+packing on and off; the firmware answers every command with its state, like
+"[MP] PV01 ON NSP". With no spaces on, the code for a space stands for E
+and the host leaves out the spaces of lines that can do without them.
+"""
+
+SIGNAL = 0xFF
+# Commands, each sent after two SIGNAL bytes
+ENABLE_PACKING = 0xFB
+DISABLE_PACKING = 0xFA
+RESET_ALL = 0xF9
+QUERY_CONFIG = 0xF8
+ENABLE_NO_SPACES = 0xF7
+DISABLE_NO_SPACES = 0xF6
+
+PROTOCOL_VERSION = "PV01"
+# The characters of codes 0 to 14, 15 being the one for a character that
+# follows as is
+CHARACTERS = b"0123456789. \nGX"
+NO_SPACES_CHARACTERS = b"0123456789.E\nGX"
+NOT_PACKED = 0b1111
+
+
+def command(code):
+    """The bytes of a MeatPack command"""
+    return bytes((SIGNAL, SIGNAL, code))
+
+
+def parse_state(line):
+    """(packing, no spaces) from the state the firmware reports, or None if
+    line isn't one"""
+    words = line.split()
+    if len(words) < 3 or words[0] != "[MP]":
+        return None
+    return "ON" in words[2:], "NSP" in words[2:]
+
+
+def without_spaces(line):
+    """A framed line without its spaces, with its checksum changed to match.
+    Taking out a space flips the bit 0x20 of the checksum."""
+    (body, star, checksum) = line.rpartition(b"*")
+    if not star:
+        return line.replace(b" ", b"")
+    if body.count(b" ") % 2 and checksum.isdigit():
+        checksum = b"%d" % (int(checksum) ^ 0x20)
+    return body.replace(b" ", b"") + star + checksum
+
+
+class PairTable(dict):
+    """The packed bytes of every pair of characters, worked out the first
+    time each pair is seen"""
+
+    def __init__(self, characters):
+        super().__init__()
+        self.codes = dict((character, code) for (code, character) in enumerate(characters))
+
+    def __missing__(self, pair):
+        (first, second) = (pair[0], pair[1])
+        first_code = self.codes.get(first, NOT_PACKED)
+        second_code = self.codes.get(second, NOT_PACKED)
+        packed = bytearray([first_code | second_code << 4])
+        if first_code == NOT_PACKED:
+            packed.append(first)
+        if second_code == NOT_PACKED:
+            packed.append(second)
+        packed = bytes(packed)
+        self[pair] = packed
+        return packed
+
+
+class MeatPacker(object):
+    """Packs lines the way a firmware with packing on unpacks them.
+
+    Every line is packed on its own: the firmware drops the half of a byte
+    that follows a newline, which is where the lines of an odd number of
+    characters are padded. With no_spaces, the spaces of G lines are left
+    out, which any G-code parser takes, and the rest send theirs as is.
+    """
+
+    def __init__(self, no_spaces=False):
+        self.no_spaces = no_spaces
+        self._pairs = PairTable(NO_SPACES_CHARACTERS if no_spaces else CHARACTERS)
+
+    def _strip(self, line):
+        command = line[line.find(b" ") + 1:] if line[:1] == b"N" else line
+        if command[:1] in (b"G", b"g"):
+            return without_spaces(line)
+        return line
+
+    def pack(self, data):
+        """The packed bytes of data, lines each ending with a newline"""
+        pairs = self._pairs
+        packed = []
+        for line in data.split(b"\n")[:-1]:
+            if self.no_spaces and b" " in line:
+                line = self._strip(line)
+            # The second newline is the padding
+            line += b"\n\n" if len(line) % 2 == 0 else b"\n"
+            packed.extend(map(pairs.__getitem__, [line[i:i + 2] for i in range(0, len(line) - 1, 2)]))
+        return b"".join(packed)
+
+
+class MeatUnpacker(object):
+    """Unpacks what a MeatPacker packs, the way Marlin does, for firmware
+    emulators. report is called with the state line after every command."""
+
+    def __init__(self, report=None):
+        self.report = report
+        self.active = False
+        self.no_spaces = False
+        self._signals = 0
+        self._command_next = False
+        # Characters that follow as is, and the unpacked character to output
+        # after the first of them
+        self._literals = 0
+        self._second = None
+
+    def state(self):
+        return "[MP] %s %s %s" % (PROTOCOL_VERSION, "ON" if self.active else "OFF",
+                                  "NSP" if self.no_spaces else "ESP")
+
+    def _command(self, code):
+        if code == ENABLE_PACKING:
+            self.active = True
+        elif code == DISABLE_PACKING:
+            self.active = False
+        elif code == RESET_ALL:
+            self.active = self.no_spaces = False
+        elif code == ENABLE_NO_SPACES:
+            self.no_spaces = True
+        elif code == DISABLE_NO_SPACES:
+            self.no_spaces = False
+        if self.report is not None:
+            self.report(self.state())
+
+    def _unpack(self, byte, output):
+        if not self.active:
+            output.append(byte)
+            return
+        if self._literals:
+            output.append(byte)
+            if self._second is not None:
+                output.append(self._second)
+                self._second = None
+            self._literals -= 1
+            return
+        characters = NO_SPACES_CHARACTERS if self.no_spaces else CHARACTERS
+        (first_code, second_code) = (byte & 0xF, byte >> 4)
+        if first_code == NOT_PACKED:
+            self._literals += 1
+            if second_code == NOT_PACKED:
+                self._literals += 1
+            else:
+                self._second = characters[second_code]
+            return
+        output.append(characters[first_code])
+        if characters[first_code] != ord("\n"):
+            if second_code == NOT_PACKED:
+                self._literals += 1
+            else:
+                output.append(characters[second_code])
+
+    def feed(self, data):
+        """The unpacked bytes of the bytes received"""
+        output = bytearray()
+        for byte in data:
+            if byte == SIGNAL:
+                if self._signals:
+                    self._command_next = True
+                    self._signals = 0
+                else:
+                    self._signals = 1
+                continue
+            if self._command_next:
+                self._command_next = False
+                self._command(byte)
+                continue
+            if self._signals:
+                # A single 0xFF is two characters that follow as is
+                self._unpack(SIGNAL, output)
+                self._signals = 0
+            self._unpack(byte, output)
+        return bytes(output)
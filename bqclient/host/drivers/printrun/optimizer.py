@@ -0,0 +1,202 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+from bqclient.host.drivers.printrun import gcoder
+
+AXES = "XYZE"
+# Commands that leave the position, the feedrate and the modes alone. Any
+# other one makes the optimizer forget what it knows about them.
+HARMLESS = frozenset([
+    "M104", "M105", "M106", "M107", "M109", "M140", "M190", "M117", "M73",
+])
+
+
+class OptimizerStats(object):
+    """What optimizing a file saved. Bytes are the bytes of the lines that
+    are sent, without their comments, line numbers and checksums."""
+
+    def __init__(self):
+        self.lines_read = 0
+        self.lines_written = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_read - self.bytes_written
+
+    def __str__(self):
+        saved = 100.0 * self.bytes_saved / self.bytes_read if self.bytes_read else 0.0
+        return "saved %d of %d bytes (%.1f%%), kept %d of %d lines" % (
+            self.bytes_saved, self.bytes_read, saved, self.lines_written, self.lines_read)
+
+
+def sent_size(line):
+    """Bytes printcore sends for a line, besides its line number and
+    checksum"""
+    if line.lstrip().startswith(";@"):
+        return 0
+    stripped = gcoder.strip_comments(line)
+    return len(stripped) + 1 if stripped else 0
+
+
+def trim(value):
+    """A number without the zeros at the end of its fraction"""
+    if "." not in value:
+        return value
+    value = value.rstrip("0").rstrip(".")
+    return value if value not in ("", "-", "+") else "0"
+
+
+def move_words(text):
+    """The words of a G0 or G1 move that is only a command and words with a
+    code and a number each, like the fast path of gcoder.tokenize reads
+    them, or None"""
+    words = text.split()
+    if words[0] not in ("G0", "G1") or not text.isascii():
+        return None
+    codes = set()
+    for word in words[1:]:
+        value = word[1:]
+        digits = value[1:] if value[:1] in "-+" else value
+        if word[0] not in "XYZEF" or word[0] in codes or not digits.replace(".", "", 1).isdigit():
+            return None
+        codes.add(word[0])
+    return words
+
+
+class Optimizer(object):
+    """Rewrites G-code to take fewer bytes to send without changing the
+    moves it makes: lines that are only a comment or empty are dropped,
+    comments and the zeros ending numbers are removed, and so are the words
+    of G0 and G1 moves that repeat the position or the feedrate the printer
+    is already at.
+
+    Positions are only known after absolute moves in a known mode, and the
+    feedrate after G1 moves. Anything else that could change them, homing,
+    G92, arcs, tool changes and unknown commands, makes the optimizer
+    forget them.
+    """
+
+    def __init__(self):
+        self.stats = OptimizerStats()
+        # None while the mode hasn't been set by the file
+        self.relative = None
+        self.relative_e = None
+        self.position = dict.fromkeys(AXES)
+        self.feedrate = None
+
+    def _forget(self):
+        self.position = dict.fromkeys(AXES)
+        self.feedrate = None
+
+    def _relative(self, axis):
+        return self.relative_e if axis == "E" else self.relative
+
+    def _move(self, words):
+        kept = [words[0]]
+        for word in words[1:]:
+            code = word[0]
+            value = trim(word[1:])
+            number = float(value)
+            if code == "F":
+                if words[0] == "G0":
+                    # Some firmwares keep the feedrate of G0 moves apart
+                    self.feedrate = None
+                elif number == self.feedrate:
+                    continue
+                else:
+                    self.feedrate = number
+            else:
+                relative = self._relative(code)
+                if relative is None:
+                    self.position[code] = None
+                elif relative:
+                    if number == 0:
+                        continue
+                    # Don't add up offsets differently than the firmware
+                    self.position[code] = None
+                elif number == self.position[code]:
+                    continue
+                else:
+                    self.position[code] = number
+            kept.append(code + value)
+        if len(kept) == 1:
+            return None
+        return " ".join(kept)
+
+    def _command(self, command):
+        if command in ("G90", "G91"):
+            self.relative = self.relative_e = command == "G91"
+        elif command in ("M82", "M83"):
+            self.relative_e = command == "M83"
+        if command not in HARMLESS:
+            self._forget()
+
+    def line(self, line):
+        """The optimized line, or None to drop it"""
+        # Like the lines of a GCode
+        line = line.strip()
+        self.stats.lines_read += 1
+        self.stats.bytes_read += sent_size(line)
+        if line.startswith(";@"):
+            # Host commands are comments to the printer
+            self._forget()
+            optimized = line
+        else:
+            optimized = gcoder.strip_comments(line)
+            if optimized and not line.startswith(optimized):
+                # Taking out a comment in the middle of the line joins the
+                # words around it, which gcoder doesn't
+                optimized = line
+                self._forget()
+            elif optimized:
+                words = move_words(optimized)
+                if words is not None:
+                    optimized = self._move(words)
+                else:
+                    self._command(gcoder.tokenize(optimized)[0])
+        if optimized:
+            self.stats.lines_written += 1
+            self.stats.bytes_written += sent_size(optimized)
+        return optimized or None
+
+    def lines(self, lines):
+        """Optimizes lines, dropping the ones that aren't needed"""
+        for line in lines:
+            optimized = self.line(line)
+            if optimized is not None:
+                yield optimized
+
+
+def optimize_file(source, destination, stages=None):
+    """Writes the lines of source to destination, passed through the lines
+    method of every one of stages in turn, an Optimizer by default.
+    Returns the OptimizerStats of it all."""
+    if stages is None:
+        stages = [Optimizer()]
+    with open(source, encoding="utf-8") as fh_in, \
+            open(destination, "w", encoding="utf-8") as fh_out:
+        lines = fh_in
+        for stage in stages:
+            lines = stage.lines(lines)
+        for line in lines:
+            fh_out.write(line + "\n")
+    stats = OptimizerStats()
+    stats.lines_read = stages[0].stats.lines_read
+    stats.bytes_read = stages[0].stats.bytes_read
+    stats.lines_written = stages[-1].stats.lines_written
+    stats.bytes_written = stages[-1].stats.bytes_written
+    return stats
@@ -0,0 +1,248 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from bqclient.host.drivers.printrun import gcoder
+
+
+class PackedLine(object):
+    """A line of a LineStore, made when the line is looked up. It stands
+    for the line at its position, lines inserted or removed before it
+    shift it to another one."""
+
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    @property
+    def raw(self):
+        return self._store.raw(self._index)
+
+    @property
+    def command(self):
+        return self._store.command(self._index)
+
+    @command.setter
+    def command(self, value):
+        self._store.set_command(self._index, value)
+
+    def __getattr__(self, name):
+        # Like LightLine, a light line doesn't keep anything else
+        return None
+
+    def __repr__(self):
+        return "<PackedLine %d %r>" % (self._index, self.raw)
+
+
+class LineStore(object):
+    """The lines of a file in a few flat buffers instead of an object and a
+    string each: the UTF-8 text of all of them in one bytearray and the
+    offset every line ends at. Commands set on lines are kept as the index
+    of the command in a table of the distinct ones.
+
+    It is a sequence of PackedLine, which LightGCode expects of its lines,
+    made when a line is looked up.
+    """
+
+    def __init__(self, lines=()):
+        self._text = bytearray()
+        self._ends = array('Q')
+        # Index in _command_table plus one of the command of every line, 0
+        # for lines without one, once a line has one
+        self._commands = None
+        self._command_table = []
+        self._command_ids = {}
+        self.extend(lines)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __iter__(self):
+        for index in range(len(self._ends)):
+            yield PackedLine(self, index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PackedLine(self, i) for i in range(*index.indices(len(self._ends)))]
+        return PackedLine(self, self._position(index))
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(len(self._ends))
+            if step != 1:
+                for i in sorted(range(start, stop, step), reverse=True):
+                    del self[i]
+                return
+        else:
+            start = self._position(index)
+            stop = start + 1
+        if start >= stop:
+            return
+        first = self._start(start)
+        last = self._ends[stop - 1]
+        del self._text[first:last]
+        removed = last - first
+        self._ends[stop:] = array('Q', [end - removed for end in self._ends[stop:]])
+        del self._ends[start:stop]
+        if self._commands is not None:
+            del self._commands[start:stop]
+
+    def _position(self, index):
+        if index < 0:
+            index += len(self._ends)
+        if not 0 <= index < len(self._ends):
+            raise IndexError("line index out of range")
+        return index
+
+    def _start(self, index):
+        return self._ends[index - 1] if index else 0
+
+    @property
+    def nbytes(self):
+        """Size of the buffers the lines are kept in"""
+        size = len(self._text) + len(self._ends) * self._ends.itemsize
+        if self._commands is not None:
+            size += len(self._commands) * self._commands.itemsize
+        return size
+
+    def raw(self, index):
+        return self._text[self._start(index):self._ends[index]].decode("utf-8")
+
+    def command(self, index):
+        if self._commands is None:
+            return None
+        command_id = self._commands[index]
+        return self._command_table[command_id - 1] if command_id else None
+
+    def set_command(self, index, command):
+        if self._commands is None:
+            if command is None:
+                return
+            self._commands = array('I', bytes(len(self._ends) * 4))
+        self._commands[index] = self._command_id(command)
+
+    def _command_id(self, command):
+        if command is None:
+            return 0
+        command_id = self._command_ids.get(command)
+        if command_id is None:
+            self._command_table.append(command)
+            command_id = self._command_ids[command] = len(self._command_table)
+        return command_id
+
+    def _encode(self, line):
+        """The text and command of a line, or of a string"""
+        if isinstance(line, str):
+            return line.encode("utf-8"), None
+        return line.raw.encode("utf-8"), line.command
+
+    def append(self, line):
+        """Appends a line, given as a string or as a line object"""
+        (text, command) = self._encode(line)
+        self._text += text
+        self._ends.append(len(self._text))
+        if self._commands is not None:
+            self._commands.append(0)
+        if command is not None:
+            self.set_command(len(self._ends) - 1, command)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def insert(self, index, line):
+        """Inserts a line before index, like list.insert"""
+        count = len(self._ends)
+        if index < 0:
+            index = max(0, index + count)
+        index = min(index, count)
+        (text, command) = self._encode(line)
+        start = self._start(index)
+        self._text[start:start] = text
+        self._ends[index:] = array('Q', [end + len(text) for end in self._ends[index:]])
+        self._ends.insert(index, start + len(text))
+        if self._commands is not None:
+            self._commands.insert(index, 0)
+        if command is not None:
+            self.set_command(index, command)
+
+
+class PackedLayer(object):
+    """A layer of a PackedGCode: the run of its lines with the layer's
+    number in layer_idxs, looked up when it is used. Lines inserted into
+    or removed from the GCode show up in it, so the list methods GCode
+    calls to do the same on its layers have nothing to do."""
+
+    __slots__ = ('gcode', 'layer', 'z', 'duration')
+
+    def __init__(self, gcode, layer, z=None):
+        self.gcode = gcode
+        self.layer = layer
+        self.z = z
+        self.duration = None
+
+    def _bounds(self):
+        layer_idxs = self.gcode.layer_idxs
+        return bisect_left(layer_idxs, self.layer), bisect_right(layer_idxs, self.layer)
+
+    def __len__(self):
+        (start, end) = self._bounds()
+        return end - start
+
+    def __iter__(self):
+        (start, end) = self._bounds()
+        lines = self.gcode.lines
+        for index in range(start, end):
+            yield lines[index]
+
+    def __getitem__(self, index):
+        (start, end) = self._bounds()
+        lines = self.gcode.lines
+        if isinstance(index, slice):
+            return [lines[start + i] for i in range(*index.indices(end - start))]
+        if index < 0:
+            index += end - start
+        if not 0 <= index < end - start:
+            raise IndexError("layer index out of range")
+        return lines[start + index]
+
+    def insert(self, index, line):
+        pass
+
+    def append(self, line):
+        pass
+
+    def __delitem__(self, index):
+        pass
+
+
+class PackedGCode(gcoder.LightGCode):
+    """A LightGCode keeping its lines in a LineStore. The layers of the
+    file are PackedLayer views of it, lines sent while printing go to an
+    append layer like they do with GCode."""
+
+    def _make_lines(self, data):
+        return LineStore(l2 for l2 in (l.strip() for l in data) if l2)
+
+    def _finish_layers(self):
+        all_layers = self.all_layers
+        for layer_id in range(self.append_layer_id):
+            layer = all_layers[layer_id]
+            packed = all_layers[layer_id] = PackedLayer(self, layer_id, layer.z)
+            packed.duration = layer.duration
@@ -34,8 +34,14 @@ import errno
 import socket
 import re
 from functools import wraps, reduce
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import xor
 from collections import deque
-from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun import gcoder, meatpack
+from bqclient.host.drivers.printrun.reader import SelectorReader
+from bqclient.host.drivers.printrun.responses import ResponseClassifier, OK, OK_TEMP, TEMP, RESEND, ERROR, \
+    GREETING, DEBUG, MEATPACK
 from bqclient.host.drivers.printrun.utils import set_utf8_locale, install_locale, decode_utf8
 
 try:
@@ -45,6 +51,25 @@ except:
 install_locale('pronterface')
 
 
+def py_checksum(command):
+    return reduce(xor, command, 0)
+
+
+def py_frame(command, lineno):
+    prefix = b"N%d %s" % (lineno, command)
+    return b"%s*%d\n" % (prefix, reduce(xor, prefix, 0))
+
+
+try:
+    from bqclient.host.drivers.printrun import framing
+    checksum = framing.checksum
+    frame = framing.frame
+except Exception as e:
+    logging.warning("Compiled line framing unavailable: %s" % e)
+    checksum = py_checksum
+    frame = py_frame
+
+
 def locked(f):
     @wraps(f)
     def inner(*args, **kw):
@@ -72,40 +97,207 @@ def disable_hup(port):
     control_ttyhup(port, True)
 
 
+# Seconds to wait on an answer to M105 before asking again while connecting.
+# _listen_until_online gives up after 15 empty reads of 0.25 seconds.
+ONLINE_PROBE_INTERVAL = 15 * 0.25
+# Most lines a printer on a reactor sends before the next printer's turn
+REACTOR_PUMP_LINES = 64
+
+
+class ResendOutOfRange(Exception):
+    pass
+
+
+class PrintFailed(Exception):
+    pass
+
+
+class ResendHistory(object):
+    """Fixed size ring buffer of the last checksummed lines sent, indexed by
+    line number. The firmware can only ask for lines it has not acknowledged
+    yet, so this only needs to be a little larger than the send window."""
+
+    def __init__(self, size):
+        self.size = size
+        self._numbers = [-1] * size
+        self._lines = [None] * size
+
+    def __setitem__(self, lineno, command):
+        slot = lineno % self.size
+        self._numbers[slot] = lineno
+        self._lines[slot] = command
+
+    def __getitem__(self, lineno):
+        slot = lineno % self.size
+        if self._numbers[slot] != lineno:
+            raise ResendOutOfRange(_("Firmware asked to resend line %d, which is no longer in the "
+                                     "resend history of %d lines") % (lineno, self.size))
+        return self._lines[slot]
+
+    def __contains__(self, lineno):
+        return self._numbers[lineno % self.size] == lineno
+
+    def clear(self):
+        self._numbers = [-1] * self.size
+        self._lines = [None] * self.size
+
+
+class LayerIndex(object):
+    """Start offsets of the layers of a GCode in the order they are printed,
+    next to the layer each one starts. Lines appended to the GCode later
+    on all go to its append layer, which is always the last one."""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.starts = array('I')
+        self.layers = array('I')
+        layer_idxs = gcode.layer_idxs
+        count = len(layer_idxs)
+        if count:
+            # Layer numbers only ever go up along the file
+            for layer in range(layer_idxs[0], layer_idxs[-1] + 1):
+                start = bisect_left(layer_idxs, layer)
+                if start < count and layer_idxs[start] == layer:
+                    self.starts.append(start)
+                    self.layers.append(layer)
+        append_layer = getattr(gcode, "append_layer_id", None)
+        if append_layer is not None and (not self.layers or self.layers[-1] != append_layer):
+            self.starts.append(count)
+            self.layers.append(append_layer)
+        # Layers that were in the file, as opposed to lines sent later
+        self.count = len(self.starts) - (append_layer is not None)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, index):
+        """Position in starts of the layer holding line index"""
+        return max(0, bisect_right(self.starts, index) - 1)
+
+
+class Hook(object):
+    """A callback attribute of printcore. Assigning it rebuilds the
+    instance's hook table."""
+
+    def __set_name__(self, owner, name):
+        self.attribute = "_" + name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__dict__.get(self.attribute)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.attribute] = value
+        instance._rebuild_hooks()
+
+
+class HookTable(object):
+    """The per-line callbacks of a printcore, each event as a tuple of
+    (callable, error reporter) pairs that is empty when nobody listens"""
+
+    __slots__ = ('send', 'recv', 'temp', 'preprintsend', 'printsend', 'layerchange')
+
+    def __init__(self, core):
+        handlers = core.event_handler or []
+        for event in self.__slots__:
+            hooks = [(getattr(handler, "on_" + event), logging.error) for handler in handlers]
+            callback = getattr(core, event + "cb", None)
+            # preprintsendcb replaces the line, it is called on its own
+            if callback and event != "preprintsend":
+                hooks.append((callback, core.logError))
+            setattr(self, event, tuple(hooks))
+
+
+def dispatch(hooks, *args):
+    for hook, report in hooks:
+        try:
+            hook(*args)
+        except:
+            report(traceback.format_exc())
+
+
 class printcore():
+    tempcb = Hook()  # impl (wholeline)
+    recvcb = Hook()  # impl (wholeline)
+    sendcb = Hook()  # impl (wholeline)
+    preprintsendcb = Hook()  # impl (wholeline)
+    printsendcb = Hook()  # impl (wholeline)
+    layerchangecb = Hook()  # impl (wholeline)
+    # Event handlers must be added with addEventHandler, or the list
+    # assigned as a whole, for the hook table to see them
+    event_handler = Hook()
+
     def __init__(self, port=None, baud=None, dtr=None):
         """Initializes a printcore instance. Pass the port and baud rate to
            connect immediately"""
         self.baud = None
         self.dtr = None
         self.port = None
+        # Tracks the printer's position from the commands sent. Only kept up
+        # to date with analyze set, in which case sent commands are handed to
+        # a separate thread so the analysis never delays the next write.
         self.analyzer = gcoder.GCode()
+        self.analyze = False
+        self.analyzer_thread = None
+        self._analyzer_queue = Queue(0)
         # Serial instance connected to the printer, should be None when
         # disconnected
         self.printer = None
-        # clear to send, enabled after responses
-        # FIXME: should probably be changed to a sliding window approach
-        self.clear = 0
+        # Flow control: the number of commands that may still be sent before
+        # waiting on an "ok". Everything that changes it, or the print state
+        # the senders wait on, notifies _flow so waiting threads sleep until
+        # the firmware actually answers instead of polling.
+        self._flow = threading.Condition()
+        self._credits = 0
+        # How many checksummed lines may be in flight at once. 1 is the
+        # classic ping-pong mode, larger values stream ahead into the
+        # firmware's serial buffer and rely on resends to recover errors.
+        self.window_size = 1
+        # Duplicate resend requests to ignore: in windowed mode every line
+        # that was in flight behind a bad one asks for the same resend
+        self._last_resend = -1
+        self._resend_swallow = 0
         # The printer has responded to the initial command and is active
         self.online = False
         # is a print currently running, true if printing, false if paused
-        self.printing = False
+        self._printing = False
         self.mainqueue = None
         self.priqueue = Queue(0)
         self.queueindex = 0
         self.lineno = 0
         self.resendfrom = -1
         self.paused = False
-        self.sentlines = {}
+        # Why the last print stopped before its end, None if it didn't
+        self.print_error = None
+        # Lines kept around for resend requests, at least twice the window
+        self.resend_history_size = 64
+        self.sentlines = ResendHistory(self.resend_history_size)
         self.log = deque(maxlen=10000)
-        self.sent = []
+        # Optional record of the last send_log_size commands written
+        self.sent = deque(maxlen=0)
         self.writefailures = 0
-        self.tempcb = None  # impl (wholeline)
-        self.recvcb = None  # impl (wholeline)
-        self.sendcb = None  # impl (wholeline)
-        self.preprintsendcb = None  # impl (wholeline)
-        self.printsendcb = None  # impl (wholeline)
-        self.layerchangecb = None  # impl (wholeline)
+        # Print lines are collected and written together, up to this many per
+        # write. The batch is flushed as soon as the sender has to wait on the
+        # firmware, or once its oldest line has been held for
+        # write_batch_latency seconds. 1 writes every line on its own.
+        self.write_batch_size = 1
+        self.write_batch_latency = 0.005
+        self._write_lock = threading.Lock()
+        self._write_buffer = bytearray()
+        self._write_buffer_lines = 0
+        self._write_buffer_since = 0
+        # Packs the lines written with MeatPack, for firmwares that unpack
+        # it: False writes them as they are, True packs them once the
+        # printer is online, and "auto" only if the firmware answered the
+        # MeatPack reset sent with the probes for it
+        self.meatpack = False
+        self._meatpack_state = None
+        self._packer = None
+        # Held while packing and writing, so packing can't start between the
+        # two
+        self._wire_lock = threading.Lock()
+        self._hooks = HookTable(self)
         self.errorcb = None  # impl (wholeline)
         self.startcb = None  # impl ()
         self.endcb = None  # impl ()
@@ -113,12 +305,45 @@ class printcore():
         self.loud = False  # emit sent and received lines to terminal
         self.tcp_streaming_mode = False
         self.greetings = ['start', 'Grbl ']
+        # Rebuilt from greetings whenever the read thread starts
+        self._classifier = ResponseClassifier(self.greetings)
         self.wait = 0  # default wait period for send(), send_now()
         self.read_thread = None
         self.stop_read_thread = False
+        # Reads replies as soon as they arrive where the platform supports
+        # waiting on the port's file descriptor, None otherwise
+        self._reader = None
+        self._pending_lines = deque()
+        self._read_error = None
         self.send_thread = None
         self.stop_send_thread = False
         self.print_thread = None
+        # Reactor doing this printer's I/O on its shared thread instead of
+        # the read, send and print threads, see connect
+        self.reactor = None
+        self._reactor_attached = False
+        self._reactor_printing = False
+        self._pumping = False
+        self._probe_timer = None
+        # Lines of the print queue rendered ahead of the sender
+        self.prerender_size = 32
+        self._rendered = deque()
+        # Whether every line of the print queue was rendered
+        self._queue_sent = False
+        self._render_index = 0
+        self._render_lineno = 0
+        # Layer of the line rendered last and the index where the next layer
+        # starts, so finding the layer of a line is a single compare
+        self._layers = None
+        self._layer = 0
+        self._layer_lines = None
+        self._layer_start = 0
+        self._next_layer_start = 0
+        # Layer of the line sent last
+        self._sent_layer = None
+        # How to look up lines of print queues streamed from a file, see
+        # StreamingGCode.line_at. None for GCode.
+        self._line_at = None
         self.event_handler = []
         for handler in self.event_handler:
             try:
@@ -130,6 +355,96 @@ class printcore():
         self.xy_feedrate = None
         self.z_feedrate = None
 
+    @property
+    def clear(self):
+        """True when the firmware is ready to accept another command"""
+        return self._credits > 0
+
+    @clear.setter
+    def clear(self, value):
+        with self._flow:
+            self._credits = self.window_size if value else 0
+            self._flow.notify_all()
+
+    @property
+    def send_log_size(self):
+        return self.sent.maxlen
+
+    @send_log_size.setter
+    def send_log_size(self, size):
+        self.sent = deque(self.sent, maxlen=size)
+
+    @property
+    def printing(self):
+        return self._printing
+
+    @property
+    def packing(self):
+        """True while the lines written are packed with MeatPack"""
+        return self._packer is not None
+
+    @printing.setter
+    def printing(self, value):
+        with self._flow:
+            self._printing = value
+            self._flow.notify_all()
+
+    def _grant_credit(self):
+        """Called when the firmware acknowledged a command, or when a claimed
+        credit ends up not being used"""
+        with self._flow:
+            if self._credits < self.window_size:
+                self._credits += 1
+            self._flow.notify_all()
+
+    def _outstanding(self):
+        """Number of commands sent that the firmware has not acknowledged"""
+        return self.window_size - self._credits
+
+    def _request_resend(self, lineno):
+        """Handles a resend request from the firmware"""
+        with self._flow:
+            if lineno == self._last_resend and self._resend_swallow > 0:
+                self._resend_swallow -= 1
+                return
+            self.resendfrom = lineno
+            self._last_resend = lineno
+            self._resend_swallow = max(0, self._outstanding() - 1)
+            self._flow.notify_all()
+
+    def _tail_pending(self):
+        """Whether the whole print queue was sent, but some of its last
+        lines wait for the firmware to acknowledge them and may still have
+        to be resent"""
+        return self._queue_sent and self.printing and self.resendfrom == -1 and self._outstanding() > 0
+
+    def _can_send(self):
+        return self._credits > 0 or not self.printer or not self.printing
+
+    def _wait_for_clear(self):
+        """Blocks until the firmware is ready for another command or the
+        print stops"""
+        with self._flow:
+            self._flow.wait_for(self._can_send)
+
+    def _take_credit(self):
+        """Like _wait_for_clear, but claims the credit for the command that is
+        about to be sent"""
+        with self._flow:
+            self._flow.wait_for(self._can_send)
+            if self._credits > 0:
+                self._credits -= 1
+
+    def _try_take_credit(self):
+        """Claims a credit like _sendnext does, without waiting for one.
+        Returns False if the firmware has no room."""
+        with self._flow:
+            if self._credits <= 0:
+                return False
+            if not self.printer_tcp or not self.tcp_streaming_mode:
+                self._credits -= 1
+            return True
+
     def addEventHandler(self, handler):
         '''
         Adds an event handler.
@@ -137,6 +452,11 @@ class printcore():
         @param handler: The handler to be added.
         '''
         self.event_handler.append(handler)
+        self._rebuild_hooks()
+
+    def _rebuild_hooks(self):
+        if "_hooks" in self.__dict__:
+            self._hooks = HookTable(self)
 
     def logError(self, error):
         for handler in self.event_handler:
@@ -157,6 +477,8 @@ class printcore():
         """Disconnects from printer and pauses the print
         """
         if self.printer:
+            if self._reactor_attached:
+                self.reactor.call(self._detach_reactor)
             if self.read_thread:
                 self.stop_read_thread = True
                 if threading.current_thread() != self.read_thread:
@@ -166,6 +488,9 @@ class printcore():
                 self.printing = False
                 self.print_thread.join()
             self._stop_sender()
+            self._stop_analyzer()
+            self._stop_packing()
+            self._close_reader()
             try:
                 self.printer.close()
             except socket.error:
@@ -209,6 +534,8 @@ class printcore():
                     except:
                         pass
             self.writefailures = 0
+            self._meatpack_state = None
+            self._packer = None
             if not is_serial:
                 self.printer_tcp = socket.socket(socket.AF_INET,
                                                  socket.SOCK_STREAM)
@@ -258,6 +585,9 @@ class printcore():
                     handler.on_connect()
                 except:
                     logging.error(traceback.format_exc())
+            if self.reactor is not None and self._attach_reactor():
+                return
+            self._open_reader()
             self.stop_read_thread = False
             self.read_thread = threading.Thread(target=self._listen)
             self.read_thread.start()
@@ -271,33 +601,182 @@ class printcore():
             time.sleep(0.2)
             self.printer.setDTR(0)
 
+    def _open_reader(self):
+        """Waits on the port's file descriptor where the platform allows it,
+        otherwise replies are read with the port's blocking readline"""
+        self._close_reader()
+        if platform.system() == "Windows":
+            return
+        fileobj = self.printer_tcp if self.printer_tcp else self.printer
+        try:
+            fileobj.fileno()
+        except Exception:
+            return
+        self._pending_lines.clear()
+        self._read_error = None
+        self._reader = SelectorReader()
+        self._reader.register(fileobj, self._pending_lines.append, self._reader_closed)
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _reader_closed(self, error):
+        self._read_error = error
+
+    def _attach_reactor(self):
+        """Hands the port over to the reactor. Returns False if it can't be
+        waited on, in which case the printer gets its own threads."""
+        fileobj = self.printer_tcp if self.printer_tcp else self.printer
+        if platform.system() == "Windows":
+            return False
+        try:
+            fileobj.fileno()
+        except Exception:
+            return False
+        self.clear = True
+        self._classifier = ResponseClassifier(self.greetings)
+        self.reactor.register(fileobj, self._reactor_line, self._reactor_closed)
+        self._reactor_attached = True
+        self.reactor.call_soon(self._probe)
+        return True
+
+    def _detach_reactor(self):
+        if self._probe_timer is not None:
+            self._probe_timer.cancel()
+            self._probe_timer = None
+        self.printing = False
+        self._pump()
+        self.reactor.unregister(self.printer_tcp if self.printer_tcp else self.printer)
+        self._reactor_attached = False
+
+    def _probe(self):
+        """Asks the printer for its temperatures until it answers, like
+        _listen_until_online does"""
+        self._probe_timer = None
+        if self.online or not self._reactor_attached:
+            return
+        self._send_probe()
+        if self.writefailures >= 4:
+            logging.error(_("Aborting connection attempt after 4 failed writes."))
+            return
+        self._probe_timer = self.reactor.call_later(ONLINE_PROBE_INTERVAL, self._probe)
+
+    def _reactor_line(self, line):
+        try:
+            line = line.decode('ascii')
+        except UnicodeDecodeError:
+            self.logError(_("Got rubbish reply from %s at baudrate %s:") % (self.port, self.baud) +
+                          "\n" + _("Maybe a bad baudrate?"))
+            return
+        self._received(line)
+        response = self._classifier.classify(line)
+        if not self.online:
+            if response.kind & MEATPACK:
+                self._meatpack_reported(line)
+            elif response.kind & (GREETING | OK | TEMP):
+                self._went_online()
+        else:
+            self._handle_reply(response)
+        self._pump()
+
+    def _reactor_closed(self, error):
+        self.logError(_("Can't read from printer (disconnected?) (OS Error {0}): {1}").format(error.errno,
+                                                                                          error.strerror))
+        self._reactor_attached = False
+        self.clear = True
+
+    def _wake(self):
+        """Has the reactor send whatever was just queued"""
+        if self._reactor_attached:
+            self.reactor.call_soon(self._pump)
+
+    def _pump(self):
+        """Sends everything the firmware has room for without blocking. This
+        is what the print and send threads do for printers on a reactor."""
+        if self._pumping or not self.printer:
+            return
+        self._pumping = True
+        try:
+            for _line in range(REACTOR_PUMP_LINES):
+                if self._reactor_printing and self.printing and self.online:
+                    if not self._try_take_credit():
+                        if self._prerender_allowed():
+                            self._render_ahead()
+                        break
+                    self._send_print_line()
+                    if self._tail_pending():
+                        break
+                elif not self.printing and not self.priqueue.empty():
+                    self._send(self.priqueue.get_nowait())
+                    self.priqueue.task_done()
+                else:
+                    break
+            else:
+                # Give the other printers a turn before sending more
+                self.reactor.call_soon(self._pump)
+            if self._reactor_printing and not self.printing:
+                self._reactor_printing = False
+                self._print_finished()
+            self._flush_writes()
+        except:
+            self.logError(_("Print thread died due to the following error:") +
+                          "\n" + traceback.format_exc())
+        finally:
+            self._pumping = False
+
+    @staticmethod
+    def _has_lines(gcode):
+        """Whether there is anything to print in gcode. The first line of a
+        print streamed from a file may be long gone, so it is only looked at
+        before any has been read."""
+        return gcode is not None and (len(gcode) > 0 or gcode.has_index(0))
+
+    def _start_reactor_print(self, resuming, send_m110):
+        if send_m110:
+            self._send("M110", -1, True)
+        if not self._has_lines(self.mainqueue):
+            return
+        self._print_started(resuming)
+        self._reactor_printing = True
+        self._pump()
+
+    def _read_raw_line(self):
+        """Returns the next line from the printer as bytes, b"" if nothing
+        arrived in time, or None once the printer can't be read anymore"""
+        if self._reader is None:
+            line = self.printer.readline()
+            if self.printer_tcp and not line:
+                raise OSError(-1, "Read EOF from socket")
+            return line
+        pending = self._pending_lines
+        if not pending and self._read_error is None:
+            self._reader.poll(0.25)
+        if pending:
+            return pending.popleft()
+        if self._read_error is not None:
+            e = self._read_error
+            self.logError(_("Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
+            return None
+        return b""
+
     def _readline(self):
         try:
             try:
                 try:
-                    line = self.printer.readline().decode('ascii')
+                    line = self._read_raw_line()
+                    if line is None:
+                        return None
+                    line = line.decode('ascii')
                 except UnicodeDecodeError:
                     self.logError(_("Got rubbish reply from %s at baudrate %s:") % (self.port, self.baud) +
                                   "\n" + _("Maybe a bad baudrate?"))
                     return None
-                if self.printer_tcp and not line:
-                    raise OSError(-1, "Read EOF from socket")
             except socket.timeout:
                 return ""
 
-            if len(line) > 1:
-                self.log.append(line)
-                for handler in self.event_handler:
-                    try:
-                        handler.on_recv(line)
-                    except:
-                        logging.error(traceback.format_exc())
-                if self.recvcb:
-                    try:
-                        self.recvcb(line)
-                    except:
-                        self.logError(traceback.format_exc())
-                if self.loud: logging.info("RECV: %s" % line.rstrip())
+            self._received(line)
             return line
         except SelectError as e:
             if 'Bad file descriptor' in e.args[1]:
@@ -323,6 +802,13 @@ class printcore():
             self.logError(_("Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
             return None
 
+    def _received(self, line):
+        if len(line) > 1:
+            self.log.append(line)
+            if self._hooks.recv:
+                dispatch(self._hooks.recv, line)
+            if self.loud: logging.info("RECV: %s" % line.rstrip())
+
     def _listen_can_continue(self):
         if self.printer_tcp:
             return not self.stop_read_thread and self.printer
@@ -332,7 +818,7 @@ class printcore():
 
     def _listen_until_online(self):
         while not self.online and self._listen_can_continue():
-            self._send("M105")
+            self._send_probe()
             if self.writefailures >= 4:
                 logging.error(_("Aborting connection attempt after 4 failed writes."))
                 return
@@ -352,67 +838,96 @@ class printcore():
                 if not line:
                     empty_lines += 1
                     if empty_lines == 15: break
-                else:
-                    empty_lines = 0
-                if line.startswith(tuple(self.greetings)) \
-                        or line.startswith('ok') or "T:" in line:
-                    self.online = True
-                    for handler in self.event_handler:
-                        try:
-                            handler.on_online()
-                        except:
-                            logging.error(traceback.format_exc())
-                    if self.onlinecb:
-                        try:
-                            self.onlinecb()
-                        except:
-                            self.logError(traceback.format_exc())
+                    continue
+                empty_lines = 0
+                kind = self._classifier.classify(line).kind
+                if kind & MEATPACK:
+                    self._meatpack_reported(line)
+                elif kind & (GREETING | OK | TEMP):
+                    self._went_online()
                     return
 
+    def _send_probe(self):
+        """Asks the printer for its temperatures, to find out when it is
+        online"""
+        if self.meatpack and not self.printer_tcp:
+            # Firmwares with MeatPack answer with their state, and unpack
+            # nothing until told to, whatever the last connection left them
+            # doing. Others take it as the start of the M105 line.
+            self._write_wire(meatpack.command(meatpack.RESET_ALL))
+        self._send("M105")
+
+    def _meatpack_reported(self, line):
+        self._meatpack_state = meatpack.parse_state(line)
+
+    def _start_packing(self):
+        """Has the firmware unpack what is written from now on, and packs
+        it"""
+        with self._wire_lock:
+            self._write_wire(meatpack.command(meatpack.ENABLE_PACKING) +
+                             meatpack.command(meatpack.ENABLE_NO_SPACES))
+            self._packer = meatpack.MeatPacker(no_spaces=True)
+
+    def _stop_packing(self):
+        """Leaves the firmware unpacking nothing, for whoever connects next"""
+        with self._wire_lock:
+            if self._packer is not None:
+                self._packer = None
+                self._write_wire(meatpack.command(meatpack.DISABLE_PACKING))
+
+    def _went_online(self):
+        if self.meatpack and not self.printer_tcp and \
+                (self.meatpack != "auto" or self._meatpack_state is not None):
+            self._start_packing()
+        self.online = True
+        for handler in self.event_handler:
+            try:
+                handler.on_online()
+            except:
+                logging.error(traceback.format_exc())
+        if self.onlinecb:
+            try:
+                self.onlinecb()
+            except:
+                self.logError(traceback.format_exc())
+
     def _listen(self):
         """This function acts on messages from the firmware
         """
         self.clear = True
+        self._classifier = ResponseClassifier(self.greetings)
         if not self.printing:
             self._listen_until_online()
+        classify = self._classifier.classify
         while self._listen_can_continue():
             line = self._readline()
             if line is None:
                 break
-            if line.startswith('DEBUG_'):
-                continue
-            if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
-                self.clear = True
-            if line.startswith('ok') and "T:" in line:
-                for handler in self.event_handler:
-                    try:
-                        handler.on_temp(line)
-                    except:
-                        logging.error(traceback.format_exc())
-            if line.startswith('ok') and "T:" in line and self.tempcb:
-                # callback for temp, status, whatever
-                try:
-                    self.tempcb(line)
-                except:
-                    self.logError(traceback.format_exc())
-            elif line.startswith('Error'):
-                self.logError(line)
-            # Teststrings for resend parsing       # Firmware     exp. result
-            # line="rs N2 Expected checksum 67"    # Teacup       2
-            if line.lower().startswith("resend") or line.startswith("rs"):
-                for haystack in ["N:", "N", ":"]:
-                    line = line.replace(haystack, " ")
-                linewords = line.split()
-                while len(linewords) != 0:
-                    try:
-                        toresend = int(linewords.pop(0))
-                        self.resendfrom = toresend
-                        break
-                    except:
-                        pass
-                self.clear = True
+            if line:
+                self._handle_reply(classify(line))
         self.clear = True
 
+    def _handle_reply(self, response):
+        """Acts on a single classified reply from the firmware"""
+        kind = response.kind
+        if kind & DEBUG:
+            return
+        if kind & MEATPACK:
+            self._meatpack_reported(response.line)
+            return
+        if kind & (GREETING | OK):
+            self._grant_credit()
+        if kind & OK_TEMP == OK_TEMP:
+            # callback for temp, status, whatever
+            if self._hooks.temp:
+                dispatch(self._hooks.temp, response.line)
+        elif kind & ERROR:
+            self.logError(response.line)
+        if kind & RESEND and response.resend is not None:
+            # The "ok" that follows the resend request returns the credit.
+            # Granting one here as well would put a second line in flight.
+            self._request_resend(response.resend)
+
     def _start_sender(self):
         self.stop_send_thread = False
         self.send_thread = threading.Thread(target=self._sender)
@@ -420,24 +935,53 @@ class printcore():
 
     def _stop_sender(self):
         if self.send_thread:
-            self.stop_send_thread = True
+            with self._flow:
+                self.stop_send_thread = True
+                self._flow.notify_all()
             self.send_thread.join()
             self.send_thread = None
 
+    def _sender_can_send(self):
+        return self.stop_send_thread or self._can_send()
+
     def _sender(self):
         while not self.stop_send_thread:
             try:
                 command = self.priqueue.get(True, 0.1)
             except QueueEmpty:
                 continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            with self._flow:
+                self._flow.wait_for(self._sender_can_send)
             self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            with self._flow:
+                self._flow.wait_for(self._sender_can_send)
+
+    def _start_analyzer(self):
+        self.analyzer_thread = threading.Thread(target=self._analyze, daemon=True)
+        self.analyzer_thread.start()
+
+    def _stop_analyzer(self):
+        if self.analyzer_thread:
+            self._analyzer_queue.put_nowait(None)
+            self.analyzer_thread.join()
+            self.analyzer_thread = None
+
+    def _analyze(self):
+        """Runs sent commands through the analyzer"""
+        while True:
+            command = self._analyzer_queue.get()
+            try:
+                if command is None:
+                    return
+                self.analyzer.append(command, store=False)
+            except:
+                logging.warning(_("Could not analyze command %s:") % command +
+                                "\n" + traceback.format_exc())
+            finally:
+                self._analyzer_queue.task_done()
 
     def _checksum(self, command):
-        return reduce(lambda x, y: x ^ y, map(ord, command))
+        return checksum(command.encode('ascii'))
 
     def startprint(self, gcode, startindex=0):
         """Start a print, gcode is an array of gcode commands.
@@ -451,13 +995,24 @@ class printcore():
         self.queueindex = startindex
         self.mainqueue = gcode
         self.printing = True
+        self.print_error = None
         self.lineno = 0
         self.resendfrom = -1
+        self._last_resend = -1
+        self._resend_swallow = 0
+        self.sentlines = ResendHistory(max(self.resend_history_size, 2 * self.window_size))
+        # Account for the M110 before sending it, its ok may arrive right away
+        has_lines = self._has_lines(gcode)
+        if has_lines:
+            with self._flow:
+                self._credits = self.window_size - 1
+        resuming = (startindex != 0)
+        if self._reactor_attached:
+            self.reactor.call_soon(self._start_reactor_print, resuming, True)
+            return True
         self._send("M110", -1, True)
-        if not gcode or not gcode.lines:
+        if not has_lines:
             return True
-        self.clear = False
-        resuming = (startindex != 0)
         self.print_thread = threading.Thread(target=self._print,
                                              kwargs={"resuming": resuming})
         self.print_thread.start()
@@ -483,27 +1038,35 @@ class printcore():
             pass
 
     def pause(self):
-        """Pauses the print, saving the current position.
+        """Pauses the print, saving the current position if analyze is set.
         """
         if not self.printing: return False
         self.paused = True
         self.printing = False
 
-        # try joining the print thread: enclose it in try/except because we
-        # might be calling it from the thread itself
-        try:
-            self.print_thread.join()
-        except RuntimeError as e:
-            if e.message == "cannot join current thread":
-                pass
-            else:
+        if self._reactor_attached:
+            # Lets the reactor wrap up the print
+            self.reactor.call(self._pump)
+        else:
+            # try joining the print thread: enclose it in try/except because
+            # we might be calling it from the thread itself
+            try:
+                self.print_thread.join()
+            except RuntimeError as e:
+                if e.message == "cannot join current thread":
+                    pass
+                else:
+                    self.logError(traceback.format_exc())
+            except:
                 self.logError(traceback.format_exc())
-        except:
-            self.logError(traceback.format_exc())
 
         self.print_thread = None
 
-        # saves the status
+        if not self.analyze:
+            return
+
+        # saves the status, once the analyzer caught up with what was sent
+        self._analyzer_queue.join()
         self.pauseX = self.analyzer.abs_x
         self.pauseY = self.analyzer.abs_y
         self.pauseZ = self.analyzer.abs_z
@@ -515,7 +1078,7 @@ class printcore():
         """Resumes a paused print.
         """
         if not self.paused: return False
-        if self.paused:
+        if self.analyze:
             # restores the status
             self.send_now("G90")  # go to absolute coordinates
 
@@ -538,6 +1101,9 @@ class printcore():
 
         self.paused = False
         self.printing = True
+        if self._reactor_attached:
+            self.reactor.call_soon(self._start_reactor_print, True, False)
+            return
         self.print_thread = threading.Thread(target=self._print,
                                              kwargs={"resuming": True})
         self.print_thread.start()
@@ -551,6 +1117,7 @@ class printcore():
                 self.mainqueue.append(command)
             else:
                 self.priqueue.put_nowait(command)
+                self._wake()
         else:
             self.logError(_("Not connected to printer."))
 
@@ -559,173 +1126,340 @@ class printcore():
         checksum"""
         if self.online:
             self.priqueue.put_nowait(command)
+            self._wake()
         else:
             self.logError(_("Not connected to printer."))
 
     def _print(self, resuming=False):
         self._stop_sender()
         try:
-            for handler in self.event_handler:
-                try:
-                    handler.on_start(resuming)
-                except:
-                    logging.error(traceback.format_exc())
-            if self.startcb:
-                # callback for printing started
-                try:
-                    self.startcb(resuming)
-                except:
-                    self.logError(_("Print start callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            self._print_started(resuming)
             while self.printing and self.printer and self.online:
                 self._sendnext()
-            self.sentlines = {}
-            self.log.clear()
-            self.sent = []
-            for handler in self.event_handler:
-                try:
-                    handler.on_end()
-                except:
-                    logging.error(traceback.format_exc())
-            if self.endcb:
-                # callback for printing done
-                try:
-                    self.endcb()
-                except:
-                    self.logError(_("Print end callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            self._print_finished()
         except:
             self.logError(_("Print thread died due to the following error:") +
                           "\n" + traceback.format_exc())
         finally:
+            self._flush_writes()
             self.print_thread = None
             self._start_sender()
 
+    def _print_started(self, resuming):
+        self._reset_render()
+        for handler in self.event_handler:
+            try:
+                handler.on_start(resuming)
+            except:
+                logging.error(traceback.format_exc())
+        if self.startcb:
+            # callback for printing started
+            try:
+                self.startcb(resuming)
+            except:
+                self.logError(_("Print start callback failed with:") +
+                              "\n" + traceback.format_exc())
+
+    def _print_finished(self):
+        self._rendered.clear()
+        self.sentlines.clear()
+        self.log.clear()
+        self.sent.clear()
+        for handler in self.event_handler:
+            try:
+                handler.on_end()
+            except:
+                logging.error(traceback.format_exc())
+        if self.endcb:
+            # callback for printing done
+            try:
+                self.endcb()
+            except:
+                self.logError(_("Print end callback failed with:") +
+                              "\n" + traceback.format_exc())
+
     def process_host_command(self, command):
         """only ;@pause command is implemented as a host command in printcore, but hosts are free to reimplement this method"""
         command = command.lstrip()
         if command.startswith(";@pause"):
             self.pause()
 
+    def _prerender_allowed(self):
+        """Lines can only be rendered ahead of time when nobody wants to
+        inspect or replace them right before they are sent"""
+        return not self._hooks.preprintsend and not self.preprintsendcb
+
+    def _reset_render(self):
+        self._rendered.clear()
+        self._queue_sent = False
+        self._render_index = self.queueindex
+        self._render_lineno = self.lineno
+        self._next_layer_start = 0
+        self._line_at = getattr(self.mainqueue, "line_at", None)
+        if not self.queueindex:
+            self._sent_layer = None
+        elif self._line_at is not None:
+            self._sent_layer = self._line_at(self.queueindex - 1)[0]
+        else:
+            self._seek_layer(self.queueindex - 1)
+            self._sent_layer = self._layer
+
+    def _seek_layer(self, index):
+        """Moves the layer cursor to the layer holding line index"""
+        layers = self._layers
+        if layers is None or layers.gcode is not self.mainqueue:
+            layers = self._layers = LayerIndex(self.mainqueue)
+        position = layers.find(index)
+        self._layer = layers.layers[position]
+        self._layer_lines = self.mainqueue.all_layers[self._layer]
+        self._layer_start = layers.starts[position]
+        if position + 1 < len(layers):
+            self._next_layer_start = layers.starts[position + 1]
+        else:
+            self._next_layer_start = sys.maxsize
+
+    def _next_print_line(self):
+        """Looks up the next line of the print queue that needs rendering"""
+        index = self._render_index
+        if self._line_at is not None:
+            line = self._line_at(index)
+            if line is None:
+                return None
+            self._render_index = index + 1
+            return index, line[0], line[1]
+        if index >= len(self.mainqueue):
+            return None
+        self._render_index = index + 1
+        if index >= self._next_layer_start or index < self._layer_start:
+            self._seek_layer(index)
+        return index, self._layer, self._layer_lines[index - self._layer_start]
+
+    def print_progress(self):
+        """Returns the fraction of the print queue sent so far"""
+        mainqueue = self.mainqueue
+        if mainqueue is None:
+            return 0.0
+        progress = getattr(mainqueue, "progress", None)
+        if progress is not None:
+            return progress(self.queueindex)
+        return float(self.queueindex) / len(mainqueue) if len(mainqueue) else 0.0
+
+    def layer_progress(self):
+        """Returns the number of the layer being printed, counting from 1, and
+        the number of layers of the print. The number of layers of a print
+        streamed from a file isn't known until it is done, it is None."""
+        if not self._has_lines(self.mainqueue):
+            return 0, 0
+        if getattr(self.mainqueue, "line_at", None) is not None:
+            return (self._sent_layer or 0) + 1, getattr(self.mainqueue, "layer_count", None)
+        layers = self._layers
+        if layers is None or layers.gcode is not self.mainqueue:
+            layers = self._layers = LayerIndex(self.mainqueue)
+        return min(layers.find(self.queueindex) + 1, layers.count), layers.count
+
+    def _render(self, index, layer, gline):
+        """Prepares a line of the print queue for sending.
+
+        Returns a tuple of (queue index, layer, gline, line number, command,
+        wire bytes, keep for resends). Host commands only have a command, and
+        lines that end up not being sent have neither.
+        """
+        if self._hooks.preprintsend:
+            dispatch(self._hooks.preprintsend, gline, index, self.mainqueue)
+        if self.preprintsendcb:
+            if not self.mainqueue.has_index(index + 1):
+                next_gline = None
+            elif self._line_at is not None:
+                next_gline = self._line_at(index + 1)[1]
+            else:
+                (next_layer, next_line) = self.mainqueue.idxs(index + 1)
+                next_gline = self.mainqueue.all_layers[next_layer][next_line]
+            gline = self.preprintsendcb(gline, next_gline)
+        if gline is None:
+            return index, layer, None, None, None, None, False
+        tline = gline.raw
+        if tline.lstrip().startswith(";@"):  # check for host command
+            return index, layer, gline, None, tline, None, False
+
+        # Strip comments
+        tline = gcoder.strip_comments(tline)
+        if not tline:
+            return index, layer, gline, None, None, None, False
+        lineno = self._render_lineno
+        self._render_lineno += 1
+        # Only add checksums if over serial (tcp does the flow control itself)
+        if self.printer_tcp:
+            return index, layer, gline, lineno, tline, (tline + "\n").encode('ascii'), False
+        return index, layer, gline, lineno, None, frame(tline.encode('ascii'), lineno), "M110" not in tline
+
+    def _render_ahead(self):
+        """Fills the buffer of ready to write lines while waiting on the
+        firmware, so sending the next line is just a write"""
+        rendered = self._rendered
+        while len(rendered) < self.prerender_size:
+            item = self._next_print_line()
+            if item is None:
+                break
+            rendered.append(self._render(*item))
+
+    def _check_layerchange(self, index, layer):
+        if layer == self._sent_layer:
+            return
+        self._sent_layer = layer
+        if index and self._hooks.layerchange:
+            dispatch(self._hooks.layerchange, layer)
+
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
+        if not self._can_send():
+            # Everything batched so far has to reach the firmware before it
+            # can answer
+            self._flush_writes()
+            if self._prerender_allowed() and self.printing:
+                self._render_ahead()
         # Only wait for oks when using serial connections or when not using tcp
         # in streaming mode
         if not self.printer_tcp or not self.tcp_streaming_mode:
-            self.clear = False
+            self._take_credit()
+        else:
+            self._wait_for_clear()
+        self._send_print_line()
+        if self._tail_pending():
+            self._flush_writes()
+            with self._flow:
+                self._flow.wait_for(lambda: not self._tail_pending() or not self.printer)
+
+    def _send_print_line(self):
+        """Sends the next line of the print, once _sendnext claimed the
+        credit for it"""
         if not (self.printing and self.printer and self.online):
-            self.clear = True
+            self._grant_credit()
             return
         if self.resendfrom < self.lineno and self.resendfrom > -1:
-            self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
+            try:
+                data = self.sentlines[self.resendfrom]
+            except ResendOutOfRange as e:
+                # Nothing sensible can be sent anymore, stop the print
+                self.logError(str(e))
+                self.print_error = str(e)
+                self.resendfrom = -1
+                self.printing = False
+                self._grant_credit()
+                return
+            self._transmit(data, batch=True)
             self.resendfrom += 1
             return
         self.resendfrom = -1
         if not self.priqueue.empty():
-            self._send(self.priqueue.get_nowait())
+            self._send(self.priqueue.get_nowait(), batch=True)
             self.priqueue.task_done()
             return
-        if self.printing and self.queueindex < len(self.mainqueue):
-            (layer, line) = self.mainqueue.idxs(self.queueindex)
-            gline = self.mainqueue.all_layers[layer][line]
-            if self.queueindex > 0:
-                (prev_layer, prev_line) = self.mainqueue.idxs(self.queueindex - 1)
-                if prev_layer != layer:
-                    for handler in self.event_handler:
-                        try:
-                            handler.on_layerchange(layer)
-                        except:
-                            logging.error(traceback.format_exc())
-            if self.layerchangecb and self.queueindex > 0:
-                (prev_layer, prev_line) = self.mainqueue.idxs(self.queueindex - 1)
-                if prev_layer != layer:
-                    try:
-                        self.layerchangecb(layer)
-                    except:
-                        self.logError(traceback.format_exc())
-            for handler in self.event_handler:
-                try:
-                    handler.on_preprintsend(gline, self.queueindex, self.mainqueue)
-                except:
-                    logging.error(traceback.format_exc())
-            if self.preprintsendcb:
-                if self.queueindex + 1 < len(self.mainqueue):
-                    (next_layer, next_line) = self.mainqueue.idxs(self.queueindex + 1)
-                    next_gline = self.mainqueue.all_layers[next_layer][next_line]
-                else:
-                    next_gline = None
-                gline = self.preprintsendcb(gline, next_gline)
-            if gline is None:
-                self.queueindex += 1
-                self.clear = True
-                return
-            tline = gline.raw
-            if tline.lstrip().startswith(";@"):  # check for host command
-                self.process_host_command(tline)
-                self.queueindex += 1
-                self.clear = True
+        if self._rendered:
+            entry = self._rendered.popleft()
+            self._check_layerchange(entry[0], entry[1])
+        else:
+            item = self._next_print_line()
+            if item is None:
+                self._queue_sent = True
+                if self._outstanding() > 1:
+                    # The lines still in flight may have to be resent, so the
+                    # line numbers are only reset once they are acknowledged
+                    self._grant_credit()
+                    return
+                self.printing = False
+                self._grant_credit()
+                if not self.paused:
+                    self.queueindex = 0
+                    self.lineno = 0
+                    self._send("M110", -1, True)
                 return
+            self._check_layerchange(item[0], item[1])
+            entry = self._render(*item)
+        (index, layer, gline, lineno, command, data, keep) = entry
+        if data is None:
+            if command is not None:
+                self.process_host_command(command)
+            self.queueindex = index + 1
+            self._grant_credit()
+            return
+        if keep:
+            self.sentlines[lineno] = data
+        self._transmit(data, command, batch=True)
+        self.lineno = lineno + 1
+        if self._hooks.printsend:
+            dispatch(self._hooks.printsend, gline)
+        self.queueindex = index + 1
 
-            # Strip comments
-            tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
-            if tline:
-                self._send(tline, self.lineno, True)
-                self.lineno += 1
-                for handler in self.event_handler:
-                    try:
-                        handler.on_printsend(gline)
-                    except:
-                        logging.error(traceback.format_exc())
-                if self.printsendcb:
-                    try:
-                        self.printsendcb(gline)
-                    except:
-                        self.logError(traceback.format_exc())
-            else:
-                self.clear = True
-            self.queueindex += 1
-        else:
-            self.printing = False
-            self.clear = True
-            if not self.paused:
-                self.queueindex = 0
-                self.lineno = 0
-                self._send("M110", -1, True)
-
-    def _send(self, command, lineno=0, calcchecksum=False):
+    def _send(self, command, lineno=0, calcchecksum=False, batch=False):
         # Only add checksums if over serial (tcp does the flow control itself)
         if calcchecksum and not self.printer_tcp:
-            prefix = "N" + str(lineno) + " " + command
-            command = prefix + "*" + str(self._checksum(prefix))
+            data = frame(command.encode('ascii'), lineno)
             if "M110" not in command:
-                self.sentlines[lineno] = command
+                self.sentlines[lineno] = data
+            self._transmit(data, batch=batch)
+        else:
+            self._transmit((command + "\n").encode('ascii'), command, batch)
+
+    def _transmit(self, data, command=None, batch=False):
+        """Writes an already framed line to the printer. command is the text
+        of the line, which is only decoded from data when needed. Lines sent
+        with batch may be held back and written together with the next ones,
+        see write_batch_size."""
         if self.printer:
+            if command is None and (self.sent.maxlen or self.analyze or self.loud
+                                    or self._hooks.send):
+                command = data[:-1].decode('ascii')
             self.sent.append(command)
-            # run the command through the analyzer
-            gline = None
-            try:
-                gline = self.analyzer.append(command, store=False)
-            except:
-                logging.warning(_("Could not analyze command %s:") % command +
-                                "\n" + traceback.format_exc())
+            if self.analyze:
+                if self.analyzer_thread is None:
+                    self._start_analyzer()
+                self._analyzer_queue.put_nowait(command)
             if self.loud:
                 logging.info("SENT: %s" % command)
 
-            for handler in self.event_handler:
-                try:
-                    handler.on_send(command, gline)
-                except:
-                    logging.error(traceback.format_exc())
-            if self.sendcb:
-                try:
-                    self.sendcb(command, gline)
-                except:
-                    self.logError(traceback.format_exc())
+            # The analyzer runs behind the sender, so there is no parsed line
+            # to hand to the callbacks
+            if self._hooks.send:
+                dispatch(self._hooks.send, command, None)
+            if batch and self.write_batch_size > 1:
+                self._queue_write(data)
+            else:
+                self._flush_writes()
+                self._write(data)
+
+    def _queue_write(self, data):
+        with self._write_lock:
+            if not self._write_buffer_lines:
+                self._write_buffer_since = time.monotonic()
+            self._write_buffer += data
+            self._write_buffer_lines += 1
+            full = self._write_buffer_lines >= self.write_batch_size or \
+                time.monotonic() - self._write_buffer_since >= self.write_batch_latency
+        if full:
+            self._flush_writes()
+
+    def _flush_writes(self):
+        """Writes out the lines batched so far"""
+        with self._write_lock:
+            if not self._write_buffer_lines:
+                return
+            data = bytes(self._write_buffer)
+            del self._write_buffer[:]
+            self._write_buffer_lines = 0
+        self._write(data)
+
+    def _write(self, data):
+        """Writes framed lines to the printer, packed if packing is on"""
+        with self._wire_lock:
+            if self._packer is not None:
+                data = self._packer.pack(data)
+            self._write_wire(data)
+
+    def _write_wire(self, data):
+        if self.printer:
             try:
-                self.printer.write((command + "\n").encode('ascii'))
+                self.printer.write(data)
                 if self.printer_tcp:
                     try:
                         self.printer.flush()
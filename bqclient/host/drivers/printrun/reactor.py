@@ -0,0 +1,163 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+from bqclient.host.drivers.printrun.reader import SelectorReader
+
+
+class Timer(object):
+    __slots__ = ('when', 'function', 'args', 'cancelled')
+
+    def __init__(self, when, function, args):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor(object):
+    """A single thread doing the I/O of any number of printcore instances.
+
+    Replies from every registered port are handed to their callbacks as soon
+    as they arrive, and everything else that has to happen on the reactor
+    thread is queued with call_soon, call or call_later. The thread is
+    started by the first call and runs until stop()."""
+
+    def __init__(self):
+        self._reader = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._wake_read = None
+        self._wake_write = None
+        self._stop = False
+
+    def _start(self):
+        self._reader = SelectorReader()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._reader.register(self._wake_read, lambda line: None, lambda error: None)
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="printcore reactor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stop = True
+            self._wake()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def in_reactor(self):
+        return threading.current_thread() is self._thread
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b"\n")
+        except BlockingIOError:
+            # The reactor has plenty of wake ups pending already
+            pass
+
+    def call_soon(self, function, *args):
+        """Runs function on the reactor thread"""
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            self._calls.append((function, args))
+            self._wake()
+
+    def call(self, function, *args):
+        """Runs function on the reactor thread and returns its result once it
+        is done"""
+        if self.in_reactor():
+            return function(*args)
+        done = threading.Event()
+        result = []
+
+        def _call():
+            try:
+                result.append(function(*args))
+            finally:
+                done.set()
+
+        self.call_soon(_call)
+        done.wait()
+        return result[0] if result else None
+
+    def call_later(self, delay, function, *args):
+        """Runs function on the reactor thread after delay seconds. Returns a
+        Timer that can be cancelled."""
+        timer = Timer(time.monotonic() + delay, function, args)
+        self.call_soon(self._add_timer, timer)
+        return timer
+
+    def _add_timer(self, timer):
+        heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+
+    def register(self, fileobj, on_line, on_close):
+        """Starts handing lines read from fileobj to on_line. See
+        SelectorReader.register."""
+        self.call(lambda: self._reader.register(fileobj, on_line, on_close))
+
+    def unregister(self, fileobj):
+        if self._thread is not None:
+            self.call(lambda: self._reader.unregister(fileobj))
+
+    def _run_safely(self, function, args):
+        try:
+            function(*args)
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def _run(self):
+        while not self._stop:
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.monotonic())
+            try:
+                self._reader.poll(timeout)
+            except Exception:
+                logging.error(traceback.format_exc())
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)[2]
+                if not timer.cancelled:
+                    self._run_safely(timer.function, timer.args)
+            while self._calls:
+                function, args = self._calls.popleft()
+                self._run_safely(function, args)
+        with self._lock:
+            self._reader.close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            self._reader = None
+            self._thread = None
@@ -0,0 +1,98 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import selectors
+
+READ_SIZE = 4096
+
+
+class LineSplitter(object):
+    """Splits a byte stream into lines, keeping partial lines in a single
+    reusable buffer until the rest of them arrives"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Adds data to the buffer and returns the complete lines, newline
+        included"""
+        buffer = self._buffer
+        start = len(buffer)
+        buffer += data
+        end = buffer.find(b"\n", start)
+        if end < 0:
+            return []
+        lines = []
+        start = 0
+        while end >= 0:
+            lines.append(bytes(buffer[start:end + 1]))
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        del buffer[:start]
+        return lines
+
+    def clear(self):
+        del self._buffer[:]
+
+
+class SelectorReader(object):
+    """Waits on any number of serial ports or sockets at once and hands every
+    complete line to the callback registered for its port as soon as it
+    arrives"""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, on_line, on_close):
+        """on_line is called with each line as bytes. on_close is called with
+        an OSError once the port can't be read from anymore, after which the
+        port is unregistered."""
+        self._selector.register(fileobj, selectors.EVENT_READ, (LineSplitter(), on_line, on_close))
+
+    def unregister(self, fileobj):
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def __len__(self):
+        return len(self._selector.get_map())
+
+    def poll(self, timeout=None):
+        """Waits up to timeout seconds for data and dispatches it. Returns
+        True if anything was read."""
+        events = self._selector.select(timeout)
+        for key, _ in events:
+            splitter, on_line, on_close = key.data
+            try:
+                data = os.read(key.fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                self.unregister(key.fileobj)
+                on_close(e)
+                continue
+            if not data:
+                self.unregister(key.fileobj)
+                on_close(OSError(errno.EPIPE, "Read EOF from printer"))
+                continue
+            for line in splitter.feed(data):
+                on_line(line)
+        return bool(events)
+
+    def close(self):
+        self._selector.close()
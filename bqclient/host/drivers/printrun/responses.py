@@ -0,0 +1,107 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Kinds of firmware replies. These are bit flags so a temperature report
+# riding on an "ok" is OK | TEMP.
+OTHER = 0
+OK = 1 << 0
+TEMP = 1 << 1
+RESEND = 1 << 2
+ERROR = 1 << 3
+BUSY = 1 << 4
+ECHO = 1 << 5
+GREETING = 1 << 6
+DEBUG = 1 << 7
+# The state a firmware with MeatPack reports, see meatpack
+MEATPACK = 1 << 8
+
+OK_TEMP = OK | TEMP
+
+
+class Response(object):
+    """A classified line received from the firmware"""
+
+    __slots__ = ('kind', 'line', 'resend')
+
+    def __init__(self, kind, line, resend=None):
+        self.kind = kind
+        self.line = line
+        # Line number the firmware asked for, for RESEND replies
+        self.resend = resend
+
+    def __repr__(self):
+        return "Response(%d, %r, %r)" % (self.kind, self.line, self.resend)
+
+
+def parse_resend(line):
+    """Finds the line number in a resend request"""
+    # Teststrings for resend parsing       # Firmware     exp. result
+    # line="rs N2 Expected checksum 67"    # Teacup       2
+    for haystack in ["N:", "N", ":"]:
+        line = line.replace(haystack, " ")
+    for word in line.split():
+        try:
+            return int(word)
+        except ValueError:
+            pass
+    return None
+
+
+class ResponseClassifier(object):
+    """Classifies firmware replies with a table keyed on their first
+    character, so each line costs a dictionary lookup and a couple of
+    startswith calls.
+
+    This is plain Python, there is no compiled version: a reply is only
+    looked at by a few string methods, and the Response record is most of
+    what is left of the cost."""
+
+    prefixes = [
+        ("DEBUG_", DEBUG),
+        ("ok", OK),
+        ("Error", ERROR),
+        ("echo:busy", BUSY),
+        ("busy", BUSY),
+        ("echo", ECHO),
+        ("rs", RESEND),
+        ("[MP]", MEATPACK),
+    ]
+
+    def __init__(self, greetings):
+        table = {}
+        for prefix, kind in self.prefixes + [(greeting, GREETING) for greeting in greetings]:
+            table.setdefault(prefix[0], []).append((prefix, kind))
+        # Resend requests are matched regardless of case
+        for first in "rR":
+            table.setdefault(first, []).append((None, RESEND))
+        self._table = {first: tuple(candidates) for first, candidates in table.items()}
+
+    def classify(self, line):
+        kind = OTHER
+        candidates = self._table.get(line[:1])
+        if candidates is not None:
+            for prefix, candidate in candidates:
+                if prefix is None:
+                    if line[:6].lower() == "resend":
+                        kind = candidate
+                        break
+                elif line.startswith(prefix):
+                    kind = candidate
+                    break
+        if "T:" in line:
+            kind |= TEMP
+        if kind & RESEND:
+            return Response(kind, line, parse_resend(line))
+        return Response(kind, line)
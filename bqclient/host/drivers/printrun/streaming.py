@@ -0,0 +1,172 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+from array import array
+from collections import deque
+
+from bqclient.host.drivers.printrun import gcoder
+
+
+class Chunk(object):
+    __slots__ = ('start', 'lines', 'layers', 'offsets')
+
+    def __init__(self, start):
+        self.start = start
+        self.lines = []
+        # Layer of every line and the position in the file it starts at
+        self.layers = array('I')
+        self.offsets = array('Q')
+
+    @property
+    def end(self):
+        return self.start + len(self.lines)
+
+
+class LayerCounter(object):
+    """Parses lines for their position a batch at a time, like GCode does
+    while loading, and counts their layers as it goes: a new layer starts
+    with the first extruding move at a height other than the current
+    layer's, so Z hops don't count."""
+
+    def __init__(self):
+        self._state = gcoder.GCode(deferred=True)
+        self.layer = 0
+        self._layer_z = None
+
+    def count(self, lines, layers):
+        """Appends the layer of every one of lines to layers"""
+        self._state._preprocess(lines)
+        for line in lines:
+            if line.extruding and line.current_z != self._layer_z:
+                if self._layer_z is not None:
+                    self.layer += 1
+                self._layer_z = line.current_z
+            layers.append(self.layer)
+
+
+class StreamingGCode(object):
+    """A print queue read from a file a chunk of lines at a time as
+    printcore asks for them, instead of all at once like GCode. Only the
+    chunk being printed and the one before it are kept in memory.
+
+    Lines are numbered like GCode numbers them, skipping empty ones.
+    Layers are counted as the print goes, see LayerCounter.
+    """
+
+    def __init__(self, filename, chunk_lines=4096, keep_chunks=2):
+        self.chunk_lines = chunk_lines
+        self.keep_chunks = keep_chunks
+        self._file = open(filename, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._chunks = deque()
+        self._read = 0
+        self._complete = False
+        # Lines sent with printcore.send while printing, printed after the file
+        self._appended = []
+        self._layers = LayerCounter()
+
+    def __len__(self):
+        """Number of lines read so far, all of them once complete is set"""
+        return self._read + len(self._appended)
+
+    @property
+    def complete(self):
+        return self._complete
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        self._complete = True
+
+    def _read_chunk(self):
+        chunk = Chunk(self._read)
+        readline = self._file.readline
+        lines = []
+        offsets = chunk.offsets
+        while len(lines) < self.chunk_lines:
+            raw = readline()
+            if not raw:
+                self.close()
+                break
+            offset = self._offset
+            self._offset += len(raw)
+            raw = raw.strip()
+            if raw:
+                lines.append(gcoder.Line(raw.decode("utf-8")))
+                offsets.append(offset)
+        if lines:
+            self._layers.count(lines, chunk.layers)
+            chunk.lines = lines
+            self._read += len(lines)
+            self._chunks.append(chunk)
+            while len(self._chunks) > self.keep_chunks:
+                self._chunks.popleft()
+        return bool(lines)
+
+    def _chunk_for(self, index):
+        with self._lock:
+            while index >= self._read and not self._complete:
+                self._read_chunk()
+            if not self._chunks or index >= self._read:
+                return None
+            if index < self._chunks[0].start:
+                raise IndexError("Line %d is no longer buffered, the oldest one is %d" %
+                                 (index, self._chunks[0].start))
+            for chunk in reversed(self._chunks):
+                if index >= chunk.start:
+                    return chunk
+
+    def has_index(self, i):
+        with self._lock:
+            if self._chunks and i < self._chunks[0].start:
+                # Read and printed already
+                return True
+        return self.line_at(i) is not None
+
+    def line_at(self, index):
+        """Returns the layer and the line at index, or None past the end"""
+        chunk = self._chunk_for(index)
+        if chunk is not None:
+            position = index - chunk.start
+            return chunk.layers[position], chunk.lines[position]
+        if self._complete and index - self._read < len(self._appended):
+            return self._layers.layer + 1, self._appended[index - self._read]
+        return None
+
+    def append(self, command, store=True):
+        command = command.strip()
+        if not command:
+            return
+        gline = gcoder.Line(command)
+        gcoder.split(gline)
+        if store:
+            self._appended.append(gline)
+        return gline
+
+    def progress(self, index):
+        """Fraction of the file that comes before line index"""
+        if not self._size:
+            return 1.0 if self._complete else 0.0
+        with self._lock:
+            for chunk in reversed(self._chunks):
+                if chunk.start <= index < chunk.end:
+                    return chunk.offsets[index - chunk.start] / self._size
+            if self._chunks and index < self._chunks[0].start:
+                return self._chunks[0].offsets[0] / self._size
+            return self._offset / self._size
@@ -0,0 +1,260 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A Marlin-like printer living on a pseudo-terminal, so printcore can be
+exercised and benchmarked without any hardware attached. Only available on
+platforms with the pty module (Linux, macOS)."""
+
+import os
+import random
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+from functools import reduce
+from operator import xor
+
+from bqclient.host.drivers.printrun.meatpack import MeatUnpacker
+from bqclient.host.drivers.printrun.reader import LineSplitter
+
+MOVES = ("G0", "G1", "G2", "G3")
+numbered_line_exp = re.compile(r"^N(-?\d+)\s*(.*?)\*(\d+)\s*$")
+# Lines packed without spaces, like G1X10, have their code run into the
+# first word
+code_exp = re.compile(r"^[A-Za-z]\d*")
+
+
+class VirtualPrinter(object):
+    """Firmware emulator speaking enough of the Marlin protocol for printcore:
+    greeting, ok, line numbers and checksums with resend requests, and
+    temperature reports. Moves go through a planner buffer of
+    planner_buffer_size entries that executes one move every move_time
+    seconds; like Marlin, the ok for a move is only sent once it fits in the
+    buffer.
+
+    resend_rate is the probability of treating a numbered line as corrupted,
+    which is answered the way Marlin answers a checksum mismatch. M110 is
+    left alone: a firmware that missed it asks for lines by the numbers it
+    had before, which no host can resend.
+    temperature_interval, if set, makes the printer report its temperatures
+    on its own every that many seconds, like M155 does.
+
+    With meatpack, the printer unpacks what it receives like a Marlin built
+    with MeatPack does. baud, if set, makes it take as long to receive as a
+    serial port at that baud rate would.
+    """
+
+    def __init__(self, greeting="start", planner_buffer_size=16, move_time=0.0,
+                 resend_rate=0.0, temperature_interval=None, seed=None, meatpack=False,
+                 baud=None):
+        self.greeting = greeting
+        self.planner_buffer_size = planner_buffer_size
+        self.move_time = move_time
+        self.resend_rate = resend_rate
+        self.temperature_interval = temperature_interval
+        self.baud = baud
+        self.unpacker = MeatUnpacker(report=self._reply) if meatpack else None
+        self.hotend_temperature = 0.0
+        self.hotend_target = 0.0
+        self.bed_temperature = 0.0
+        self.bed_target = 0.0
+        # Numbered lines accepted, in order
+        self.received = []
+        self.resends_requested = 0
+        self.oks_sent = 0
+        # Bytes read from the port, packed or not
+        self.bytes_received = 0
+        self.port = None
+        self._random = random.Random(seed)
+        self._master = None
+        self._slave = None
+        self._write_lock = threading.Lock()
+        self._planner = deque()
+        self._planner_changed = threading.Condition()
+        self._last_lineno = 0
+        self._corrupt_next = set()
+        self._stop = False
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """Opens the pseudo-terminal and starts answering on it. The port
+        to connect to is then available as port."""
+        import pty
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = False
+        self._threads = [threading.Thread(target=self._serve, daemon=True),
+                         threading.Thread(target=self._execute, daemon=True)]
+        if self.temperature_interval:
+            self._threads.append(threading.Thread(target=self._report_temperatures, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        self._reply(self.greeting)
+
+    def stop(self):
+        with self._planner_changed:
+            self._stop = True
+            self._planner_changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        os.close(self._master)
+        os.close(self._slave)
+        self._master = self._slave = None
+
+    def corrupt(self, lineno):
+        """Makes the printer reject the next copy of line lineno it
+        receives"""
+        self._corrupt_next.add(lineno)
+
+    def _reply(self, line):
+        with self._write_lock:
+            if self._master is not None:
+                os.write(self._master, (line + "\n").encode('ascii'))
+        if line.startswith("ok"):
+            self.oks_sent += 1
+
+    def _temperatures(self):
+        return "T:%.2f /%.2f B:%.2f /%.2f @:0 B@:0" % (self.hotend_temperature, self.hotend_target,
+                                                      self.bed_temperature, self.bed_target)
+
+    def _serve(self):
+        splitter = LineSplitter()
+        while not self._stop:
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                # Nobody has the port open
+                time.sleep(0.01)
+                continue
+            self.bytes_received += len(data)
+            if self.baud:
+                # 8 data bits, a start and a stop bit per byte
+                time.sleep(len(data) * 10.0 / self.baud)
+            if self.unpacker is not None:
+                data = self.unpacker.feed(data)
+            for line in splitter.feed(data):
+                self._handle_line(line.decode('ascii', 'replace').strip())
+
+    def _handle_line(self, line):
+        if not line:
+            return
+        if line.startswith("N"):
+            match = numbered_line_exp.match(line)
+            if not match:
+                self._request_resend("Error:No Checksum with line number, Last Line: %d" % self._last_lineno)
+                return
+            lineno = int(match.group(1))
+            command = match.group(2)
+            expected = reduce(xor, line[:line.rindex("*")].encode('ascii'), 0)
+            corrupted = lineno in self._corrupt_next or \
+                (self.resend_rate and not command.startswith("M110") and self._random.random() < self.resend_rate)
+            if corrupted or expected != int(match.group(3)):
+                self._corrupt_next.discard(lineno)
+                self._request_resend("Error:checksum mismatch, Last Line: %d" % self._last_lineno)
+                return
+            if command.startswith("M110"):
+                self._last_lineno = lineno
+                self._reply("ok")
+                return
+            if lineno != self._last_lineno + 1:
+                self._request_resend("Error:Line Number is not Last Line Number+1, Last Line: %d"
+                                     % self._last_lineno)
+                return
+            self._last_lineno = lineno
+            self.received.append(command)
+        else:
+            command = line
+        self._run(command)
+
+    def _request_resend(self, error):
+        self.resends_requested += 1
+        self._reply(error)
+        self._reply("Resend: %d" % (self._last_lineno + 1))
+        self._reply("ok")
+
+    def _run(self, command):
+        match = code_exp.match(command)
+        code = match.group(0) if match else ""
+        if code in MOVES:
+            self._plan(command)
+            self._reply("ok")
+        elif code == "M105":
+            self._reply("ok " + self._temperatures())
+        elif code in ("M104", "M109"):
+            self.hotend_target = self.hotend_temperature = self._parameter(command, "S")
+            self._reply("ok")
+        elif code in ("M140", "M190"):
+            self.bed_target = self.bed_temperature = self._parameter(command, "S")
+            self._reply("ok")
+        elif code == "M400":
+            self._wait_for_moves()
+            self._reply("ok")
+        else:
+            self._reply("ok")
+
+    def _parameter(self, command, letter):
+        for word in command.split()[1:]:
+            if word.startswith(letter):
+                try:
+                    return float(word[1:])
+                except ValueError:
+                    pass
+        return 0.0
+
+    def _plan(self, command):
+        """Blocks until the move fits in the planner buffer"""
+        if not self.move_time:
+            return
+        with self._planner_changed:
+            self._planner_changed.wait_for(
+                lambda: self._stop or len(self._planner) < self.planner_buffer_size)
+            self._planner.append(command)
+            self._planner_changed.notify_all()
+
+    def _wait_for_moves(self):
+        with self._planner_changed:
+            self._planner_changed.wait_for(lambda: self._stop or not self._planner)
+
+    def _execute(self):
+        while True:
+            with self._planner_changed:
+                self._planner_changed.wait_for(lambda: self._stop or self._planner)
+                if self._stop:
+                    return
+            time.sleep(self.move_time)
+            with self._planner_changed:
+                self._planner.popleft()
+                self._planner_changed.notify_all()
+
+    def _report_temperatures(self):
+        while not self._stop:
+            time.sleep(self.temperature_interval)
+            self._reply(" " + self._temperatures())
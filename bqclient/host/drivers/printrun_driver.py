@@ -1,45 +1,187 @@
+import os
+import tempfile
 import time
 
-from bqclient.host.drivers.printrun.printcore import printcore
+from appdirs import AppDirs
+
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.printcore import PrintFailed, printcore
+from bqclient.host.drivers.printrun.analysis_cache import AnalysisCache, load_gcode
+from bqclient.host.drivers.printrun.arcs import ArcFitter
 from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.mapped import MappedGCode
+from bqclient.host.drivers.printrun.optimizer import Optimizer, optimize_file
+from bqclient.host.drivers.printrun.packed import PackedGCode
+from bqclient.host.drivers.printrun.reactor import Reactor
+from bqclient.host.drivers.printrun.streaming import StreamingGCode
+from bqclient.host.framework.ioc import singleton
+
+
+@singleton
+class SharedReactor(Reactor):
+    """Does the I/O of every printer configured with "reactor" on one
+    thread"""
+
+
+@singleton
+class GCodeAnalysisCache(AnalysisCache):
+    """Analyses of the files every printer printed, kept with the
+    downloads"""
+
+    def __init__(self, app_dirs: AppDirs):
+        super().__init__(os.path.join(app_dirs.user_data_dir, "analysis_cache"))
 
 
 class PrintrunDriver(object):
-    def __init__(self, config):
+    def __init__(self, config, reactor: SharedReactor, analysis_cache: GCodeAnalysisCache):
         self.serial_port = config["connection"]["port"]
         self.baud_rate = None
 
         if "baud" in config["connection"]:
             self.baud_rate = config["connection"]["baud"]
 
+        # Number of lines allowed in flight before waiting on an "ok"
+        self.window_size = 1
+        if "window_size" in config:
+            self.window_size = max(1, int(config["window_size"]))
+
         self.printcore = printcore()
+        self.printcore.window_size = self.window_size
+
+        # Do the I/O on one thread shared by every printer configured with
+        # "reactor" instead of three threads per printer. At the line rates
+        # of serial ports latency holds steady, but the lines of all printers
+        # are handled one after another, so with printers answering faster
+        # than that it grows with the printer count.
+        if config.get("reactor", False):
+            self.printcore.reactor = reactor
+
+        # Read the file as it prints instead of loading it all up front. The
+        # number of layers isn't known until the end, and streamed files skip
+        # the analysis cache, parse_workers and pack_lines, which only apply
+        # to files loaded up front.
+        self.stream_gcode = config.get("stream_gcode", False)
+
+        # Map the file into memory and index its lines instead, which knows
+        # the number of layers up front and lets bots printing the same file
+        # share it
+        self.map_gcode = config.get("map_gcode", False)
+
+        # Keep the analysis of files loaded up front or mapped, to skip
+        # parsing them again when they are printed again
+        self.analysis_cache = None
+        if config.get("analysis_cache", True):
+            self.analysis_cache = analysis_cache
+
+        # Keep the lines of files loaded up front in a few flat buffers
+        # rather than as an object each. That keeps a third of the memory
+        # without the compiled lines, but little less with them, and takes
+        # longer to load either way.
+        self.pack_lines = config.get("pack_lines", False)
+
+        # Rewrite files to take fewer bytes to send before printing them
+        self.optimize_gcode = config.get("optimize_gcode", False)
+
+        # Replace runs of short moves along a circle by arcs that are within
+        # this many mm of them, for firmwares that take G2 and G3
+        self.arc_tolerance = None
+        if config.get("arc_tolerance") is not None:
+            self.arc_tolerance = float(config["arc_tolerance"])
+
+        # Number of processes to parse large files loaded up front with
+        self.parse_workers = max(1, int(config.get("parse_workers", os.cpu_count() or 1)))
+
+        if "resend_history_size" in config:
+            self.printcore.resend_history_size = int(config["resend_history_size"])
+
+        if "send_log_size" in config:
+            self.printcore.send_log_size = int(config["send_log_size"])
+
+        # Lines written to the port at once, and how long to hold them back
+        if "write_batch_size" in config:
+            self.printcore.write_batch_size = max(1, int(config["write_batch_size"]))
+
+        if "write_batch_latency" in config:
+            self.printcore.write_batch_latency = float(config["write_batch_latency"])
+
+        # Pack the lines sent with MeatPack, for firmwares built with it:
+        # true always does, "auto" only if the firmware answers for it
+        self.printcore.meatpack = config.get("meatpack", False)
 
     def connect(self):
+        # Without the compiled lines, files loaded up front take several
+        # times the memory, so say which ones are in use
+        print(gcoder.implementation())
+
         self.printcore.connect(self.serial_port, self.baud_rate)
 
         while not self.printcore.online:
             print("Printer is not online yet")
             time.sleep(2)
 
+        if self.printcore.packing:
+            print("Sending lines packed with MeatPack")
+        elif self.printcore.meatpack:
+            print("Printer did not answer for MeatPack, sending lines as they are")
+
     def disconnect(self):
         self.printcore.disconnect()
 
+    def _optimize(self, filename):
+        """Writes the lines of filename, rewritten the way the config asks,
+        to a temporary file and returns its name. None if they aren't to be
+        rewritten."""
+        stages = []
+        if self.arc_tolerance is not None:
+            stages.append(ArcFitter(self.arc_tolerance))
+        if self.optimize_gcode:
+            stages.append(Optimizer())
+        if not stages:
+            return None
+
+        (handle, optimized) = tempfile.mkstemp(suffix=".gcode")
+        os.close(handle)
+        stats = optimize_file(filename, optimized, stages)
+        print("Optimized %s: %s" % (os.path.basename(filename), stats))
+        if self.arc_tolerance is not None:
+            print("Fitted %d moves into %d arcs" % (stages[0].segments, stages[0].arcs))
+        return optimized
+
     def run(self, filename, **kwargs):
         if "update_job_progress" in kwargs:
             update_job_progress = kwargs["update_job_progress"]
         else:
             update_job_progress = None
 
-        with open(filename, 'rb') as fh:
-            gcode = [i.strip().decode("utf-8") for i in fh.readlines()]
+        optimized = self._optimize(filename)
+
+        try:
+            self._run(optimized or filename, update_job_progress)
+        finally:
+            if optimized is not None:
+                os.remove(optimized)
+
+    def _run(self, filename, update_job_progress):
+        if self.map_gcode:
+            gcode = MappedGCode(filename, cache=self.analysis_cache)
+        elif self.stream_gcode:
+            gcode = StreamingGCode(filename)
+        else:
+            gcode_class = PackedGCode if self.pack_lines else LightGCode
+            gcode = load_gcode(filename, self.analysis_cache, gcode_class, workers=self.parse_workers)
 
-        gcode = LightGCode(gcode)
+        try:
+            self.printcore.startprint(gcode)
 
-        self.printcore.startprint(gcode)
+            while self.printcore.printing:
+                time.sleep(5)
 
-        while self.printcore.printing:
-            time.sleep(5)
+                progress = 100.0 * self.printcore.print_progress()
+                if update_job_progress is not None:
+                    update_job_progress(progress)
 
-            progress = 100.0 * (float(self.printcore.queueindex) / float(len(self.printcore.mainqueue)))
-            if update_job_progress is not None:
-                update_job_progress(progress)
+            if self.printcore.print_error is not None:
+                raise PrintFailed(self.printcore.print_error)
+        finally:
+            if self.map_gcode or self.stream_gcode:
+                gcode.close()
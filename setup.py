@@ -18,7 +18,11 @@ def get_version():
 
 try:
     from Cython.Build import cythonize
-    extensions = cythonize("bqclient/host/drivers/printrun/gcoder_line.pyx")
+    extensions = cythonize([
+        "bqclient/host/drivers/printrun/gcoder_line.pyx",
+        "bqclient/host/drivers/printrun/framing.pyx",
+        "bqclient/host/drivers/printrun/gcoder_preprocess.pyx",
+    ])
     from Cython.Distutils import build_ext
 except ImportError as e:
     print("WARNING: Failed to cythonize: %s" % e)
@@ -55,6 +59,10 @@ setup(name="bqclient",
           'sentry-sdk==0.10.2',
           'zeroconf'
       ],
+      extras_require={
+          # Analyses files with gcoder_columnar
+          "columnar": ["numpy"],
+      },
       tests_require=[
           "pytest",
       ],
@@ -25,6 +25,7 @@ def mock_appdirs():
     appdirs_mock = Mock(AppDirs)
     appdirs_mock.user_config_dir = os.path.join(tempfile.mkdtemp(), 'user_config_dir')
     appdirs_mock.user_log_dir = os.path.join(tempfile.mkdtemp(), 'user_log_dir')
+    appdirs_mock.user_data_dir = os.path.join(tempfile.mkdtemp(), 'user_data_dir')
 
     return appdirs_mock
 
@@ -0,0 +1,79 @@
+from queue import Queue, Empty
+from threading import Event
+
+import pytest
+
+from bqclient.host.drivers.printrun.printcore import printcore
+
+
+class FakePrinter(object):
+    """Stands in for the Serial instance printcore talks to"""
+
+    def __init__(self):
+        self.written = []
+        self.replies = Queue()
+        self.is_open = True
+        self.reading = Event()
+
+    def reply(self, line):
+        self.replies.put((line + "\n").encode('ascii'))
+
+    def readline(self):
+        self.reading.set()
+        try:
+            return self.replies.get(True, 0.05)
+        except Empty:
+            return b""
+
+    def write(self, data):
+        self.written.append(data)
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def fake_printer():
+    return FakePrinter()
+
+
+@pytest.fixture
+def online_printcore(fake_printer):
+    core = printcore()
+    core.printer = fake_printer
+    core.printer_tcp = None
+    core.online = True
+
+    return core
+
+
+@pytest.fixture
+def long_file(tmp_path):
+    """A print of ten layers of 99 moves each"""
+    path = tmp_path / "long.gcode"
+    with open(path, "w") as fh:
+        for layer in range(10):
+            fh.write("G1 Z%.1f\n" % (0.2 * (layer + 1)))
+            for i in range(99):
+                fh.write("G1 X%d Y%d E%d\n" % (i, i, layer * 99 + i + 1))
+    return str(path)
+
+
+@pytest.fixture
+def print_gcode(online_printcore, fake_printer):
+    """Prints a print queue on online_printcore to the end, as if the
+    firmware acknowledged every line right away. Returns what was written."""
+    def print_gcode(gcode):
+        online_printcore.mainqueue = gcode
+        online_printcore.window_size = 8
+        online_printcore.printing = True
+        online_printcore._reset_render()
+        while online_printcore.printing:
+            online_printcore.clear = True
+            online_printcore._sendnext()
+        return list(fake_printer.written)
+
+    return print_gcode
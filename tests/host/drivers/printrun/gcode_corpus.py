@@ -0,0 +1,65 @@
+"""Print files made up for the tests that compare the ways of analysing
+G-code with each other"""
+import random
+
+from bqclient.host.drivers.printrun import gcoder
+
+ANALYSIS = [
+    "imperial", "cutting", "relative", "relative_e", "current_tool",
+    "current_x", "current_y", "current_z", "current_e", "current_f",
+    "offset_x", "offset_y", "offset_z", "offset_e", "total_e", "max_e",
+    "current_e_multi", "offset_e_multi", "total_e_multi", "max_e_multi",
+    "filament_length", "filament_length_multi",
+    "xmin", "xmax", "ymin", "ymax", "zmin", "zmax", "width", "depth", "height",
+    "est_layer_height", "all_zs", "duration", "append_layer_id",
+]
+
+ODD_LINES = [
+    "G28 X0", "G28", "G92 X10 Y10", "G2 X10 Y10 I5 J5 E1", "; comment",
+    "N5 G1 X1*44", "N5 N6 G1", "(paren) G1 X5", "(open G1 X5", "G1 X(a)5",
+    "%", "G1 X5 X6 E3", "G0 Z1", "M104 S200", "G01 X3", "g1 x4 e1",
+    "G1 X 7 Y\t8", "G1 X-.5 Y+2.", "G1 F3000", "G1 E5", "G4 P200", "G4",
+    "M83", "M82", "G91", "G90", "T1", "T0", "T", "Tx", "M3", "M5", "G20",
+    "G21", "G92 E0", "G1 E-1.5 F2400", "G1 X1 ; move to X1", "/G1 X5",
+    "G1 X1 Ä", "M117 Grüße", "G1 X1.5 Y2", "hello",
+]
+
+
+def corpus(seed, count=2000):
+    rand = random.Random(seed)
+    lines = ["G28", "G21", "G90", "M82", "G92 E0"]
+    z = 0.2
+    e = 0.0
+    for _ in range(count):
+        choice = rand.random()
+        if choice < 0.02:
+            z = round(z + rand.choice([0.1, 0.15, 0.2, 0.3]), 2)
+            lines.append("G1 Z%s F600" % z)
+        elif choice < 0.025:
+            # Z hop
+            lines.extend(["G1 Z%.2f" % (z + 0.4), "G1 X10 Y10", "G1 Z%.2f" % z])
+        elif choice < 0.08:
+            lines.append(rand.choice(ODD_LINES))
+        else:
+            e += rand.uniform(0, 1)
+            feedrate = rand.choice(["", " F1200", " F1800", " F3000"])
+            lines.append("G1 X%.3f Y%.3f E%.5f%s" % (rand.uniform(0, 200), rand.uniform(0, 200), e, feedrate))
+    return lines
+
+
+def analyse(data, columnar=False, compiled=False, gcode_class=gcoder.LightGCode):
+    """Analyses data with the columnar engine, gcoder_preprocess, or the
+    loop of GCode if neither"""
+    gcode = gcode_class(deferred=True)
+    gcode.columnar = columnar
+    gcode.compiled = compiled
+    gcode.prepare(data)
+    return gcode
+
+
+def analysis(gcode):
+    result = {name: getattr(gcode, name) for name in ANALYSIS}
+    result["layer_idxs"] = list(gcode.layer_idxs)
+    result["line_idxs"] = list(gcode.line_idxs)
+    result["layers"] = [([line.raw for line in layer], layer.z, layer.duration) for layer in gcode.all_layers]
+    return result
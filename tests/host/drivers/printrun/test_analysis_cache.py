@@ -0,0 +1,149 @@
+import os
+import time
+from array import array
+
+import pytest
+
+from bqclient.host.drivers.printrun import analysis_cache
+from bqclient.host.drivers.printrun.analysis_cache import AnalysisCache, load_gcode
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.mapped import MappedGCode
+
+SAMPLE = [
+    "; generated for the tests",
+    "G28",
+    "G21",
+    "G90",
+    "M82",
+    "G1 Z0.2 F1200",
+    "G1 X10 Y10 E1.5",
+    "G1 X20 Y10 E3",
+    "",
+    "G92 E0",
+    "G1 Z0.4",
+    "G1 X20 Y20 E1.5",
+    "T1",
+    "G1 X10 Y20 E3",
+    "G4 P500",
+    "G1 Z0.6",
+    "G1 X10 Y10 E4.5",
+]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnalysisCache(str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def sample_file(tmp_path):
+    path = tmp_path / "sample.gcode"
+    path.write_bytes(("\n".join(SAMPLE) + "\n").encode("utf-8"))
+    return str(path)
+
+
+def analysis(gcode):
+    state = {name: getattr(gcode, name) for name in analysis_cache.GCODE_STATE}
+    state.update(
+        all_zs=gcode.all_zs,
+        duration=gcode.duration,
+        layer_idxs=list(gcode.layer_idxs),
+        line_idxs=list(gcode.line_idxs),
+        layers=[([line.raw for line in layer], layer.z, layer.duration) for layer in gcode.all_layers],
+        append_layer_id=gcode.append_layer_id,
+    )
+    return state
+
+
+class TestAnalysisCache(object):
+    def test_entries_round_trip(self, cache):
+        cache.put("key", {"z": 0.2}, {"offsets": array('Q', [0, 5, 2 ** 40]), "zs": array('d', [0.2, 0.4])})
+
+        (header, arrays) = cache.get("key")
+
+        assert header["z"] == 0.2
+        assert arrays["offsets"] == array('Q', [0, 5, 2 ** 40])
+        assert arrays["zs"] == array('d', [0.2, 0.4])
+
+    def test_missing_entries(self, cache):
+        assert cache.get("key") is None
+
+    def test_unreadable_entries_are_dropped(self, cache):
+        cache.put("key", {}, {"offsets": array('Q', range(100))})
+        path = cache._path("key")
+        with open(path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(path) - 8)
+
+        assert cache.get("key") is None
+        assert not os.path.exists(path)
+
+    def test_least_recently_used_entries_are_evicted(self, cache):
+        values = array('Q', range(1000))
+        cache.put("a", {}, {"values": values})
+        cache.max_size = 2.5 * os.path.getsize(cache._path("a"))
+        cache.put("b", {}, {"values": values})
+        old = time.time() - 100
+        os.utime(cache._path("a"), (old, old))
+        os.utime(cache._path("b"), (old - 10, old - 10))
+        # Using a makes b the least recently used
+        assert cache.get("a") is not None
+
+        cache.put("c", {}, {"values": values})
+
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+
+
+class TestLoadGCode(object):
+    def test_a_cached_analysis_matches_parsing(self, cache, sample_file):
+        parsed = load_gcode(sample_file, cache)
+        cached = load_gcode(sample_file, cache)
+
+        assert analysis(cached) == analysis(parsed)
+        assert analysis(parsed) == analysis(LightGCode([line.strip() for line in SAMPLE]))
+
+    def test_the_analysis_is_not_parsed_again(self, cache, sample_file, monkeypatch):
+        load_gcode(sample_file, cache)
+
+        def _preprocess(*args, **kwargs):
+            raise AssertionError("Parsed again")
+        monkeypatch.setattr(LightGCode, "_preprocess", _preprocess)
+
+        assert len(load_gcode(sample_file, cache)) == len(SAMPLE) - 1
+
+    def test_lines_appended_to_a_cached_analysis(self, cache, sample_file):
+        parsed = load_gcode(sample_file, cache)
+        cached = load_gcode(sample_file, cache)
+
+        for gcode in (parsed, cached):
+            gcode.append("G1 X5 Y5 E6")
+
+        assert analysis(cached) == analysis(parsed)
+        assert cached.lines[-1].current_x == parsed.lines[-1].current_x
+
+    def test_a_changed_file_is_parsed_again(self, cache, sample_file):
+        load_gcode(sample_file, cache)
+        with open(sample_file, 'a') as fh:
+            fh.write("G1 Z0.8\nG1 X0 Y0 E6\n")
+
+        gcode = load_gcode(sample_file, cache)
+
+        assert gcode.lines[-1].raw == "G1 X0 Y0 E6"
+        assert analysis(gcode) == analysis(LightGCode([line.strip() for line in open(sample_file)]))
+
+
+class TestMappedGCodeCache(object):
+    def test_the_index_is_loaded_from_the_cache(self, cache, sample_file, monkeypatch):
+        indexed = MappedGCode(sample_file, cache=cache)
+
+        def _index(*args, **kwargs):
+            raise AssertionError("Indexed again")
+        monkeypatch.setattr(MappedGCode, "_index", _index)
+        cached = MappedGCode(sample_file, cache=cache)
+
+        assert cached.offsets == indexed.offsets
+        assert cached.layer_idxs == indexed.layer_idxs
+        assert cached.line_idxs == indexed.line_idxs
+        assert cached.layer_count == indexed.layer_count
+        assert [line.raw for line in cached] == [line.raw for line in indexed]
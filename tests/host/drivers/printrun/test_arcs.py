@@ -0,0 +1,158 @@
+import math
+
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.arcs import ArcFitter
+from bqclient.host.drivers.printrun.optimizer import Optimizer, optimize_file
+
+
+def circle(center=(100.0, 100.0), radius=10.0, segments=90, clockwise=False, e=0.0, relative_e=False):
+    """A tessellated circle, starting and ending at its rightmost point"""
+    lines = ["G1 X%.3f Y%.3f F1800" % (center[0] + radius, center[1])]
+    step = 2 * math.pi / segments
+    for k in range(1, segments + 1):
+        angle = -k * step if clockwise else k * step
+        e = 0.02 if relative_e else e + 0.02
+        lines.append("G1 X%.3f Y%.3f E%.5f" % (center[0] + radius * math.cos(angle),
+                                              center[1] + radius * math.sin(angle), e))
+    return lines
+
+
+def fit(lines, tolerance=0.05):
+    return list(ArcFitter(tolerance).lines(lines))
+
+
+def arcs(lines):
+    return [line for line in lines if line.split()[0] in ("G2", "G3")]
+
+
+def words(line):
+    return dict((word[0], float(word[1:])) for word in line.split()[1:])
+
+
+def analyse(lines):
+    return gcoder.GCode(lines)
+
+
+def positions(gcode):
+    return [(line.current_x, line.current_y, line.current_z) for line in gcode.lines if line.is_move]
+
+
+def cylinders(layers=5):
+    lines = ["G28", "G90", "M82", "G92 E0"]
+    for layer in range(layers):
+        lines.append("G1 Z%.2f F600" % (0.2 * (layer + 1)))
+        lines.extend(circle(radius=10, segments=120))
+        lines.append("G92 E0")
+        lines.extend(circle(center=(150.0, 80.0), radius=25, segments=300, clockwise=True))
+        lines.extend(["G1 X120 Y120 E1", "G1 X130 Y120 E1.5", "G1 X130 Y130 E2"])
+        lines.append("G92 E0")
+    return lines
+
+
+class TestArcFitter(object):
+    def test_fits_a_circle(self):
+        lines = ["G90", "M82", "G92 E0"] + circle()
+
+        fitted = fit(lines)
+
+        assert len(fitted) < 10
+        for arc in arcs(fitted):
+            assert arc.startswith("G3 ")
+        # Ends where the moves did, having pushed as much filament
+        last = words(fitted[-1])
+        assert (last["X"], last["Y"], last["E"]) == (110, 100, pytest.approx(1.8))
+
+    def test_arcs_are_within_tolerance_of_the_moves(self):
+        lines = ["G90", "M82", "G92 E0"] + circle(clockwise=True)
+
+        fitted = fit(lines, 0.01)
+
+        position = None
+        for line in fitted:
+            values = words(line) if line.startswith("G") else {}
+            if line.startswith("G2 "):
+                (cx, cy) = (position[0] + values["I"], position[1] + values["J"])
+                assert math.hypot(cx - 100, cy - 100) < 0.01
+                assert math.hypot(values["X"] - cx, values["Y"] - cy) == pytest.approx(10, abs=0.01)
+            assert not line.startswith("G3 ")
+            if "X" in values:
+                position = (values["X"], values["Y"])
+        assert arcs(fitted)
+
+    def test_keeps_relative_extrusion(self):
+        lines = ["G90", "M83"] + circle(relative_e=True)
+
+        fitted = fit(lines)
+
+        assert sum(words(line).get("E", 0) for line in fitted if line.startswith("G")) == \
+            pytest.approx(sum(words(line).get("E", 0) for line in lines if line.startswith("G")), abs=1e-4)
+
+    def test_leaves_other_moves_alone(self):
+        straight = ["G90", "M82", "G92 E0"] + ["G1 X%d Y10 E%d" % (i, i) for i in range(10)]
+        hexagon = ["G90", "M82", "G92 E0", "G1 X10 Y0"] + [
+            "G1 X%.3f Y%.3f E%d" % (10 * math.cos(k * math.pi / 3), 10 * math.sin(k * math.pi / 3), k)
+            for k in range(1, 7)]
+
+        assert fit(straight) == straight
+        assert fit(hexagon) == hexagon
+
+    def test_keeps_comments(self):
+        lines = ["G90", "M82", "G92 E0"] + circle()
+        lines.insert(20, "; middle")
+        lines.append(";LAYER:1")
+        lines.append("G1 Z0.4")
+
+        fitted = fit(lines)
+
+        assert fitted[-3:] == ["; middle", ";LAYER:1", "G1 Z0.4"]
+
+    def test_needs_to_know_the_mode(self):
+        lines = ["G92 E0"] + circle()
+
+        assert fit(lines) == lines
+
+    def test_uneven_extrusion_is_not_fitted(self):
+        lines = ["G90", "M83"] + circle(relative_e=True)
+        lines = [line.replace("E0.02000", "E0.04000") if i % 2 else line for (i, line) in enumerate(lines)]
+
+        assert not arcs(fit(lines))
+
+    def test_feedrate_changes_end_arcs(self):
+        lines = ["G90", "M82", "G92 E0"] + circle()
+        lines[40] += " F3000"
+
+        fitted = fit(lines)
+
+        assert len(arcs(fitted)) == 2
+        assert "F3000" in arcs(fitted)[1]
+
+    def test_positions_are_kept(self):
+        lines = cylinders()
+
+        fitted = fit(lines)
+        original = analyse(lines)
+        result = analyse(fitted)
+
+        assert len(fitted) < len(lines) / 10
+        assert result.filament_length == pytest.approx(original.filament_length)
+        assert [layer.z for layer in result.all_layers] == [layer.z for layer in original.all_layers]
+        assert (result.current_x, result.current_y, result.current_z) == \
+            (original.current_x, original.current_y, original.current_z)
+        # Arcs end where some of the moves did
+        remaining = iter(positions(original))
+        assert all(position in remaining for position in positions(result))
+
+    def test_optimized_with_the_optimizer(self, tmp_path):
+        source = tmp_path / "cylinders.gcode"
+        source.write_text("\n".join(cylinders(2)) + "\n")
+        destination = tmp_path / "optimized.gcode"
+        (fitter, optimizer) = (ArcFitter(0.05), Optimizer())
+
+        stats = optimize_file(str(source), str(destination), [fitter, optimizer])
+
+        assert stats.lines_read == fitter.stats.lines_read
+        assert stats.bytes_written == optimizer.stats.bytes_written
+        assert fitter.arcs and fitter.segments > 10 * fitter.arcs
+        assert stats.bytes_saved > 0.8 * stats.bytes_read
@@ -0,0 +1,117 @@
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+
+numpy = pytest.importorskip("numpy")
+
+from bqclient.host.drivers.printrun import gcoder_columnar  # noqa: E402
+from tests.host.drivers.printrun.gcode_corpus import analyse, analysis, corpus  # noqa: E402
+
+
+class TestColumnarAnalysis(object):
+    @pytest.mark.parametrize("seed", range(20))
+    def test_matches_preprocess(self, seed):
+        data = corpus(seed)
+
+        assert analysis(analyse(data, columnar=True)) == analysis(analyse(data))
+
+    @pytest.mark.parametrize("data", [
+        ["G1 E-1", "G1 E-2"],
+        ["M83", "G1 E-1", "G1 X1"],
+        ["G91", "G1 Z1", "G1 Z1", "G1 X1 E1", "G90"],
+        ["T2", "G1 X1 E1", "T0", "G1 X2 E2", "T1", "M83", "G1 E3"],
+        ["G1 Z0.2", "G1 X1 E1", "G1 Z0.25", "G1 X2 E2", "G1 Z0.3", "G1 X3 E3"],
+        ["G20", "G1 X1 Y1 E1", "G21", "G1 X1"],
+        ["M3", "G1 X5 Y5", "M5"],
+        ["G1 F0", "G1 X1", "G1 X2 F600"],
+        ["G92 Z5", "G1 Z6", "G92 X1 Y1 E0"],
+        ["N1 G1 X1", "N2", "%"],
+        ["; only a comment"],
+    ])
+    def test_matches_preprocess_on_odd_files(self, data):
+        assert analysis(analyse(data, columnar=True)) == analysis(analyse(data))
+
+    def test_is_used_for_light_lines(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(gcoder_columnar, "preprocess", calls.append)
+
+        gcode = analyse(corpus(1, 10), columnar=True)
+
+        assert calls == [gcode]
+
+    def test_is_not_used_for_full_lines(self, monkeypatch):
+        monkeypatch.setattr(gcoder_columnar, "preprocess", pytest.fail)
+
+        gcode = analyse(corpus(1, 10), columnar=True, gcode_class=gcoder.GCode)
+
+        assert gcode.lines[-1].current_x is not None
+
+    def test_is_not_used_with_a_layer_callback(self, monkeypatch):
+        monkeypatch.setattr(gcoder_columnar, "preprocess", pytest.fail)
+        layers = []
+
+        gcoder.LightGCode(corpus(1, 100), layer_callback=lambda gcode, layer: layers.append(layer))
+
+        assert layers
+
+    def test_falls_back_without_numpy(self, monkeypatch):
+        data = corpus(2)
+        expected = analysis(analyse(data))
+        monkeypatch.setattr(gcoder, "gcoder_columnar", None)
+
+        assert analysis(analyse(data, columnar=True)) == expected
+
+
+class TestParallelParse(object):
+    @pytest.fixture
+    def corpus_file(self, tmp_path):
+        path = tmp_path / "corpus.gcode"
+        lines = corpus(3, 3000)
+        # Units and tools carried over from one range to the next
+        lines[1000:1000] = ["G20", "T1", "G1 X1 Y1 E1"]
+        lines[2000:2000] = ["G21", "", "   ", "T0"]
+        path.write_bytes(("\n".join(lines) + "\n").encode("utf-8"))
+        return str(path), lines
+
+    def test_ranges_split_on_lines(self, corpus_file):
+        (path, _) = corpus_file
+        with open(path, 'rb') as fh:
+            data = fh.read()
+
+        ranges = gcoder_columnar.split_file(path, 4)
+
+        assert len(ranges) == 4
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == len(data)
+        for ((_, end), (start, _)) in zip(ranges, ranges[1:]):
+            assert end == start
+            assert data[end - 1:end] == b"\n"
+
+    def test_matches_parsing_in_one_process(self, corpus_file, monkeypatch):
+        (path, lines) = corpus_file
+        monkeypatch.setattr(gcoder.GCode, "compiled", False)
+
+        monkeypatch.setattr(gcoder.os, "cpu_count", lambda: 4)
+
+        gcode = gcoder.parse_file(path, workers=3, min_parallel_size=0)
+
+        assert [line.raw for line in gcode.lines] == [line.strip() for line in lines if line.strip()]
+        assert analysis(gcode) == analysis(analyse(lines))
+
+    def test_small_files_are_parsed_in_process(self, corpus_file, monkeypatch):
+        (path, lines) = corpus_file
+        monkeypatch.setattr(gcoder.os, "cpu_count", lambda: 4)
+        monkeypatch.setattr(gcoder_columnar, "parse_file", pytest.fail)
+
+        gcode = gcoder.parse_file(path, workers=3)
+
+        assert len(gcode) == len([line for line in lines if line.strip()])
+
+    def test_no_more_processes_than_cores(self, corpus_file, monkeypatch):
+        (path, lines) = corpus_file
+        monkeypatch.setattr(gcoder.os, "cpu_count", lambda: 1)
+        monkeypatch.setattr(gcoder_columnar, "parse_file", pytest.fail)
+
+        gcode = gcoder.parse_file(path, workers=3, min_parallel_size=0)
+
+        assert len(gcode) == len([line for line in lines if line.strip()])
@@ -0,0 +1,50 @@
+import re
+
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+
+
+class TestImplementation(object):
+    def test_falls_back_to_pure_python_lines(self):
+        if gcoder.gcoder_line is not None:
+            assert gcoder.Line is gcoder.gcoder_line.GLine
+        else:
+            assert gcoder.Line is gcoder.PyLine
+            assert gcoder.LightLine is gcoder.PyLightLine
+            assert not gcoder.single_precision()
+
+    def test_says_whether_the_lines_are_compiled(self):
+        description = gcoder.implementation()
+
+        if gcoder.gcoder_line is not None:
+            assert "compiled" in description
+        else:
+            assert "pure Python" in description
+
+    def test_reports_the_bytes_per_move(self):
+        match = re.search(r"about (\d+) bytes per move, (\d+) for light lines", gcoder.implementation())
+
+        assert match
+        (move, light) = (int(match.group(1)), int(match.group(2)))
+        assert move > light > len("G1 X103.125 Y97.25 E1.5625")
+
+    @pytest.mark.parametrize("line_class", [gcoder.PyLine, gcoder.PyLightLine])
+    def test_line_size_counts_what_a_line_holds(self, line_class):
+        line = line_class("G1 X1.5")
+        empty = gcoder.line_size(line)
+
+        line.command = "G1"
+
+        assert gcoder.line_size(line) > empty > len("G1 X1.5")
+
+
+class TestToolPositions(object):
+    def test_are_not_shared_between_gcodes(self):
+        first = gcoder.GCode(["T1", "G1 X10 E5"])
+
+        second = gcoder.GCode(["G1 X10 E1"])
+
+        assert first.max_e_multi == [0, 5]
+        assert second.max_e_multi == [1]
+        assert second.filament_length_multi == [1]
@@ -0,0 +1,100 @@
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+from tests.host.drivers.printrun.gcode_corpus import analyse, analysis, corpus
+
+if gcoder.gcoder_preprocess is None:
+    pytest.skip("gcoder_preprocess isn't built", allow_module_level=True)
+
+LINE_ATTRIBUTES = [
+    "command", "is_move", "x", "y", "z", "e", "f", "i", "j",
+    "relative", "relative_e", "current_x", "current_y", "current_z",
+    "extruding", "current_tool",
+]
+
+
+def attributes(gcode):
+    return [[getattr(line, name) for name in LINE_ATTRIBUTES] for line in gcode.lines]
+
+
+@pytest.fixture(params=["GLine", "PyLine"])
+def line_class(request, monkeypatch):
+    """Runs a test with the compiled lines, and with the pure Python ones
+    that keep coordinates as double precision floats"""
+    if request.param != "GLine":
+        monkeypatch.setattr(gcoder, "Line", getattr(gcoder, request.param))
+        monkeypatch.setattr(gcoder.GCode, "line_class", getattr(gcoder, request.param))
+    elif not gcoder.single_precision():
+        pytest.skip("gcoder_line isn't built")
+    return gcoder.Line
+
+
+class TestCompiledPreprocess(object):
+    @pytest.mark.parametrize("seed", range(10))
+    def test_matches_preprocess(self, line_class, seed):
+        data = corpus(seed)
+
+        assert analysis(analyse(data, compiled=True)) == analysis(analyse(data))
+
+    @pytest.mark.parametrize("data", [
+        ["G1 E-1", "G1 E-2"],
+        ["M83", "G1 E-1", "G1 X1"],
+        ["G91", "G1 Z1", "G1 Z1", "G1 X1 E1", "G90"],
+        ["T2", "G1 X1 E1", "T0", "G1 X2 E2", "T1", "M83", "G1 E3"],
+        ["G1 Z0.2", "G1 X1 E1", "G1 Z0.25", "G1 X2 E2", "G1 Z0.3", "G1 X3 E3"],
+        ["G20", "G1 X1 Y1 E1", "G21", "G1 X1"],
+        ["M3", "G1 X5 Y5", "M5"],
+        ["G1 F0", "G1 X1", "G1 X2 F600"],
+        ["G92 Z5", "G1 Z6", "G92 X1 Y1 E0"],
+        ["G1 X0.1 Y0.3 Z0.7 E0.9"],
+        ["N1 G1 X1", "N2", "%"],
+        ["; only a comment"],
+    ])
+    def test_matches_preprocess_on_odd_files(self, line_class, data):
+        assert analysis(analyse(data, compiled=True)) == analysis(analyse(data))
+
+    def test_sets_the_attributes_of_full_lines(self, line_class):
+        data = corpus(1, 500)
+
+        compiled = analyse(data, compiled=True, gcode_class=gcoder.GCode)
+        expected = analyse(data, gcode_class=gcoder.GCode)
+
+        assert analysis(compiled) == analysis(expected)
+        assert attributes(compiled) == attributes(expected)
+
+    def test_appended_lines(self, line_class):
+        data = corpus(2, 200)
+        compiled = analyse(data, compiled=True, gcode_class=gcoder.GCode)
+        expected = analyse(data, gcode_class=gcoder.GCode)
+
+        for command in ("G91", "G1 X5 E1", "T1", "G92 E0", "G1 X1 E2"):
+            assert [getattr(compiled.append(command), name) for name in LINE_ATTRIBUTES] == \
+                [getattr(expected.append(command), name) for name in LINE_ATTRIBUTES]
+
+        assert analysis(compiled) == analysis(expected)
+
+    def test_layer_callback(self):
+        data = corpus(3, 500)
+        layers = []
+
+        analyse(data, compiled=True).prepare(data, layer_callback=lambda gcode, layer: layers.append(layer))
+
+        assert layers == list(range(len(analyse(data).all_layers) - 2))
+
+    def test_is_not_used_when_disabled(self, monkeypatch):
+        monkeypatch.setattr(gcoder.gcoder_preprocess, "preprocess", pytest.fail)
+
+        gcode = analyse(corpus(1, 10))
+
+        assert gcode.lines
+
+    def test_files_are_parsed_in_process(self, tmp_path, monkeypatch):
+        path = tmp_path / "corpus.gcode"
+        path.write_text("\n".join(corpus(4, 100)), encoding="utf-8")
+        monkeypatch.setattr(gcoder.os, "cpu_count", lambda: 4)
+        if gcoder.gcoder_columnar is not None:
+            monkeypatch.setattr(gcoder.gcoder_columnar, "parse_file", pytest.fail)
+
+        gcode = gcoder.parse_file(str(path), workers=4, min_parallel_size=0)
+
+        assert gcode.lines
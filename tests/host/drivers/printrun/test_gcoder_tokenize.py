@@ -0,0 +1,80 @@
+import random
+import re
+
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+
+LINES = [
+    "G1 X10 Y20 E1.5", "G1 X-.5 Y+2. F1800", "G0 Z0.2", "G2 X10 Y10 I5 J5 E1",
+    "G1 X1 ; move to X1", "G1 X(a)5", "(paren) G1 X5", "(open G1 X5", "; comment",
+    "N5 G1 X1*44", "N5 N6 G1", "G1 X5 X6 E3", "g1 x4 e1", "G1 X 7 Y\t8", "G1\tX1  Y2",
+    "G1 X1.", "G1 X.", "G1 X", "G1 X1e5", "G1 X1.2.3", "G1 X1-2", "G1 X١", "G1 X1 Ä",
+    "M104 S200", "M109 S210.5 ; wait", "G4 P200", "G4 (P1) P2", "M117 Grüße", "İx5",
+    "/G1 X5", "G1 X5 /\nG1 Y5", "T1", "%", "hello", "", "   ",
+]
+
+
+def findall(raw):
+    split_raw = gcoder.gcode_exp.findall(raw.lower())
+    if split_raw and split_raw[0][0] == "n":
+        del split_raw[0]
+    return split_raw
+
+
+def specific(raw, code):
+    bits = [bit for bit in re.findall(gcoder.specific_exp % code, raw) if bit]
+    return float(bits[0][1:]) if bits else None
+
+
+def fuzz(count=5000):
+    rand = random.Random(7)
+    alphabet = "GXYZESPMTNgx ;()/*\n\t0123456789.-+İ%"
+    return ["".join(rand.choice(alphabet) for _ in range(rand.randint(0, 20))) for _ in range(count)]
+
+
+class TestTokenize(object):
+    @pytest.mark.parametrize("raw", LINES)
+    def test_matches_the_regular_expressions(self, raw):
+        (command, pairs, stripped) = gcoder.tokenize(raw)
+
+        assert pairs == findall(raw)
+        assert stripped == gcoder.gcode_strip_comment_exp.sub("", raw).strip()
+        if pairs:
+            assert command == pairs[0][0].upper() + pairs[0][1]
+        else:
+            assert command is None
+
+    def test_matches_the_regular_expressions_on_anything(self):
+        for raw in fuzz():
+            (_, pairs, stripped) = gcoder.tokenize(raw)
+            assert pairs == findall(raw), raw
+            assert stripped == gcoder.gcode_strip_comment_exp.sub("", raw).strip(), raw
+            assert gcoder.strip_comments(raw) == stripped, raw
+
+    def test_moves(self):
+        assert gcoder.tokenize("G1 X10.5 Y-2 E.25") == \
+            ("G1", [("g", "1"), ("x", "10.5"), ("y", "-2"), ("e", ".25")], "G1 X10.5 Y-2 E.25")
+        assert gcoder.tokenize("G1 X10 ; go") == ("G1", [("g", "1"), ("x", "10"), ("", "")], "G1 X10")
+
+    def test_comments(self):
+        assert gcoder.tokenize("; only a comment") == ("", [("", "")], "")
+        assert gcoder.tokenize("%") == (None, [], "%")
+
+
+class TestFindSpecificCode(object):
+    @pytest.mark.parametrize("raw", LINES)
+    def test_matches_the_regular_expression(self, raw):
+        for code in ("S", "P"):
+            try:
+                expected = specific(raw, code)
+            except ValueError:
+                with pytest.raises(ValueError):
+                    gcoder.find_specific_code(gcoder.LightLine(raw), code)
+            else:
+                assert gcoder.find_specific_code(gcoder.LightLine(raw), code) == expected
+
+    def test_values(self):
+        assert gcoder.S(gcoder.LightLine("M104 S200 ; S100")) == 200
+        assert gcoder.P(gcoder.LightLine("G4 (P1) P2")) == 2
+        assert gcoder.P(gcoder.LightLine("G4")) is None
@@ -0,0 +1,106 @@
+import pytest
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.mapped import MappedGCode
+from bqclient.host.drivers.printrun.streaming import StreamingGCode
+
+SAMPLE = [
+    "; generated for the tests",
+    "G28",
+    "M83",
+    "",
+    "G1 Z0.2 F600",
+    "G1 X10 Y10 E1.5",
+    "G1 Z0.6 ; hop",
+    "G1 Z0.2",
+    "   ",
+    "G1 Z0.4",
+    "G1 X10 Y10 E1.5",
+    "G1 X20 Y20 E1.5",
+]
+
+
+@pytest.fixture
+def sample_file(tmp_path):
+    path = tmp_path / "sample.gcode"
+    # No newline after the last line
+    path.write_bytes("\n".join(SAMPLE).encode("utf-8"))
+    return str(path)
+
+
+class TestMappedGCode(object):
+    def test_lines_match_gcode(self, sample_file):
+        gcode = MappedGCode(sample_file, batch_lines=3)
+        expected = LightGCode([line.strip() for line in SAMPLE])
+
+        assert [line.raw for line in gcode] == [line.raw for line in expected.lines]
+        assert len(gcode) == len(expected)
+        gcode.close()
+
+    def test_layers_match_streaming(self, long_file):
+        gcode = MappedGCode(long_file, batch_lines=64)
+        stream = StreamingGCode(long_file)
+
+        assert list(gcode.layer_idxs) == [stream.line_at(i)[0] for i in range(len(gcode))]
+        assert gcode.layer_count == 10
+        assert gcode.idxs(0) == (0, 0)
+        # The Z move of a layer belongs to the one before, until it extrudes
+        assert gcode.idxs(101) == (1, 0)
+        assert gcode.idxs(999) == (9, 98)
+
+    def test_any_line_can_be_looked_up(self, long_file):
+        gcode = MappedGCode(long_file)
+
+        assert gcode.line_at(999)[1].raw == "G1 X98 Y98 E990"
+        assert gcode.line_at(0)[1].raw == "G1 Z0.2"
+        assert gcode.line_at(1000) is None
+
+    def test_empty_file(self, tmp_path):
+        path = tmp_path / "empty.gcode"
+        path.write_bytes(b"")
+
+        gcode = MappedGCode(str(path))
+
+        assert len(gcode) == 0
+        assert not gcode.has_index(0)
+        assert gcode.layer_count == 0
+        gcode.close()
+
+    def test_appended_lines_come_after_the_file(self, sample_file):
+        gcode = MappedGCode(sample_file)
+        count = len(gcode)
+
+        gcode.append("M117 done")
+
+        assert gcode.line_at(count) == (gcode.layer_count, gcode._appended[0])
+        assert gcode.line_at(count)[1].raw == "M117 done"
+        assert gcode.idxs(count) == (gcode.layer_count, 0)
+        assert len(gcode) == count + 1
+
+
+class TestPrintcoreMapped(object):
+    def test_the_same_lines_are_sent(self, online_printcore, fake_printer, long_file, print_gcode):
+        with open(long_file) as fh:
+            mapped = print_gcode(MappedGCode(long_file))
+            del fake_printer.written[:]
+            online_printcore.lineno = 0
+            online_printcore.queueindex = 0
+            loaded = print_gcode(LightGCode([line.strip() for line in fh]))
+
+        assert mapped == loaded
+
+    def test_resuming_picks_up_the_layer(self, online_printcore, fake_printer, long_file, print_gcode):
+        layers = []
+        online_printcore.layerchangecb = layers.append
+        online_printcore.queueindex = 550
+
+        print_gcode(MappedGCode(long_file))
+
+        assert layers == [6, 7, 8, 9]
+        assert fake_printer.written[0].split(b"*")[0].endswith(b"G1 X49 Y49 E545")
+
+    def test_layer_progress_knows_the_layer_count(self, online_printcore, long_file):
+        online_printcore.mainqueue = MappedGCode(long_file)
+        online_printcore.queueindex = 0
+
+        assert online_printcore.layer_progress() == (1, 10)
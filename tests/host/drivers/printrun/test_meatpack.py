@@ -0,0 +1,100 @@
+import pytest
+
+from bqclient.host.drivers.printrun import meatpack
+from bqclient.host.drivers.printrun.meatpack import MeatPacker, MeatUnpacker, command, parse_state, \
+    without_spaces
+from bqclient.host.drivers.printrun.printcore import py_checksum, py_frame
+
+LINES = [
+    py_frame(b"G1 X10.5 Y20.25 E1.2345 F1800", 1),
+    py_frame(b"G28", 22),
+    py_frame(b"M110", -1),
+    py_frame(b"M117 Printing cube.gcode", 333),
+    b"M105\n",
+    b"G1 X1\n",
+    b"T0\n",
+    b"\n",
+]
+
+
+def unpack(data, no_spaces=False):
+    unpacker = MeatUnpacker()
+    enable = command(meatpack.ENABLE_PACKING)
+    if no_spaces:
+        enable += command(meatpack.ENABLE_NO_SPACES)
+    return unpacker.feed(enable + data)
+
+
+class TestMeatPacker(object):
+    def test_packs_two_characters_to_a_byte(self):
+        assert MeatPacker().pack(b"G1\n") == bytes([0x1D, 0xCC])
+
+    def test_characters_it_cant_pack_follow_as_is(self):
+        assert MeatPacker().pack(b"M1\n") == b"\x1fM\xcc"
+        assert MeatPacker().pack(b"MY\n") == b"\xffMY\xcc"
+
+    @pytest.mark.parametrize("line", LINES)
+    def test_round_trip(self, line):
+        assert unpack(MeatPacker().pack(line)) == line
+
+    def test_round_trip_of_many_lines(self):
+        data = b"".join(LINES * 3)
+
+        assert unpack(MeatPacker().pack(data)) == data
+
+    def test_no_spaces(self):
+        packed = MeatPacker(no_spaces=True).pack(b"".join(LINES))
+
+        unpacked = unpack(packed, no_spaces=True).split(b"\n")
+
+        assert unpacked[0] == without_spaces(LINES[0][:-1])
+        assert unpacked[0].startswith(b"N1G1X10.5Y20.25E1.2345F1800*")
+        # Only G lines lose their spaces
+        assert unpacked[3] == LINES[3][:-1]
+        assert unpacked[4:] == [b"M105", b"G1X1", b"T0", b"", b""]
+        # Moves take fewer bytes, text takes more
+        assert len(MeatPacker(no_spaces=True).pack(LINES[0])) < len(MeatPacker().pack(LINES[0]))
+        assert len(MeatPacker(no_spaces=True).pack(LINES[3])) > len(MeatPacker().pack(LINES[3]))
+
+    @pytest.mark.parametrize("lineno, line", [(12, b"G1 X10 Y5"), (1, b"G1 X10"), (-1, b"G28 X Y")])
+    def test_without_spaces_keeps_the_checksum(self, lineno, line):
+        framed = py_frame(line, lineno)[:-1]
+
+        (body, _, checksum) = without_spaces(framed).rpartition(b"*")
+
+        assert b" " not in body
+        assert int(checksum) == py_checksum(body)
+
+
+class TestMeatUnpacker(object):
+    def test_reports_its_state_after_commands(self):
+        reports = []
+        unpacker = MeatUnpacker(report=reports.append)
+
+        unpacker.feed(command(meatpack.QUERY_CONFIG) + command(meatpack.ENABLE_PACKING) +
+                      command(meatpack.ENABLE_NO_SPACES) + command(meatpack.RESET_ALL))
+
+        assert reports == ["[MP] PV01 OFF ESP", "[MP] PV01 ON ESP", "[MP] PV01 ON NSP", "[MP] PV01 OFF ESP"]
+
+    def test_passes_lines_through_until_enabled(self):
+        unpacker = MeatUnpacker()
+
+        assert unpacker.feed(b"G1 X10\n") == b"G1 X10\n"
+        assert unpacker.feed(command(meatpack.ENABLE_PACKING) + MeatPacker().pack(b"G1 X10\n")) == b"G1 X10\n"
+        assert unpacker.feed(command(meatpack.DISABLE_PACKING) + b"G1 X10\n") == b"G1 X10\n"
+
+    def test_bytes_split_across_reads(self):
+        packed = command(meatpack.ENABLE_PACKING) + MeatPacker().pack(b"".join(LINES))
+        unpacker = MeatUnpacker()
+
+        assert b"".join(unpacker.feed(packed[i:i + 1]) for i in range(len(packed))) == b"".join(LINES)
+
+
+class TestParseState(object):
+    def test_state(self):
+        assert parse_state("[MP] PV01 ON NSP\n") == (True, True)
+        assert parse_state("[MP] PV01 OFF ESP") == (False, False)
+
+    def test_other_lines(self):
+        assert parse_state("ok") is None
+        assert parse_state("echo:[MP] PV01 ON NSP") is None
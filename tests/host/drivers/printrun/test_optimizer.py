@@ -0,0 +1,140 @@
+import random
+
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.optimizer import Optimizer, optimize_file, trim
+
+
+def optimize(lines):
+    return list(Optimizer().lines(lines))
+
+
+def print_file(seed, count=3000):
+    """Something like what a slicer makes, with the oddities the optimizer
+    has to leave alone"""
+    rand = random.Random(seed)
+    lines = ["; generated for the tests", "", "G28", "G21", "G90", "M82", "M104 S200", "G92 E0.00000",
+             "G1 Z0.200 F600.000"]
+    (x, y, z, e) = (100.0, 100.0, 0.2, 0.0)
+    for _ in range(count):
+        choice = rand.random()
+        if choice < 0.02:
+            z = round(z + 0.2, 2)
+            lines.extend(["; layer", "G1 Z%.3f F600.000" % z])
+        elif choice < 0.03:
+            lines.extend(["G91", "G1 Z0.400 F600", "G1 X0.000 Y5.000", "G1 Z-0.400", "G90",
+                          "G0 X%.3f Y%.3f F9000" % (x, y)])
+        elif choice < 0.04:
+            lines.extend(["M83", "G1 E-1.00000 F2400.000", "G1 E0 F2400", "G1 E1.00000", "M82",
+                          "G92 E0", "G1 E0.00000"])
+            e = 0.0
+        elif choice < 0.045:
+            lines.append(rand.choice(["G2 X%.3f Y%.3f I1 J1 E%.5f" % (x + 2, y + 2, e + 0.1), "T1", "T0",
+                                      "M106 S255", "M117 Hello", "G4 P10", "N5 G1 X1*44", ";@pause",
+                                      "G1 X(a)5", "g1 x10.500", "G20", "G21", "G92 X10 Y10"]))
+            # Don't guess where any of them left the printer
+            lines.append("G1 X%.3f Y%.3f" % (x, y))
+        else:
+            if rand.random() < 0.3:
+                x = round(x + rand.uniform(-5, 5), 3)
+            else:
+                y = round(y + rand.uniform(-5, 5), 3)
+            e += rand.uniform(0, 0.5)
+            feedrate = rand.choice(["F1800.000", "F1800", "F3000.000", ""])
+            comment = rand.choice(["", "", " ; perimeter"])
+            lines.append("G1 X%.3f Y%.3f E%.5f %s%s" % (x, y, e, feedrate, comment))
+    return lines
+
+
+def analyse(lines):
+    return gcoder.GCode(lines)
+
+
+def positions(gcode):
+    """Where every move leaves the printer, once"""
+    result = []
+    for line in gcode.lines:
+        if line.is_move:
+            position = (line.current_x, line.current_y, line.current_z)
+            if not result or result[-1] != position:
+                result.append(position)
+    return result
+
+
+class TestOptimizer(object):
+    def test_drops_comments_and_empty_lines(self):
+        assert optimize(["; start", "", "   ", "G28 ; home", "(note)", "M104 S200"]) == ["G28", "M104 S200"]
+
+    def test_keeps_host_commands(self):
+        assert optimize([";@pause", "G28"]) == [";@pause", "G28"]
+
+    @pytest.mark.parametrize("value, expected", [
+        ("10.500", "10.5"), ("10.000", "10"), ("10.", "10"), ("-0.000", "-0"), (".000", "0"),
+        ("100", "100"), ("0.05", "0.05"),
+    ])
+    def test_trims_trailing_zeros(self, value, expected):
+        assert trim(value) == expected
+
+    def test_drops_words_that_repeat_the_position(self):
+        lines = ["G90", "M82", "G1 X10.000 Y20.000 Z0.200 F1800.000", "G1 X10.000 Y25.000 F1800",
+                 "G1 X10 Y25 E1.0", "G1 Z0.2 F1800", "G1 X11"]
+
+        assert optimize(lines) == ["G90", "M82", "G1 X10 Y20 Z0.2 F1800", "G1 Y25", "G1 E1", "G1 X11"]
+
+    def test_keeps_words_while_the_mode_is_unknown(self):
+        assert optimize(["G1 X10", "G1 X10 F100", "G1 X10 F100"]) == ["G1 X10", "G1 X10 F100", "G1 X10"]
+
+    def test_relative_moves(self):
+        lines = ["G91", "G1 X5", "G1 X5 Y0", "M83", "G1 E0 X1", "G90", "G1 X5", "G1 X5"]
+
+        assert optimize(lines) == ["G91", "G1 X5", "G1 X5", "M83", "G1 X1", "G90", "G1 X5"]
+
+    def test_forgets_after_other_commands(self):
+        lines = ["G90", "G1 X5 F600", "G28", "G1 X5 F600", "G92 X0", "G1 X5", "M104 S200", "G1 X5",
+                 "G0 X5 F9000", "G1 F9000"]
+
+        assert optimize(lines) == ["G90", "G1 X5 F600", "G28", "G1 X5 F600", "G92 X0", "G1 X5",
+                                   "M104 S200", "G0 F9000", "G1 F9000"]
+
+    def test_leaves_odd_moves_alone(self):
+        lines = ["G90", "G1 X5", "G1 X5 X5", "G1 X5", "g1 x5", "G1 X5 S1"]
+
+        assert optimize(lines) == ["G90", "G1 X5", "G1 X5 X5", "G1 X5", "g1 x5", "G1 X5 S1"]
+
+    def test_reports_the_bytes_saved(self):
+        optimizer = Optimizer()
+        list(optimizer.lines(["; start", "G90", "G1 X10.000 ; move", "G1 X10.000"]))
+
+        stats = optimizer.stats
+        assert stats.lines_read == 4
+        assert stats.lines_written == 2
+        assert stats.bytes_read == len("G90\nG1 X10.000\nG1 X10.000\n")
+        assert stats.bytes_written == len("G90\nG1 X10\n")
+        assert stats.bytes_saved == stats.bytes_read - stats.bytes_written
+        assert "saved %d of" % stats.bytes_saved in str(stats)
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_moves_are_unchanged(self, seed):
+        lines = print_file(seed)
+        optimized = optimize(lines)
+
+        original = analyse(lines)
+        result = analyse(optimized)
+
+        assert positions(result) == positions(original)
+        assert result.filament_length == pytest.approx(original.filament_length)
+        assert [layer.z for layer in result.all_layers] == [layer.z for layer in original.all_layers]
+        assert (result.xmin, result.xmax, result.ymin, result.ymax, result.zmin, result.zmax) == \
+            (original.xmin, original.xmax, original.ymin, original.ymax, original.zmin, original.zmax)
+        assert sum(map(len, optimized)) < 0.8 * sum(map(len, lines))
+
+    def test_optimize_file(self, tmp_path):
+        source = tmp_path / "print.gcode"
+        source.write_text("\n".join(print_file(1, 200)) + "\n", encoding="utf-8")
+        destination = tmp_path / "optimized.gcode"
+
+        stats = optimize_file(str(source), str(destination))
+
+        assert destination.read_text(encoding="utf-8").splitlines() == optimize(print_file(1, 200))
+        assert stats.bytes_saved > 0
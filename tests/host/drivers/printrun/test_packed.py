@@ -0,0 +1,203 @@
+import tracemalloc
+
+import pytest
+
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.analysis_cache import AnalysisCache, load_gcode
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.packed import LineStore, PackedGCode, PackedLayer
+from bqclient.host.drivers.printrun.utils import RemainingTimeEstimator
+
+SAMPLE = [
+    "; generated for the tests",
+    "G28",
+    "M83",
+    "",
+    "G1 Z0.2 F600",
+    "G1 X10 Y10 E1.5",
+    "G1 X20 Y10 E1.5 ; infill",
+    "G1 Z0.6 ; hop",
+    "G1 X0 Y0",
+    "G1 Z0.2",
+    "M117 Grüße",
+    "   ",
+    "G1 Z0.4",
+    "G1 X10 Y10 E1.5",
+    "G1 X20 Y20 E1.5",
+]
+
+
+def layers(gcode):
+    return [([line.raw for line in layer], layer.z, layer.duration) for layer in gcode.all_layers]
+
+
+@pytest.fixture
+def long_lines():
+    lines = []
+    for layer in range(10):
+        lines.append("G1 Z%.1f F1200" % (0.2 * (layer + 1)))
+        for i in range(99):
+            lines.append("G1 X%d.125 Y%d.25 E%d.0625" % (i, i, layer * 99 + i + 1))
+    return lines
+
+
+class TestLineStore(object):
+    def test_lines(self):
+        store = LineStore(["G1 X1", "M117 Grüße", "G28"])
+
+        assert len(store) == 3
+        assert [line.raw for line in store] == ["G1 X1", "M117 Grüße", "G28"]
+        assert store[-1].raw == "G28"
+        assert [line.raw for line in store[1:]] == ["M117 Grüße", "G28"]
+        with pytest.raises(IndexError):
+            store[3]
+
+    def test_commands(self):
+        store = LineStore(["G1 X1", "G1 X2", "G28"])
+
+        store[0].command = "G1"
+        store[1].command = "G1"
+
+        assert [line.command for line in store] == ["G1", "G1", None]
+        assert store[0].x is None
+
+    def test_insert_and_delete(self):
+        store = LineStore(["G1 X1", "G1 X2", "G1 X3"])
+        store[2].command = "G1"
+        expected = ["G1 X1", "G1 X2", "G1 X3"]
+
+        gline = gcoder.Line("M400")
+        gcoder.split(gline)
+        store.insert(1, gline)
+        expected.insert(1, "M400")
+        store.insert(-1, "G4 P10")
+        expected.insert(-1, "G4 P10")
+        assert [line.raw for line in store] == expected
+        assert store[1].command == "M400"
+        assert store[-1].command == "G1"
+
+        del store[0:2]
+        del expected[0:2]
+        del store[-1]
+        del expected[-1]
+        assert [line.raw for line in store] == expected
+        store.append("G1 X4")
+        assert [line.raw for line in store] == expected + ["G1 X4"]
+
+
+class TestPackedGCode(object):
+    def test_matches_light_gcode(self):
+        packed = PackedGCode(SAMPLE)
+        expected = LightGCode(SAMPLE)
+
+        assert [line.raw for line in packed] == [line.raw for line in expected]
+        assert layers(packed) == layers(expected)
+        assert list(packed.layer_idxs) == list(expected.layer_idxs)
+        assert packed.filament_length == expected.filament_length
+        assert isinstance(packed.lines, LineStore)
+        assert all(isinstance(layer, PackedLayer) for layer in packed.all_layers[:-1])
+
+    def test_lines_are_looked_up_by_layer(self, long_lines):
+        gcode = PackedGCode(long_lines)
+
+        for index in (0, 1, 99, 100, 101, 999):
+            (layer, line) = gcode.idxs(index)
+            assert gcode.all_layers[layer][line].raw == long_lines[index]
+
+    def test_appended_lines(self):
+        gcode = PackedGCode(SAMPLE)
+        expected = LightGCode(SAMPLE)
+
+        for gcode_ in (gcode, expected):
+            gcode_.append("M117 done")
+            gcode_.append("G1 X5 E1")
+
+        assert layers(gcode) == layers(expected)
+        assert gcode.lines[-1].raw == "G1 X5 E1"
+        assert gcode.idxs(len(gcode) - 1) == expected.idxs(len(expected) - 1)
+
+    def test_prepend_and_rewrite_layers(self, long_lines):
+        gcode = PackedGCode(long_lines)
+        expected = LightGCode(long_lines)
+
+        for gcode_ in (gcode, expected):
+            gcode_.prepend_to_layer(["M117 layer 3", "M400"], 3)
+            gcode_.rewrite_layer(["G1 X1 E1", "G1 X2 E2"], 5)
+
+        assert [line.raw for line in gcode] == [line.raw for line in expected]
+        assert [[line.raw for line in layer] for layer in gcode.all_layers] == \
+            [[line.raw for line in layer] for layer in expected.all_layers]
+        assert list(gcode.line_idxs) == list(expected.line_idxs)
+
+    def test_remaining_time_estimate(self, long_lines):
+        packed = RemainingTimeEstimator(PackedGCode(long_lines))
+        expected = RemainingTimeEstimator(LightGCode(long_lines))
+
+        packed.update_layer(2, 30)
+        expected.update_layer(2, 30)
+
+        assert packed(250, 40) == expected(250, 40)
+
+    def test_empty(self):
+        gcode = PackedGCode()
+
+        assert len(gcode) == 0
+        gcode.append("G28")
+        assert gcode.lines[0].raw == "G28"
+
+    def test_uses_less_memory(self, long_lines):
+        data = [line.encode("utf-8") for line in long_lines * 10]
+
+        def size(gcode_class):
+            tracemalloc.start()
+            # New strings, like the ones read from a file
+            lines = [line.decode("utf-8") for line in data]
+            gcode = gcode_class(lines)
+            del lines
+            (current, _) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert len(gcode) == len(data)
+            return current
+
+        class PyLightGCode(LightGCode):
+            # tracemalloc doesn't see the strings GLightLine allocates
+            line_class = gcoder.PyLightLine
+
+        assert size(PackedGCode) * 2 < size(PyLightGCode)
+
+    def test_loaded_from_the_analysis_cache(self, tmp_path, long_lines):
+        path = tmp_path / "long.gcode"
+        path.write_text("\n".join(long_lines) + "\n")
+        cache = AnalysisCache(str(tmp_path / "cache"))
+
+        parsed = load_gcode(str(path), cache, PackedGCode)
+        cached = load_gcode(str(path), cache, PackedGCode)
+
+        assert isinstance(cached.lines, LineStore)
+        assert isinstance(cached.all_layers[0], PackedLayer)
+        assert layers(cached) == layers(parsed)
+
+
+class TestPrintcorePacked(object):
+    def test_the_same_lines_are_sent(self, online_printcore, fake_printer, long_lines, print_gcode):
+        packed = print_gcode(PackedGCode(long_lines))
+        del fake_printer.written[:]
+        online_printcore.lineno = 0
+        online_printcore.queueindex = 0
+        loaded = print_gcode(LightGCode(long_lines))
+
+        assert packed == loaded
+
+    def test_layer_changes_are_reported(self, online_printcore, long_lines, print_gcode):
+        layers = []
+        online_printcore.layerchangecb = layers.append
+
+        print_gcode(PackedGCode(long_lines))
+        packed = list(layers)
+        del layers[:]
+        online_printcore.lineno = 0
+        online_printcore.queueindex = 0
+        print_gcode(LightGCode(long_lines))
+
+        assert packed == layers
+        assert len(packed) == 9
@@ -0,0 +1,613 @@
+import os
+from threading import Thread, Event
+from unittest.mock import MagicMock
+
+import pytest
+
+from bqclient.host.drivers.printrun import meatpack
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.meatpack import MeatUnpacker
+from bqclient.host.drivers.printrun.printcore import LayerIndex, ResendHistory, ResendOutOfRange, frame, py_frame, \
+    py_checksum, checksum
+
+
+class TestPrintcoreFlowControl(object):
+    def test_sendnext_waits_for_the_firmware(self, online_printcore, fake_printer):
+        online_printcore.mainqueue = LightGCode(["G1 X1"])
+        online_printcore.printing = True
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+
+        assert sender.is_alive()
+        assert fake_printer.written == []
+
+        online_printcore._grant_credit()
+        sender.join(1)
+
+        assert not sender.is_alive()
+        assert len(fake_printer.written) == 1
+        assert fake_printer.written[0].startswith(b"N0 G1 X1*")
+        assert not online_printcore.clear
+
+    def test_stopping_the_print_wakes_a_waiting_sender(self, online_printcore, fake_printer):
+        online_printcore.mainqueue = LightGCode(["G1 X1"])
+        online_printcore.printing = True
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+        assert sender.is_alive()
+
+        online_printcore.printing = False
+        sender.join(1)
+
+        assert not sender.is_alive()
+        assert fake_printer.written == []
+
+    def test_an_ok_from_the_firmware_grants_credit(self, online_printcore, fake_printer):
+        online_printcore.printing = True
+        online_printcore.clear = False
+
+        listener = Thread(target=online_printcore._listen, daemon=True)
+        listener.start()
+        try:
+            assert fake_printer.reading.wait(1)
+            online_printcore.clear = False
+
+            fake_printer.reply("ok")
+            with online_printcore._flow:
+                assert online_printcore._flow.wait_for(lambda: online_printcore.clear, 1)
+        finally:
+            online_printcore.stop_read_thread = True
+            listener.join(1)
+
+
+class TestPrintcoreSlidingWindow(object):
+    def _start_print(self, core, lines, window_size):
+        core.window_size = window_size
+        core.mainqueue = LightGCode(lines)
+        core.printing = True
+        core.clear = True
+
+    def test_lines_are_streamed_up_to_the_window_size(self, online_printcore, fake_printer):
+        self._start_print(online_printcore, ["G1 X1", "G1 X2", "G1 X3", "G1 X4"], 3)
+
+        for _ in range(3):
+            online_printcore._sendnext()
+
+        assert len(fake_printer.written) == 3
+        assert not online_printcore.clear
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+        assert sender.is_alive()
+
+        online_printcore._grant_credit()
+        sender.join(1)
+        assert fake_printer.written[3].startswith(b"N3 G1 X4*")
+
+    def test_credit_never_exceeds_the_window(self, online_printcore):
+        online_printcore.window_size = 2
+        online_printcore.clear = True
+
+        online_printcore._grant_credit()
+
+        assert online_printcore._credits == 2
+
+    def test_duplicate_resend_requests_are_only_honored_once(self, online_printcore, fake_printer):
+        self._start_print(online_printcore, ["G1 X1", "G1 X2", "G1 X3"], 3)
+
+        listener = Thread(target=online_printcore._listen, daemon=True)
+        listener.start()
+        try:
+            assert fake_printer.reading.wait(1)
+            for _ in range(3):
+                online_printcore._sendnext()
+
+            for reply in ["Error:checksum mismatch, Last Line: -1", "Resend: 0", "ok",
+                          "Error:Line Number is not Last Line Number+1, Last Line: -1", "Resend: 0", "ok",
+                          "Error:Line Number is not Last Line Number+1, Last Line: -1", "Resend: 0", "ok"]:
+                fake_printer.reply(reply)
+            with online_printcore._flow:
+                assert online_printcore._flow.wait_for(lambda: online_printcore._credits == 3, 1)
+        finally:
+            online_printcore.stop_read_thread = True
+            listener.join(1)
+
+        assert online_printcore.resendfrom == 0
+
+        for _ in range(3):
+            online_printcore._sendnext()
+
+        assert fake_printer.written[3:] == fake_printer.written[:3]
+
+
+    def test_the_print_ends_once_its_last_lines_are_acknowledged(self, online_printcore, fake_printer):
+        self._start_print(online_printcore, ["G1 X1", "G1 X2", "G1 X3"], 4)
+        for _ in range(3):
+            online_printcore._sendnext()
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+        assert sender.is_alive()
+        assert online_printcore.printing
+
+        online_printcore._request_resend(2)
+        online_printcore._grant_credit()
+        sender.join(1)
+        assert not sender.is_alive()
+
+        online_printcore._sendnext()
+        assert fake_printer.written[3] == fake_printer.written[2]
+
+        online_printcore.clear = True
+        online_printcore._sendnext()
+        assert not online_printcore.printing
+        assert fake_printer.written[4].startswith(b"N-1 M110*")
+
+
+class TestResendHistory(object):
+    def test_recent_lines_can_be_resent(self):
+        history = ResendHistory(4)
+
+        for lineno in range(10):
+            history[lineno] = "N%d" % lineno
+
+        assert history[6] == "N6"
+        assert history[9] == "N9"
+        assert 6 in history
+
+    def test_lines_outside_of_the_window_raise(self):
+        history = ResendHistory(4)
+
+        for lineno in range(10):
+            history[lineno] = "N%d" % lineno
+
+        assert 5 not in history
+        with pytest.raises(ResendOutOfRange):
+            history[5]
+
+    def test_memory_stays_flat_during_a_long_print(self, online_printcore):
+        online_printcore.mainqueue = LightGCode(["G1 X%d" % i for i in range(500)])
+        online_printcore.printing = True
+        online_printcore.sentlines = ResendHistory(8)
+
+        for _ in range(500):
+            online_printcore.clear = True
+            online_printcore._sendnext()
+
+        assert len(online_printcore.sentlines._lines) == 8
+        assert len(online_printcore.sent) == 0
+
+    def test_a_resend_outside_the_history_stops_the_print(self, online_printcore, fake_printer):
+        online_printcore.mainqueue = LightGCode(["G1 X%d" % i for i in range(20)])
+        online_printcore.printing = True
+        online_printcore.sentlines = ResendHistory(8)
+        online_printcore.errorcb = MagicMock()
+
+        for _ in range(20):
+            online_printcore.clear = True
+            online_printcore._sendnext()
+
+        online_printcore.clear = True
+        online_printcore.resendfrom = 2
+        online_printcore._sendnext()
+
+        assert not online_printcore.printing
+        assert "resend line 2" in online_printcore.print_error
+        online_printcore.errorcb.assert_called_once()
+        assert len(fake_printer.written) == 20
+
+
+class TestSendLog(object):
+    def test_the_send_log_is_capped(self, online_printcore):
+        online_printcore.send_log_size = 3
+
+        for i in range(5):
+            online_printcore._send("G1 X%d" % i)
+
+        assert list(online_printcore.sent) == ["G1 X2", "G1 X3", "G1 X4"]
+
+
+class TestHooks(object):
+    def test_no_hooks_by_default(self, online_printcore):
+        hooks = online_printcore._hooks
+
+        assert (hooks.send, hooks.recv, hooks.temp, hooks.preprintsend, hooks.printsend, hooks.layerchange) == \
+               ((), (), (), (), (), ())
+
+    def test_assigning_a_callback_rebuilds_the_table(self, online_printcore):
+        sent = []
+        online_printcore.sendcb = lambda command, gline: sent.append(command)
+
+        online_printcore._send("M105")
+
+        assert sent == ["M105"]
+        assert online_printcore.sendcb is not None
+
+        online_printcore.sendcb = None
+
+        assert online_printcore._hooks.send == ()
+
+    def test_event_handlers_are_added_to_the_table(self, online_printcore):
+        handler = MagicMock()
+        online_printcore.addEventHandler(handler)
+
+        online_printcore._send("M105")
+
+        handler.on_send.assert_called_once_with("M105", None)
+
+    def test_layers_are_not_looked_up_without_listeners(self, online_printcore):
+        online_printcore.mainqueue = MagicMock()
+
+        online_printcore._check_layerchange(5, 1)
+
+        online_printcore.mainqueue.idxs.assert_not_called()
+
+    def test_layer_changes_are_reported(self, online_printcore):
+        layers = []
+        online_printcore.layerchangecb = layers.append
+        online_printcore.mainqueue = LightGCode(["G1 Z0.2", "G1 X1", "G1 Z0.4", "G1 X2"])
+
+        for index in range(4):
+            online_printcore._check_layerchange(index, online_printcore.mainqueue.idxs(index)[0])
+
+        assert layers == [online_printcore.mainqueue.idxs(2)[0]]
+
+    def test_a_failing_callback_is_reported(self, online_printcore):
+        errors = []
+        online_printcore.errorcb = errors.append
+        online_printcore.recvcb = MagicMock(side_effect=ValueError)
+        online_printcore.printer.reply("ok")
+
+        online_printcore._readline()
+
+        assert "ValueError" in errors[0]
+
+
+def layered_gcode(layers=5, lines_per_layer=4):
+    lines = []
+    for layer in range(layers):
+        lines.append("G1 Z%.1f" % (0.2 * (layer + 1)))
+        lines.extend("G1 X%d Y%d E%d" % (i, i, i) for i in range(lines_per_layer))
+    return LightGCode(lines)
+
+
+class TestLayerIndex(object):
+    def test_starts_match_the_gcode(self):
+        gcode = layered_gcode()
+
+        index = LayerIndex(gcode)
+
+        assert index.count == len(index) - 1
+        for position, start in enumerate(index.starts[:index.count]):
+            assert gcode.idxs(start)[0] == index.layers[position]
+            assert start == 0 or gcode.idxs(start - 1)[0] != index.layers[position]
+        assert (index.starts[-1], index.layers[-1]) == (len(gcode), gcode.append_layer_id)
+
+    def test_find(self):
+        gcode = layered_gcode()
+        index = LayerIndex(gcode)
+
+        for i in range(len(gcode)):
+            assert index.layers[index.find(i)] == gcode.idxs(i)[0]
+
+    def test_print_lines_are_looked_up_through_the_cursor(self, online_printcore):
+        gcode = layered_gcode()
+        online_printcore.mainqueue = gcode
+        online_printcore.queueindex = 7
+        online_printcore._reset_render()
+
+        for i in range(7, len(gcode)):
+            (layer, line) = gcode.idxs(i)
+            assert online_printcore._next_print_line() == (i, layer, gcode.all_layers[layer][line])
+        assert online_printcore._next_print_line() is None
+
+    def test_appended_lines_are_found(self, online_printcore):
+        gcode = layered_gcode(layers=2)
+        online_printcore.mainqueue = gcode
+        online_printcore._reset_render()
+        while online_printcore._next_print_line() is not None:
+            pass
+
+        gcode.append("M117 appended")
+
+        (index, layer, gline) = online_printcore._next_print_line()
+        assert layer == gcode.append_layer_id
+        assert gline.raw == "M117 appended"
+
+    def test_every_layer_change_is_reported_once(self, online_printcore, fake_printer):
+        gcode = layered_gcode()
+        layers = []
+        online_printcore.layerchangecb = layers.append
+        online_printcore.mainqueue = gcode
+        online_printcore.printing = True
+        online_printcore.window_size = 4
+
+        for _ in range(len(gcode)):
+            online_printcore.clear = True
+            online_printcore._sendnext()
+
+        assert layers == sorted({gcode.idxs(i)[0] for i in range(len(gcode))})[1:]
+
+    def test_layer_progress(self, online_printcore):
+        online_printcore.mainqueue = layered_gcode(layers=5, lines_per_layer=4)
+
+        online_printcore.queueindex = 0
+        assert online_printcore.layer_progress()[0] == 1
+        online_printcore.queueindex = len(online_printcore.mainqueue) - 1
+        assert online_printcore.layer_progress() == (online_printcore._layers.count,
+                                                     online_printcore._layers.count)
+
+    def test_no_progress_without_a_print(self, online_printcore):
+        assert online_printcore.layer_progress() == (0, 0)
+
+
+class TestAnalyzer(object):
+    def test_commands_are_not_analyzed_by_default(self, online_printcore):
+        online_printcore.analyzer = MagicMock()
+
+        online_printcore._send("G1 X10")
+
+        online_printcore.analyzer.append.assert_not_called()
+        assert online_printcore.analyzer_thread is None
+
+    def test_the_analyzer_tracks_the_position(self, online_printcore):
+        online_printcore.analyze = True
+
+        try:
+            online_printcore._send("G1 X10 Y20")
+            online_printcore._send("G1 Z0.3")
+            online_printcore._analyzer_queue.join()
+
+            assert (online_printcore.analyzer.abs_x, online_printcore.analyzer.abs_y,
+                    online_printcore.analyzer.abs_z) == pytest.approx((10, 20, 0.3))
+        finally:
+            online_printcore._stop_analyzer()
+
+    def test_a_slow_analyzer_does_not_delay_writes(self, online_printcore, fake_printer):
+        release = Event()
+        online_printcore.analyze = True
+        online_printcore.analyzer = MagicMock()
+        online_printcore.analyzer.append.side_effect = lambda *args, **kwargs: release.wait(1)
+
+        try:
+            for i in range(3):
+                online_printcore._send("G1 X%d" % i)
+
+            assert len(fake_printer.written) == 3
+        finally:
+            release.set()
+            online_printcore._stop_analyzer()
+
+        assert online_printcore.analyzer.append.call_count == 3
+
+
+class TestWriteBatching(object):
+    def _start_print(self, core, lines, window_size, batch_size):
+        core.window_size = window_size
+        core.write_batch_size = batch_size
+        core.write_batch_latency = 60
+        core.mainqueue = LightGCode(lines)
+        core.printing = True
+        core.clear = True
+
+    def test_lines_are_written_together(self, online_printcore, fake_printer):
+        self._start_print(online_printcore, ["G1 X%d" % i for i in range(4)], 8, 4)
+
+        for _ in range(3):
+            online_printcore._sendnext()
+        assert fake_printer.written == []
+
+        online_printcore._sendnext()
+
+        assert len(fake_printer.written) == 1
+        assert fake_printer.written[0] == b"".join(frame(("G1 X%d" % i).encode('ascii'), i) for i in range(4))
+
+    def test_the_batch_is_flushed_before_waiting_on_the_firmware(self, online_printcore, fake_printer):
+        self._start_print(online_printcore, ["G1 X%d" % i for i in range(3)], 2, 8)
+
+        online_printcore._sendnext()
+        online_printcore._sendnext()
+        assert fake_printer.written == []
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+        assert sender.is_alive()
+        assert len(fake_printer.written) == 1
+
+        online_printcore._grant_credit()
+        sender.join(1)
+        online_printcore._flush_writes()
+        assert fake_printer.written[1].startswith(b"N2 G1 X2*")
+
+    def test_the_batch_is_flushed_after_the_latency(self, online_printcore, fake_printer):
+        self._start_print(online_printcore, ["G1 X1", "G1 X2"], 8, 8)
+        online_printcore.write_batch_latency = 0
+
+        online_printcore._sendnext()
+
+        assert len(fake_printer.written) == 1
+
+    def test_commands_outside_of_a_print_are_written_right_away(self, online_printcore, fake_printer):
+        online_printcore.write_batch_size = 8
+
+        online_printcore._send("M105")
+
+        assert fake_printer.written == [b"M105\n"]
+
+
+class TestMeatPack(object):
+    def test_lines_are_packed_once_online(self, online_printcore, fake_printer):
+        online_printcore.online = False
+        online_printcore.meatpack = True
+
+        online_printcore._went_online()
+        online_printcore._send("G1 X10", 1, True)
+        online_printcore._send("M105")
+
+        unpacker = MeatUnpacker()
+        assert online_printcore.packing
+        assert unpacker.feed(b"".join(fake_printer.written)) == \
+            meatpack.without_spaces(frame(b"G1 X10", 1)[:-1]) + b"\nM105\n"
+        assert unpacker.active and unpacker.no_spaces
+        # Resends are packed as they are written
+        assert online_printcore.sentlines[1] == frame(b"G1 X10", 1)
+
+    def test_auto_needs_the_firmware_to_answer(self, online_printcore, fake_printer):
+        online_printcore.online = False
+        online_printcore.meatpack = "auto"
+
+        online_printcore._went_online()
+        online_printcore._send("M105")
+
+        assert not online_printcore.packing
+        assert fake_printer.written == [b"M105\n"]
+
+    def test_the_probe_resets_meatpack(self, online_printcore, fake_printer):
+        online_printcore.meatpack = "auto"
+
+        online_printcore._send_probe()
+        online_printcore._handle_reply(online_printcore._classifier.classify("[MP] PV01 OFF ESP"))
+
+        assert fake_printer.written == [meatpack.command(meatpack.RESET_ALL), b"M105\n"]
+        assert online_printcore._meatpack_state == (False, False)
+        # The report isn't an ok
+        assert not online_printcore.clear
+
+
+class TestPrintcorePrerender(object):
+    def test_lines_are_rendered_while_waiting_on_the_firmware(self, online_printcore, fake_printer):
+        online_printcore.mainqueue = LightGCode(["G1 X1 ; comment", "G1 X2", "G1 X3"])
+        online_printcore.printing = True
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+
+        assert [entry[5] for entry in online_printcore._rendered] == [
+            b"N0 G1 X1*97\n",
+            b"N1 G1 X2*99\n",
+            b"N2 G1 X3*97\n",
+        ]
+
+        online_printcore._grant_credit()
+        sender.join(1)
+
+        assert fake_printer.written == [b"N0 G1 X1*97\n"]
+        assert online_printcore.queueindex == 1
+        assert online_printcore.lineno == 1
+        assert len(online_printcore._rendered) == 2
+
+    def test_rendered_lines_match_the_lines_sent_inline(self, online_printcore, fake_printer):
+        lines = ["G28", "; just a comment", "G1 X1 Y2 (inline)", "M104 S200"]
+        online_printcore.mainqueue = LightGCode(lines)
+        online_printcore.printing = True
+
+        for _ in range(len(lines)):
+            online_printcore.clear = True
+            online_printcore._sendnext()
+
+        for lineno, command in enumerate(["G28", "G1 X1 Y2", "M104 S200"]):
+            assert fake_printer.written[lineno] == frame(command.encode('ascii'), lineno)
+
+    def test_nothing_is_rendered_ahead_when_a_presend_hook_is_registered(self, online_printcore):
+        online_printcore.mainqueue = LightGCode(["G1 X1", "G1 X2"])
+        online_printcore.printing = True
+        online_printcore.preprintsendcb = MagicMock(side_effect=lambda gline, next_gline: gline)
+
+        sender = Thread(target=online_printcore._sendnext, daemon=True)
+        sender.start()
+        sender.join(0.1)
+
+        assert len(online_printcore._rendered) == 0
+        online_printcore.preprintsendcb.assert_not_called()
+
+        online_printcore._grant_credit()
+        sender.join(1)
+
+        online_printcore.preprintsendcb.assert_called_once()
+
+
+class TestFraming(object):
+    def test_python_checksum_matches_the_reference(self):
+        command = b"N12 G1 X10.5 Y3 E0.25"
+
+        assert py_checksum(command) == _reference_checksum(command)
+
+    def test_python_frame(self):
+        assert py_frame(b"G1 X1", 0) == b"N0 G1 X1*97\n"
+        assert py_frame(b"M110", -1) == b"N-1 M110*15\n"
+
+    def test_active_implementation_matches_the_python_one(self):
+        for lineno in [-1, 0, 9, 10, 99, 100, 123456789]:
+            for command in [b"G28", b"G1 X1.25 Y-3 E0.0125 F1800", b"M117 ***", b""]:
+                assert frame(command, lineno) == py_frame(command, lineno)
+                assert checksum(command) == py_checksum(command)
+
+
+def _reference_checksum(command):
+    cs = 0
+    for c in command:
+        cs ^= c
+    return cs
+
+
+class PipePrinter(object):
+    """A printer whose replies come through a real file descriptor"""
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.written = []
+
+    def fileno(self):
+        return self.read_fd
+
+    def reply(self, data):
+        os.write(self.write_fd, data)
+
+    def write(self, data):
+        self.written.append(data)
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class TestPrintcoreReader(object):
+    def test_replies_are_read_through_the_selector(self, online_printcore):
+        printer = PipePrinter()
+        online_printcore.printer = printer
+        online_printcore._open_reader()
+
+        printer.reply(b"ok T:21.0 /0.0\nstar")
+        assert online_printcore._readline() == "ok T:21.0 /0.0\n"
+        assert online_printcore._readline() == ""
+
+        printer.reply(b"t\n")
+        assert online_printcore._readline() == "start\n"
+
+        online_printcore._close_reader()
+        printer.close()
+
+    def test_a_closed_port_stops_the_reader(self, online_printcore):
+        printer = PipePrinter()
+        online_printcore.printer = printer
+        online_printcore.errorcb = MagicMock()
+        online_printcore._open_reader()
+
+        os.close(printer.write_fd)
+
+        assert online_printcore._readline() is None
+        online_printcore.errorcb.assert_called_once()
+
+        online_printcore._close_reader()
+        os.close(printer.read_fd)
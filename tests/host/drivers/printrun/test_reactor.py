@@ -0,0 +1,192 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.printcore import printcore
+from bqclient.host.drivers.printrun.reactor import Reactor
+from bqclient.host.drivers.printrun.streaming import StreamingGCode
+from bqclient.host.drivers.printrun.virtual_printer import VirtualPrinter
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith("win"), reason="Needs pipes and pseudo-terminals")
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def reactor():
+    reactor = Reactor()
+    yield reactor
+    reactor.stop()
+
+
+class TestReactor(object):
+    def test_calls_run_on_the_reactor_thread(self, reactor):
+        threads = []
+
+        reactor.call(lambda: threads.append(threading.current_thread()))
+
+        assert threads == [reactor._thread]
+        assert threads[0] is not threading.current_thread()
+
+    def test_call_returns_the_result(self, reactor):
+        assert reactor.call(lambda a, b: a + b, 1, 2) == 3
+
+    def test_timers_run_in_order(self, reactor):
+        calls = []
+
+        reactor.call_later(0.05, calls.append, 2)
+        reactor.call_later(0.01, calls.append, 1)
+        cancelled = reactor.call_later(0.02, calls.append, 3)
+        cancelled.cancel()
+
+        assert wait_for(lambda: len(calls) == 2)
+        time.sleep(0.05)
+        assert calls == [1, 2]
+
+    def test_lines_are_read_from_registered_ports(self, reactor):
+        read_fd, write_fd = os.pipe()
+        lines = []
+        try:
+            reactor.register(read_fd, lines.append, lambda error: None)
+
+            os.write(write_fd, b"ok\nok T:20")
+            os.write(write_fd, b"\n")
+
+            assert wait_for(lambda: len(lines) == 2)
+            assert lines == [b"ok\n", b"ok T:20\n"]
+        finally:
+            reactor.unregister(read_fd)
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_a_failing_call_does_not_stop_the_reactor(self, reactor):
+        reactor.call_soon(lambda: 1 / 0)
+
+        assert reactor.call(lambda: "still running") == "still running"
+
+
+class TestPrintcoreOnAReactor(object):
+    @pytest.fixture
+    def printers(self, reactor):
+        pairs = []
+        for _ in range(3):
+            printer = VirtualPrinter()
+            printer.start()
+            core = printcore()
+            core.reactor = reactor
+            core.connect(printer.port, 115200)
+            pairs.append((printer, core))
+        try:
+            assert wait_for(lambda: all(core.online for _, core in pairs))
+            yield pairs
+        finally:
+            for printer, core in pairs:
+                core.disconnect()
+                printer.stop()
+
+    def test_no_threads_are_started_per_printer(self, printers):
+        for _, core in printers:
+            assert core.read_thread is None
+            assert core.send_thread is None
+            assert core.print_thread is None
+
+    @pytest.mark.parametrize("window_size", [1, 4])
+    def test_printers_print_side_by_side(self, printers, window_size):
+        lines = ["G1 X%d Y%d" % (i, i) for i in range(300)]
+        for printer, core in printers:
+            printer.corrupt(100)
+            core.window_size = window_size
+            core.startprint(LightGCode(lines))
+
+        assert wait_for(lambda: not any(core.printing for _, core in printers))
+        for printer, _ in printers:
+            assert printer.received == lines
+
+    @pytest.mark.parametrize("window_size", [1, 4, 16])
+    def test_printers_print_through_random_resends(self, printers, window_size):
+        lines = ["G1 X%d Y%d" % (i, i) for i in range(200)]
+        for printer, core in printers:
+            printer.resend_rate = 0.05
+            core.window_size = window_size
+            core.startprint(LightGCode(lines))
+
+        assert wait_for(lambda: not any(core.printing for _, core in printers))
+        for printer, _ in printers:
+            assert printer.received == lines
+            assert printer.resends_requested > 0
+
+    def test_a_failing_send_is_reported(self, printers):
+        printer, core = printers[0]
+        errors = []
+        core.errorcb = errors.append
+
+        def fail():
+            raise RuntimeError("port went away")
+        core._send_print_line = fail
+        core.startprint(LightGCode(["G1 X1", "G1 X2"]))
+
+        assert wait_for(lambda: errors)
+        assert errors[0].startswith("Print thread died")
+        assert "port went away" in errors[0]
+
+    def test_commands_are_sent_right_away(self, printers):
+        printer, core = printers[0]
+        replies = []
+        core.tempcb = replies.append
+
+        core.send_now("M105")
+
+        assert wait_for(lambda: replies)
+
+    def test_pause_and_resume(self, printers):
+        printer, core = printers[0]
+        printer.move_time = 0.002
+        ended = []
+        core.endcb = lambda: ended.append(True)
+        lines = ["G1 X%d" % i for i in range(200)]
+
+        core.startprint(LightGCode(lines))
+        assert wait_for(lambda: len(printer.received) > 10)
+        core.pause()
+
+        assert not core.printing
+        assert ended == [True]
+        sent = len(printer.received)
+        time.sleep(0.05)
+        assert len(printer.received) == sent
+
+        core.resume()
+
+        assert wait_for(lambda: not core.printing)
+        assert printer.received == lines
+
+    def test_pause_and_resume_a_streamed_print(self, printers, tmp_path):
+        printer, core = printers[0]
+        printer.move_time = 0.0005
+        lines = ["G1 X%d" % i for i in range(1000)]
+        path = tmp_path / "long.gcode"
+        path.write_text("\n".join(lines) + "\n")
+        gcode = StreamingGCode(str(path), chunk_lines=100, keep_chunks=2)
+
+        core.startprint(gcode)
+        assert wait_for(lambda: len(printer.received) > 500)
+        core.pause()
+        # The first lines aren't buffered anymore
+        assert gcode._chunks[0].start > 0
+
+        core.resume()
+
+        assert wait_for(lambda: not core.printing)
+        assert printer.received == lines
+        gcode.close()
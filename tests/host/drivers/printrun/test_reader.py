@@ -0,0 +1,89 @@
+import os
+from unittest.mock import MagicMock
+
+import pytest
+
+from bqclient.host.drivers.printrun.reader import LineSplitter, SelectorReader
+
+
+@pytest.fixture
+def pipes():
+    created = []
+
+    def _pipe():
+        read_fd, write_fd = os.pipe()
+        created.append(read_fd)
+        created.append(write_fd)
+        return read_fd, write_fd
+
+    yield _pipe
+
+    for fd in created:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+class TestLineSplitter(object):
+    def test_complete_lines_are_returned_with_their_newline(self):
+        splitter = LineSplitter()
+
+        assert splitter.feed(b"ok\nok T:20.0\n") == [b"ok\n", b"ok T:20.0\n"]
+
+    def test_partial_lines_are_kept_until_completed(self):
+        splitter = LineSplitter()
+
+        assert splitter.feed(b"o") == []
+        assert splitter.feed(b"k\nRes") == [b"ok\n"]
+        assert splitter.feed(b"end: 3\n") == [b"Resend: 3\n"]
+
+    def test_clear_drops_partial_lines(self):
+        splitter = LineSplitter()
+        splitter.feed(b"garbage")
+
+        splitter.clear()
+
+        assert splitter.feed(b"ok\n") == [b"ok\n"]
+
+
+class TestSelectorReader(object):
+    def test_lines_are_dispatched_to_the_port_they_came_from(self, pipes):
+        first_read, first_write = pipes()
+        second_read, second_write = pipes()
+        first, second = MagicMock(), MagicMock()
+
+        reader = SelectorReader()
+        reader.register(first_read, first, MagicMock())
+        reader.register(second_read, second, MagicMock())
+
+        os.write(first_write, b"ok\n")
+        os.write(second_write, b"start\nok\n")
+        while reader.poll(0.1):
+            pass
+
+        assert [c[0][0] for c in first.call_args_list] == [b"ok\n"]
+        assert [c[0][0] for c in second.call_args_list] == [b"start\n", b"ok\n"]
+        reader.close()
+
+    def test_poll_times_out_without_data(self, pipes):
+        read_fd, _ = pipes()
+        reader = SelectorReader()
+        reader.register(read_fd, MagicMock(), MagicMock())
+
+        assert not reader.poll(0.01)
+        reader.close()
+
+    def test_end_of_file_closes_the_port(self, pipes):
+        read_fd, write_fd = pipes()
+        on_close = MagicMock()
+        reader = SelectorReader()
+        reader.register(read_fd, MagicMock(), on_close)
+
+        os.close(write_fd)
+        reader.poll(0.1)
+
+        on_close.assert_called_once()
+        assert isinstance(on_close.call_args[0][0], OSError)
+        assert len(reader) == 0
+        reader.close()
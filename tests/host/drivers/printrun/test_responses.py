@@ -0,0 +1,70 @@
+from bqclient.host.drivers.printrun.responses import ResponseClassifier, parse_resend, OTHER, OK, TEMP, \
+    RESEND, ERROR, BUSY, ECHO, GREETING, DEBUG, MEATPACK
+
+
+class TestParseResend(object):
+    def test_teacup_style(self):
+        assert parse_resend("rs N2 Expected checksum 67") == 2
+
+    def test_marlin_style(self):
+        assert parse_resend("Resend: 3") == 3
+
+    def test_no_line_number(self):
+        assert parse_resend("Resend: garbage") is None
+
+
+class TestResponseClassifier(object):
+    def setup_method(self):
+        self.classifier = ResponseClassifier(['start', 'Grbl '])
+
+    def test_ok(self):
+        assert self.classifier.classify("ok\n").kind == OK
+
+    def test_ok_with_temperature(self):
+        response = self.classifier.classify("ok T:200.0 /200.0 B:60.0 /60.0\n")
+
+        assert response.kind == OK | TEMP
+        assert response.line == "ok T:200.0 /200.0 B:60.0 /60.0\n"
+
+    def test_temperature_report(self):
+        assert self.classifier.classify(" T:200.0 /200.0\n").kind == TEMP
+
+    def test_greetings(self):
+        assert self.classifier.classify("start\n").kind == GREETING
+        assert self.classifier.classify("Grbl 1.1f ['$' for help]\n").kind == GREETING
+
+    def test_error(self):
+        assert self.classifier.classify("Error:Line Number is not Last Line Number+1\n").kind == ERROR
+
+    def test_resend(self):
+        response = self.classifier.classify("Resend: 3\n")
+
+        assert response.kind == RESEND
+        assert response.resend == 3
+
+    def test_resend_is_case_insensitive(self):
+        assert self.classifier.classify("resend: 4\n").resend == 4
+        assert self.classifier.classify("RESEND: 5\n").resend == 5
+
+    def test_teacup_resend(self):
+        response = self.classifier.classify("rs N2 Expected checksum 67\n")
+
+        assert response.kind == RESEND
+        assert response.resend == 2
+
+    def test_busy(self):
+        assert self.classifier.classify("echo:busy: processing\n").kind == BUSY
+        assert self.classifier.classify("busy: processing\n").kind == BUSY
+
+    def test_echo(self):
+        assert self.classifier.classify("echo:Unknown command: \"G999\"\n").kind == ECHO
+
+    def test_debug(self):
+        assert self.classifier.classify("DEBUG_INFO ENABLED\n").kind == DEBUG
+
+    def test_meatpack_state(self):
+        assert self.classifier.classify("[MP] PV01 ON NSP\n").kind == MEATPACK
+
+    def test_other(self):
+        assert self.classifier.classify("X:0.00 Y:0.00 Z:0.00 E:0.00\n").kind == OTHER
+        assert self.classifier.classify("\n").kind == OTHER
@@ -0,0 +1,131 @@
+import pytest
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.streaming import StreamingGCode
+
+SAMPLE = [
+    "; generated for the tests",
+    "G28",
+    "M83",
+    "",
+    "G1 Z0.2 F600",
+    "G1 X10 Y10 E1.5",
+    "G1 X20 Y10 E1.5 ; infill",
+    "G1 Z0.6 ; hop",
+    "G1 X0 Y0",
+    "G1 Z0.2",
+    "G1 X10 Y20 E1.0",
+    "   ",
+    "G1 Z0.4",
+    "G1 X10 Y10 E1.5",
+    "G1 X20 Y20 E1.5",
+]
+
+
+@pytest.fixture
+def sample_file(tmp_path):
+    path = tmp_path / "sample.gcode"
+    path.write_bytes(("\n".join(SAMPLE) + "\n").encode("utf-8"))
+    return str(path)
+
+
+class TestStreamingGCode(object):
+    def test_lines_match_gcode(self, sample_file):
+        stream = StreamingGCode(sample_file, chunk_lines=4)
+        expected = LightGCode([line.strip() for line in SAMPLE])
+
+        raws = []
+        index = 0
+        while stream.has_index(index):
+            raws.append(stream.line_at(index)[1].raw)
+            index += 1
+
+        assert raws == [line.raw for line in expected.lines]
+        assert stream.complete
+        assert len(stream) == len(expected)
+
+    def test_z_hops_are_not_layers(self, sample_file):
+        stream = StreamingGCode(sample_file)
+
+        layers = [stream.line_at(i)[0] for i in range(len(SAMPLE)) if stream.has_index(i)]
+
+        # The hop to Z0.6 doesn't extrude, only Z0.4 starts a new layer
+        assert sorted(set(layers)) == [0, 1]
+        assert layers[-1] == 1
+        assert stream.line_at(10)[1].raw == "G1 Z0.4"
+        assert stream.line_at(11)[0] == 1
+
+    def test_only_a_few_chunks_are_kept(self, long_file):
+        stream = StreamingGCode(long_file, chunk_lines=100, keep_chunks=2)
+
+        assert stream.line_at(950) is not None
+
+        assert len(stream._chunks) == 2
+        with pytest.raises(IndexError):
+            stream.line_at(10)
+        # It was there all the same
+        assert stream.has_index(10)
+
+    def test_layers_of_a_long_file(self, long_file):
+        stream = StreamingGCode(long_file, chunk_lines=64)
+
+        assert stream.line_at(1)[0] == 0
+        assert stream.line_at(101)[0] == 1
+        assert stream.line_at(999)[0] == 9
+        assert stream.line_at(1000) is None
+
+    def test_progress(self, long_file):
+        stream = StreamingGCode(long_file, chunk_lines=100)
+
+        assert stream.progress(0) == 0.0
+        stream.line_at(500)
+        assert 0.45 < stream.progress(500) < 0.55
+        stream.line_at(999)
+        assert stream.progress(999) < 1.0
+        assert stream.progress(1000) == 1.0
+
+    def test_appended_lines_come_after_the_file(self, sample_file):
+        stream = StreamingGCode(sample_file)
+        count = sum(1 for line in SAMPLE if line.strip())
+
+        stream.append("M117 done")
+
+        assert stream.line_at(count)[1].raw == "M117 done"
+        assert stream.line_at(count + 1) is None
+
+
+class TestPrintcoreStreaming(object):
+    def test_the_same_lines_are_sent(self, online_printcore, fake_printer, long_file, print_gcode):
+        with open(long_file) as fh:
+            streamed = print_gcode(StreamingGCode(long_file, chunk_lines=64))
+            del fake_printer.written[:]
+            online_printcore.lineno = 0
+            online_printcore.queueindex = 0
+            loaded = print_gcode(LightGCode([line.strip() for line in fh]))
+
+        assert streamed == loaded
+
+    def test_layer_changes_are_reported(self, online_printcore, long_file, print_gcode):
+        layers = []
+        online_printcore.layerchangecb = layers.append
+
+        print_gcode(StreamingGCode(long_file, chunk_lines=64))
+
+        assert layers == list(range(1, 10))
+
+    def test_progress(self, online_printcore, long_file):
+        online_printcore.mainqueue = StreamingGCode(long_file)
+        online_printcore.mainqueue.line_at(0)
+
+        online_printcore.queueindex = 0
+        assert online_printcore.print_progress() == 0.0
+        assert online_printcore.layer_progress() == (1, None)
+
+    def test_progress_once_the_first_lines_are_gone(self, online_printcore, long_file):
+        online_printcore.mainqueue = StreamingGCode(long_file, chunk_lines=100, keep_chunks=2)
+        online_printcore.mainqueue.line_at(950)
+        online_printcore._sent_layer = 9
+
+        online_printcore.queueindex = 950
+        assert online_printcore.layer_progress() == (10, None)
+        assert 0.9 < online_printcore.print_progress() < 1.0
@@ -0,0 +1,175 @@
+import sys
+import time
+
+import pytest
+
+from bqclient.host.drivers.printrun.gcoder import LightGCode
+from bqclient.host.drivers.printrun.printcore import printcore
+from bqclient.host.drivers.printrun.virtual_printer import VirtualPrinter
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith("win"), reason="Needs a pseudo-terminal")
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def connected():
+    printer = VirtualPrinter(seed=1)
+    printer.start()
+    core = printcore()
+    core.connect(printer.port, 115200)
+    try:
+        assert wait_for(lambda: core.online)
+        yield printer, core
+    finally:
+        core.disconnect()
+        printer.stop()
+
+
+class TestVirtualPrinter(object):
+    @pytest.mark.parametrize("window_size", [1, 4])
+    def test_a_print_reaches_the_printer_in_order(self, connected, window_size):
+        printer, core = connected
+        lines = ["G1 X%d Y%d" % (i, i) for i in range(200)]
+        core.window_size = window_size
+
+        core.startprint(LightGCode(lines))
+
+        assert wait_for(lambda: not core.printing)
+        assert printer.received == lines
+
+    @pytest.mark.parametrize("window_size", [1, 4])
+    def test_corrupted_lines_are_resent(self, connected, window_size):
+        printer, core = connected
+        lines = ["G1 X%d" % i for i in range(100)]
+        core.window_size = window_size
+        printer.corrupt(10)
+        printer.corrupt(50)
+
+        core.startprint(LightGCode(lines))
+
+        assert wait_for(lambda: not core.printing)
+        assert printer.received == lines
+        assert printer.resends_requested >= 2
+
+    @pytest.mark.parametrize("write_batch_size", [1, 8])
+    def test_the_last_lines_are_resent_with_a_large_window(self, connected, write_batch_size):
+        printer, core = connected
+        lines = ["G1 X%d" % i for i in range(400)]
+        core.window_size = 16
+        core.write_batch_size = write_batch_size
+        printer.corrupt(398)
+
+        core.startprint(LightGCode(lines))
+
+        assert wait_for(lambda: not core.printing)
+        assert printer.received == lines
+        assert printer.resends_requested >= 1
+
+    def test_moves_wait_for_room_in_the_planner(self, connected):
+        printer, core = connected
+        printer.planner_buffer_size = 2
+        printer.move_time = 0.02
+        core.window_size = 4
+
+        started = time.monotonic()
+        core.startprint(LightGCode(["G1 X%d" % i for i in range(10)]))
+
+        assert wait_for(lambda: not core.printing)
+        # The last two moves can still be in the planner once they are acked
+        assert time.monotonic() - started >= 8 * 0.02
+
+    def test_temperatures_are_reported(self, connected):
+        printer, core = connected
+        reports = []
+        core.tempcb = reports.append
+
+        core.send_now("M104 S210")
+        core.send_now("M105")
+
+        assert wait_for(lambda: reports)
+        assert reports[-1].startswith("ok T:210.00 /210.00")
+
+
+def start(printer, meatpack):
+    printer.start()
+    core = printcore()
+    core.meatpack = meatpack
+    core.connect(printer.port, 115200)
+    assert wait_for(lambda: core.online)
+    return core
+
+
+class TestMeatPack(object):
+    @pytest.mark.parametrize("meatpack", [True, "auto"])
+    def test_a_packed_print_reaches_the_printer_in_order(self, meatpack):
+        printer = VirtualPrinter(seed=1, meatpack=True)
+        core = start(printer, meatpack)
+        lines = ["G1 X%.3f Y%.3f E%.5f" % (i * 0.5, i * 0.25, i * 0.01) for i in range(200)]
+        try:
+            core.window_size = 4
+            printer.corrupt(10)
+
+            core.startprint(LightGCode(lines))
+
+            assert wait_for(lambda: not core.printing)
+            assert core.packing
+            assert printer.unpacker.active and printer.unpacker.no_spaces
+            # G lines are sent without their spaces
+            assert printer.received == [line.replace(" ", "") for line in lines]
+            assert printer.resends_requested >= 1
+        finally:
+            core.disconnect()
+            printer.stop()
+
+    def test_takes_fewer_bytes(self):
+        lines = ["G1 X%.3f Y%.3f E%.5f" % (100 + i % 50, 100 + i % 70, i * 0.01) for i in range(500)]
+        received = []
+        for meatpack in (False, True):
+            printer = VirtualPrinter(seed=1, meatpack=meatpack)
+            core = start(printer, meatpack)
+            try:
+                sent_before = printer.bytes_received
+                core.startprint(LightGCode(lines))
+                assert wait_for(lambda: not core.printing)
+                received.append(printer.bytes_received - sent_before)
+            finally:
+                core.disconnect()
+                printer.stop()
+
+        assert received[1] < 0.6 * received[0]
+
+    def test_auto_leaves_other_firmwares_alone(self):
+        printer = VirtualPrinter(seed=1)
+        core = start(printer, "auto")
+        try:
+            core.send_now("M104 S210")
+            core.startprint(LightGCode(["G1 X%d" % i for i in range(20)]))
+
+            assert wait_for(lambda: not core.printing)
+            assert not core.packing
+            assert printer.received == ["G1 X%d" % i for i in range(20)]
+            assert printer.hotend_target == 210
+        finally:
+            core.disconnect()
+            printer.stop()
+
+    def test_packing_is_turned_off_on_disconnect(self):
+        printer = VirtualPrinter(seed=1, meatpack=True)
+        core = start(printer, True)
+        try:
+            core.send_now("M105")
+            assert wait_for(lambda: printer.unpacker.active)
+
+            core.disconnect()
+
+            assert wait_for(lambda: not printer.unpacker.active)
+        finally:
+            printer.stop()
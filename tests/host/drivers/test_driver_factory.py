@@ -1,8 +1,13 @@
+import math
+import os
+
 import pytest
 
 from bqclient.host.drivers.driver_factory import DriverFactory, InvalidDriver
 from bqclient.host.drivers.dummy import DummyDriver
-from bqclient.host.drivers.printrun_driver import PrintrunDriver
+from bqclient.host.drivers.printrun import gcoder
+from bqclient.host.drivers.printrun.printcore import PrintFailed
+from bqclient.host.drivers.printrun_driver import GCodeAnalysisCache, PrintrunDriver, SharedReactor
 
 
 class TestDriverFactory(object):
@@ -74,3 +79,414 @@ class TestDriverFactory(object):
         assert isinstance(driver, PrintrunDriver)
         assert driver.serial_port == "/dev/testSerial"
         assert driver.baud_rate == 250000
+
+    def test_printrun_driver_defaults_to_one_line_in_flight(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+
+        assert driver.window_size == 1
+        assert driver.printcore.window_size == 1
+
+    def test_printrun_driver_will_populate_window_size(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "window_size": 4
+            }
+        })
+
+        assert driver.window_size == 4
+        assert driver.printcore.window_size == 4
+
+    def test_printrun_driver_will_populate_history_sizes(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "resend_history_size": 128,
+                "send_log_size": 10
+            }
+        })
+
+        assert driver.printcore.resend_history_size == 128
+        assert driver.printcore.send_log_size == 10
+
+    def test_printrun_driver_will_populate_write_batching(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "write_batch_size": 8,
+                "write_batch_latency": 0.01
+            }
+        })
+
+        assert driver.printcore.write_batch_size == 8
+        assert driver.printcore.write_batch_latency == 0.01
+
+    def test_printrun_driver_does_not_pack_lines_by_default(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+
+        assert not driver.printcore.meatpack
+
+    def test_printrun_driver_reports_meatpack_on_connect(self, resolver, monkeypatch, capsys):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "meatpack": "auto"
+            }
+        })
+        monkeypatch.setattr(driver.printcore, "connect", lambda port, baud: None)
+        driver.printcore.online = True
+
+        driver.connect()
+
+        assert driver.printcore.meatpack == "auto"
+        assert "did not answer for MeatPack" in capsys.readouterr().out
+
+    def test_printrun_driver_uses_its_own_threads_by_default(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+
+        assert driver.printcore.reactor is None
+
+    def test_printrun_drivers_share_the_reactor(self, resolver):
+        factory = resolver(DriverFactory)
+        setup = {
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "reactor": True
+            }
+        }
+
+        first: PrintrunDriver = factory.get(setup)
+        second: PrintrunDriver = factory.get(setup)
+
+        assert isinstance(first.printcore.reactor, SharedReactor)
+        assert first.printcore.reactor is second.printcore.reactor
+
+    def test_printrun_driver_loads_gcode_up_front_by_default(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+
+        assert not driver.stream_gcode
+
+    def test_printrun_driver_can_stream_gcode(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "stream_gcode": True
+            }
+        })
+
+        assert driver.stream_gcode
+
+    def test_printrun_driver_can_map_gcode(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "map_gcode": True
+            }
+        })
+
+        assert driver.map_gcode
+
+    def test_printrun_driver_shares_the_analysis_cache(self, resolver):
+        factory = resolver(DriverFactory)
+        setup = {
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        }
+
+        first: PrintrunDriver = factory.get(setup)
+        second: PrintrunDriver = factory.get(setup)
+
+        assert isinstance(first.analysis_cache, GCodeAnalysisCache)
+        assert first.analysis_cache is second.analysis_cache
+
+    def test_printrun_driver_analysis_cache_can_be_disabled(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "analysis_cache": False
+            }
+        })
+
+        assert driver.analysis_cache is None
+
+    def test_printrun_driver_parse_workers(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "parse_workers": 4
+            }
+        })
+
+        assert driver.parse_workers == 4
+
+    def test_printrun_driver_keeps_line_objects_by_default(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+
+        assert not driver.pack_lines
+
+    def test_printrun_driver_can_pack_lines(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "pack_lines": True
+            }
+        })
+
+        assert driver.pack_lines
+
+    def test_printrun_driver_reports_the_gcode_lines_on_connect(self, resolver, monkeypatch, capsys):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+        monkeypatch.setattr(driver.printcore, "connect", lambda port, baud: None)
+        driver.printcore.online = True
+
+        driver.connect()
+
+        output = capsys.readouterr().out
+        assert gcoder.implementation() in output
+
+    def test_printrun_driver_does_not_optimize_by_default(self, resolver):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+
+        assert not driver.optimize_gcode
+        assert driver.arc_tolerance is None
+
+    def test_printrun_driver_prints_the_optimized_file(self, resolver, tmp_path, capsys):
+        factory = resolver(DriverFactory)
+        path = tmp_path / "print.gcode"
+        path.write_text("; start\nG90\nG1 X10.000 F1800\nG1 X10.000 Y5 F1800\n")
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "optimize_gcode": True
+            }
+        })
+        printed = []
+
+        def run(filename, update_job_progress):
+            with open(filename) as fh:
+                printed.append((filename, fh.read()))
+        driver._run = run
+
+        driver.run(str(path))
+
+        ((filename, content),) = printed
+        assert content == "G90\nG1 X10 F1800\nG1 Y5\n"
+        assert not os.path.exists(filename)
+        assert "Optimized print.gcode: saved" in capsys.readouterr().out
+
+    def test_printrun_driver_fits_arcs_when_asked(self, resolver, tmp_path, capsys):
+        factory = resolver(DriverFactory)
+        path = tmp_path / "print.gcode"
+        lines = ["G90", "M82", "G92 E0", "G1 X10 Y0 F1800"]
+        for k in range(1, 46):
+            angle = k * math.pi / 45
+            lines.append("G1 X%.3f Y%.3f E%.3f" % (10 * math.cos(angle), 10 * math.sin(angle), k * 0.02))
+        path.write_text("\n".join(lines) + "\n")
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                },
+                "arc_tolerance": "0.02"
+            }
+        })
+        printed = []
+
+        def run(filename, update_job_progress):
+            with open(filename) as fh:
+                printed.append(fh.read().splitlines())
+        driver._run = run
+
+        driver.run(str(path))
+
+        assert driver.arc_tolerance == 0.02
+        assert printed[0][:4] == lines[:4]
+        (command, x, y, i, j, e) = printed[0][-1].split()
+        assert (command, x, y, e) == ("G3", "X-10", "Y0", "E0.9")
+        assert float(i[1:]) == pytest.approx(-10, abs=0.02)
+        assert "Fitted 45 moves into 1 arcs" in capsys.readouterr().out
+
+    def test_printrun_driver_fails_a_print_the_printer_stopped(self, resolver, tmp_path):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+        path = tmp_path / "print.gcode"
+        path.write_text("G1 X1\nG1 X2\n")
+
+        def startprint(gcode):
+            driver.printcore.print_error = "Firmware asked to resend line 2"
+        driver.printcore.startprint = startprint
+
+        with pytest.raises(PrintFailed, match="resend line 2"):
+            driver._run(str(path), None)
+
+    def test_printrun_driver_loads_through_the_analysis_cache_by_default(self, resolver, tmp_path):
+        factory = resolver(DriverFactory)
+
+        driver: PrintrunDriver = factory.get({
+            "type": "gcode",
+            "config": {
+                "connection": {
+                    "type": "serial",
+                    "port": "/dev/testSerial"
+                }
+            }
+        })
+        path = tmp_path / "print.gcode"
+        path.write_text("G1 Z0.2\nG1 X1 E1\nG1 Z0.4\nG1 X2 E2\n")
+        printed = []
+        driver.printcore.startprint = printed.append
+
+        driver._run(str(path), None)
+
+        assert printed[0].layers_count == 2
+        assert os.listdir(driver.analysis_cache.directory)
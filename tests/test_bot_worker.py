@@ -369,6 +369,57 @@ class TestBotWorker(object):
 
         dummy_driver.disconnect.assert_called_once()
 
+    def test_job_the_driver_fails_is_not_finished(self, resolver):
+        driver_factory = MagicMock(DriverFactory)
+        resolver.instance(driver_factory)
+
+        dummy_driver = MagicMock(DummyDriver)
+        failure = RuntimeError("Firmware asked for a line that is gone")
+        dummy_driver.run.side_effect = failure
+        driver_factory.get.return_value = dummy_driver
+
+        bot = Bot(
+            id=1,
+            name="Test Bot",
+            status="job_assigned",
+            type="3d_printer",
+            driver={"type": "dummy"}
+        )
+
+        worker: BotWorker = resolver(BotWorker, bot=bot)
+
+        job = Job(
+            id=2,
+            name="Test Job",
+            status="assigned",
+            file_url="https://test.url/foo.gcode"
+        )
+
+        downloader = MagicMock(Downloader)
+        downloader.download.return_value = "foo.gcode"
+        resolver.instance(downloader)
+
+        resolver.instance(MagicMock(StartJob))
+
+        finish_job = MagicMock(FinishJob)
+        resolver.instance(finish_job)
+
+        bot_error = MagicMock()
+        resolver.instance(BotError, bot_error)
+
+        JobEvents.JobAssigned(job, bot).fire()
+
+        # TODO: Fix fragile test
+        assert worker._current_job is not None
+        while worker._current_job is not None:
+            pass
+
+        worker.stop()
+
+        finish_job.assert_not_called()
+        bot_error.assert_called_once_with(bot.id, failure)
+        assert worker.bot.status == "error"
+
     def test_bot_updated_does_not_force_driver_reconnect(self, resolver):
         driver_factory = MagicMock(DriverFactory)
         resolver.instance(driver_factory)